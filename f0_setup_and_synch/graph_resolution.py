@@ -0,0 +1,358 @@
+"""
+Transitive merging of master profiles.
+
+A raw profile is linked to a single master, so when its email belongs to master A and its phone
+to master B, A and B stay two masters. For a window of raw profiles, load_candidate_edges reads
+such (linked master, identifier owner) pairs from cdp_master_identifiers, a union-find computes
+the connected components in memory, and merge_components merges every component into its oldest
+master in one transaction: the survivor is consolidated with the data of the others, and
+cdp_profile_links, cdp_behavioral_events and cdp_master_identifiers are re-pointed in bulk before
+the merged masters are deleted.
+"""
+import io
+import logging
+import os
+import time
+from datetime import datetime
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+# Rows fetched per round trip while streaming the candidate edges
+EDGE_FETCH_SIZE = int(os.environ.get("GRAPH_EDGE_FETCH_SIZE", "100000"))
+
+
+class UnionFind:
+    """Disjoint sets over hashable keys, with union by size and path halving."""
+
+    def __init__(self):
+        self.index = {}
+        self.keys = []
+        self.parent = []
+        self.size = []
+
+    def find(self, i: int) -> int:
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def root(self, key):
+        """Representative index of the component of key, None for a key never added."""
+        i = self.index.get(key)
+        return None if i is None else self.find(i)
+
+    def union(self, a, b):
+        self.add_edges(((a, b),))
+
+    def add_edges(self, edges) -> int:
+        """Union every (a, b) pair of keys; returns the number of edges read."""
+        index, keys, parent, size = self.index, self.keys, self.parent, self.size
+        count = 0
+        # find() is inlined: this loop runs once per edge, millions of times per window
+        for a, b in edges:
+            count += 1
+            ri = index.get(a)
+            if ri is None:
+                ri = index[a] = len(parent)
+                keys.append(a)
+                parent.append(ri)
+                size.append(1)
+            rj = index.get(b)
+            if rj is None:
+                rj = index[b] = len(parent)
+                keys.append(b)
+                parent.append(rj)
+                size.append(1)
+            while parent[ri] != ri:
+                parent[ri] = ri = parent[parent[ri]]
+            while parent[rj] != rj:
+                parent[rj] = rj = parent[parent[rj]]
+            if ri == rj:
+                continue
+            if size[ri] < size[rj]:
+                ri, rj = rj, ri
+            parent[rj] = ri
+            size[ri] += size[rj]
+        return count
+
+    def components(self):
+        """Lists of keys of the components with more than one key."""
+        parent, size = self.parent, self.size
+        groups = {}
+        for i, key in enumerate(self.keys):
+            root = i
+            while parent[root] != root:
+                parent[root] = root = parent[parent[root]]
+            if size[root] > 1:
+                members = groups.get(root)
+                if members is None:
+                    groups[root] = [key]
+                else:
+                    members.append(key)
+        return list(groups.values())
+
+
+# A raw profile of the window links master A (cdp_profile_links) while one of its identifiers
+# belongs to master B (cdp_master_identifiers): A and B are the same customer
+sql_candidate_edges = """
+    SELECT DISTINCT l.master_profile_id::TEXT, mi.master_profile_id::TEXT
+    FROM cdp_raw_profiles_stage r
+    JOIN cdp_profile_links l ON l.raw_profile_id = r.raw_profile_id
+    CROSS JOIN LATERAL profile_identifiers(
+        r.email::TEXT, r.phone_number, r.web_visitor_id, r.source_system, r.crm_source_id, r.social_user_id
+    ) i
+    JOIN cdp_profile_attributes a
+      ON a.attribute_internal_code = i.id_type
+     AND a.is_identity_resolution = TRUE
+     AND a.status = 'ACTIVE'
+     AND a.matching_rule = 'exact'
+    JOIN cdp_master_identifiers mi
+      ON mi.tenant_id = r.tenant_id AND mi.id_type = i.id_type AND mi.id_value = i.id_value
+    WHERE r.received_at >= %s AND r.received_at < %s
+      AND mi.master_profile_id <> l.master_profile_id
+"""
+
+sql_create_graph_nodes = """
+    CREATE TEMP TABLE tmp_graph_nodes (
+        master_profile_id UUID PRIMARY KEY,
+        component INT NOT NULL
+    ) ON COMMIT DROP
+"""
+
+sql_copy_graph_nodes = "COPY tmp_graph_nodes (master_profile_id, component) FROM STDIN"
+
+# Lock the masters of the components in a fixed order, so that concurrent merges cannot deadlock
+sql_lock_graph_masters = """
+    SELECT mp.master_profile_id
+    FROM cdp_master_profiles mp
+    JOIN tmp_graph_nodes n ON n.master_profile_id = mp.master_profile_id
+    ORDER BY mp.master_profile_id
+    FOR UPDATE OF mp
+"""
+
+# Survivor of a component: its oldest master still present
+sql_create_master_merges = """
+    CREATE TEMP TABLE tmp_master_merges ON COMMIT DROP AS
+    WITH alive AS (
+        SELECT n.component, mp.master_profile_id, mp.created_at
+        FROM tmp_graph_nodes n
+        JOIN cdp_master_profiles mp ON mp.master_profile_id = n.master_profile_id
+    ),
+    survivors AS (
+        SELECT DISTINCT ON (component) component, master_profile_id AS survivor_id
+        FROM alive
+        ORDER BY component, created_at, master_profile_id
+    )
+    SELECT a.master_profile_id AS loser_id, s.survivor_id
+    FROM alive a
+    JOIN survivors s ON s.component = a.component
+    WHERE a.master_profile_id <> s.survivor_id
+"""
+
+# Consolidate the survivor: its own values win, the merged masters fill the gaps and add their identifiers
+sql_consolidate_survivors = """
+    WITH losers AS (
+        SELECT m.survivor_id, l.*
+        FROM tmp_master_merges m
+        JOIN cdp_master_profiles l ON l.master_profile_id = m.loser_id
+    ),
+    loser_values AS (
+        SELECT l.survivor_id, v.kind, v.value
+        FROM losers l
+        CROSS JOIN LATERAL (
+            SELECT 'email', l.email::TEXT
+            UNION ALL SELECT 'email', unnest(l.secondary_emails)
+            UNION ALL SELECT 'phone_number', l.phone_number::TEXT
+            UNION ALL SELECT 'phone_number', unnest(l.secondary_phone_numbers)
+            UNION ALL SELECT 'web_visitor_id', unnest(l.web_visitor_ids)
+            UNION ALL SELECT 'source_system', unnest(l.source_systems)
+        ) AS v(kind, value)
+        WHERE v.value IS NOT NULL AND v.value <> ''
+    ),
+    loser_json AS (
+        SELECT l.survivor_id, j.kind, j.key, j.value
+        FROM losers l
+        CROSS JOIN LATERAL (
+            SELECT 'crm', c.key, c.value FROM jsonb_each(CASE WHEN jsonb_typeof(l.crm_contact_ids) = 'object' THEN l.crm_contact_ids ELSE '{}'::jsonb END) c
+            UNION ALL
+            SELECT 'social', s.key, s.value FROM jsonb_each(CASE WHEN jsonb_typeof(l.social_user_ids) = 'object' THEN l.social_user_ids ELSE '{}'::jsonb END) s
+            UNION ALL
+            SELECT 'ext', e.key, e.value FROM jsonb_each(CASE WHEN jsonb_typeof(l.ext_attributes) = 'object' THEN l.ext_attributes ELSE '{}'::jsonb END) e
+        ) AS j(kind, key, value)
+    ),
+    fields AS (
+        SELECT
+            survivor_id,
+            (array_agg(email::TEXT ORDER BY created_at) FILTER (WHERE email IS NOT NULL AND email <> ''))[1] AS email,
+            (array_agg(phone_number ORDER BY created_at) FILTER (WHERE phone_number IS NOT NULL AND phone_number <> ''))[1] AS phone_number,
+            (array_agg(first_name ORDER BY created_at) FILTER (WHERE first_name IS NOT NULL))[1] AS first_name,
+            (array_agg(last_name ORDER BY created_at) FILTER (WHERE last_name IS NOT NULL))[1] AS last_name,
+            (array_agg(gender ORDER BY created_at) FILTER (WHERE gender IS NOT NULL AND gender <> 'unknown'))[1] AS gender,
+            (array_agg(date_of_birth ORDER BY created_at) FILTER (WHERE date_of_birth IS NOT NULL))[1] AS date_of_birth,
+            max(last_seen_at) AS last_seen_at
+        FROM losers
+        GROUP BY survivor_id
+    ),
+    arrays AS (
+        SELECT
+            survivor_id,
+            array_agg(DISTINCT value) FILTER (WHERE kind = 'email') AS emails,
+            array_agg(DISTINCT value) FILTER (WHERE kind = 'phone_number') AS phone_numbers,
+            array_agg(DISTINCT value) FILTER (WHERE kind = 'web_visitor_id') AS web_visitor_ids,
+            array_agg(DISTINCT value) FILTER (WHERE kind = 'source_system') AS source_systems
+        FROM loser_values
+        GROUP BY survivor_id
+    ),
+    objects AS (
+        SELECT
+            survivor_id,
+            jsonb_object_agg(key, value) FILTER (WHERE kind = 'crm') AS crm_contact_ids,
+            jsonb_object_agg(key, value) FILTER (WHERE kind = 'social') AS social_user_ids,
+            jsonb_object_agg(key, value) FILTER (WHERE kind = 'ext') AS ext_attributes
+        FROM loser_json
+        GROUP BY survivor_id
+    ),
+    merged AS (
+        SELECT
+            f.*,
+            a.emails, a.phone_numbers, a.web_visitor_ids, a.source_systems,
+            o.crm_contact_ids, o.social_user_ids, o.ext_attributes,
+            COALESCE(NULLIF(s.email::TEXT, ''), f.email) AS final_email,
+            COALESCE(NULLIF(s.phone_number, ''), f.phone_number) AS final_phone_number
+        FROM fields f
+        JOIN cdp_master_profiles s ON s.master_profile_id = f.survivor_id
+        LEFT JOIN arrays a ON a.survivor_id = f.survivor_id
+        LEFT JOIN objects o ON o.survivor_id = f.survivor_id
+    )
+    UPDATE cdp_master_profiles s
+    SET
+        email = m.final_email,
+        secondary_emails = ARRAY(
+            SELECT DISTINCT elem FROM unnest(COALESCE(s.secondary_emails, '{}'::TEXT[]) || COALESCE(m.emails, '{}'::TEXT[])) AS elem
+            WHERE elem <> '' AND elem::CITEXT IS DISTINCT FROM m.final_email::CITEXT
+        ),
+        phone_number = m.final_phone_number,
+        secondary_phone_numbers = ARRAY(
+            SELECT DISTINCT elem FROM unnest(COALESCE(s.secondary_phone_numbers, '{}'::TEXT[]) || COALESCE(m.phone_numbers, '{}'::TEXT[])) AS elem
+            WHERE elem <> '' AND elem IS DISTINCT FROM m.final_phone_number
+        ),
+        web_visitor_ids = ARRAY(
+            SELECT DISTINCT elem FROM unnest(COALESCE(s.web_visitor_ids, '{}'::TEXT[]) || COALESCE(m.web_visitor_ids, '{}'::TEXT[])) AS elem
+        ),
+        source_systems = ARRAY(
+            SELECT DISTINCT elem FROM unnest(COALESCE(s.source_systems, '{}'::TEXT[]) || COALESCE(m.source_systems, '{}'::TEXT[])) AS elem
+        ),
+        crm_contact_ids = COALESCE(m.crm_contact_ids, '{}'::jsonb) || COALESCE(s.crm_contact_ids, '{}'::jsonb),
+        social_user_ids = COALESCE(m.social_user_ids, '{}'::jsonb) || COALESCE(s.social_user_ids, '{}'::jsonb),
+        ext_attributes = COALESCE(m.ext_attributes, '{}'::jsonb) || COALESCE(s.ext_attributes, '{}'::jsonb),
+        first_name = COALESCE(s.first_name, m.first_name),
+        last_name = COALESCE(s.last_name, m.last_name),
+        gender = CASE WHEN s.gender IS NULL OR s.gender = 'unknown' THEN COALESCE(m.gender, s.gender) ELSE s.gender END,
+        date_of_birth = COALESCE(s.date_of_birth, m.date_of_birth),
+        last_seen_at = GREATEST(s.last_seen_at, m.last_seen_at),
+        updated_at = NOW(),
+        status_code = 10
+    FROM merged m
+    WHERE s.master_profile_id = m.survivor_id
+"""
+
+sql_repoint_profile_links = """
+    UPDATE cdp_profile_links l
+    SET master_profile_id = m.survivor_id
+    FROM tmp_master_merges m
+    WHERE l.master_profile_id = m.loser_id
+"""
+
+sql_repoint_behavioral_events = """
+    UPDATE cdp_behavioral_events e
+    SET master_profile_id = m.survivor_id
+    FROM tmp_master_merges m
+    WHERE e.master_profile_id = m.loser_id
+"""
+
+sql_repoint_master_identifiers = """
+    UPDATE cdp_master_identifiers mi
+    SET master_profile_id = m.survivor_id
+    FROM tmp_master_merges m
+    WHERE mi.master_profile_id = m.loser_id
+"""
+
+sql_delete_merged_masters = """
+    DELETE FROM cdp_master_profiles mp
+    USING tmp_master_merges m
+    WHERE mp.master_profile_id = m.loser_id
+"""
+
+
+def load_candidate_edges(conn, from_dt: datetime, to_dt: datetime, union_find: UnionFind) -> int:
+    """Stream the candidate edges of raw profiles received in [from_dt, to_dt) into union_find."""
+    with conn.cursor(name="graph_candidate_edges") as cursor:
+        cursor.itersize = EDGE_FETCH_SIZE
+        cursor.execute(sql_candidate_edges, (from_dt, to_dt))
+        return union_find.add_edges(cursor)
+
+
+def merge_components(conn, components) -> dict:
+    """
+    Merge every component into its oldest master, in the current transaction (committed by the caller).
+    Returns the number of merged masters and re-pointed rows.
+    """
+    buffer = io.StringIO()
+    for component, members in enumerate(components):
+        for master_profile_id in members:
+            buffer.write(f"{master_profile_id}\t{component}\n")
+    buffer.seek(0)
+
+    stats = {}
+    with conn.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS tmp_master_merges; DROP TABLE IF EXISTS tmp_graph_nodes;")
+        cursor.execute(sql_create_graph_nodes)
+        cursor.copy_expert(sql_copy_graph_nodes, buffer)
+        cursor.execute(sql_lock_graph_masters)
+        cursor.execute(sql_create_master_merges)
+        stats["merged_masters"] = cursor.rowcount
+
+        cursor.execute(sql_consolidate_survivors)
+        stats["survivors"] = cursor.rowcount
+        cursor.execute(sql_repoint_profile_links)
+        stats["profile_links"] = cursor.rowcount
+        cursor.execute("SELECT to_regclass('cdp_behavioral_events') IS NOT NULL")
+        if cursor.fetchone()[0]:
+            cursor.execute(sql_repoint_behavioral_events)
+            stats["behavioral_events"] = cursor.rowcount
+        cursor.execute(sql_repoint_master_identifiers)
+        stats["master_identifiers"] = cursor.rowcount
+        cursor.execute(sql_delete_merged_masters)
+    return stats
+
+
+def resolve_identity_graph(conn, from_dt: datetime, to_dt: datetime) -> dict:
+    """
+    Merge the masters connected through the raw profiles received in [from_dt, to_dt).
+    One transaction: the window is merged completely or not at all.
+    """
+    started = time.perf_counter()
+    union_find = UnionFind()
+    try:
+        edge_count = load_candidate_edges(conn, from_dt, to_dt, union_find)
+        components = union_find.components()
+        loaded = time.perf_counter()
+        logger.info(f"Graph {from_dt} - {to_dt}: {edge_count} edges, {len(union_find.parent)} masters, "
+                    f"{len(components)} components to merge ({loaded - started:.2f}s)")
+
+        stats = {"edges": edge_count, "components": len(components)}
+        if components:
+            stats.update(merge_components(conn, components))
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+
+    stats["duration_seconds"] = round(time.perf_counter() - started, 3)
+    if components:
+        logger.info(f"Graph merge committed: {stats}")
+    return stats
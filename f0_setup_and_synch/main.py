@@ -4,6 +4,9 @@ import logging
 from datetime import datetime, timedelta, timezone
 import psycopg2
 
+import graph_resolution
+import resolution_worker
+
 # --- Logger Setup ---
 logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
@@ -25,6 +28,12 @@ DEFAULT_WINDOW_INTERVAL = timedelta(seconds=int(os.environ.get("WINDOW_INTERVAL_
 DEFAULT_MAX_ITERATIONS = int(os.environ.get("MAX_ITERATIONS", "10000"))
 DEFAULT_MAX_LOOP_DURATION = timedelta(hours=int(os.environ.get("MAX_LOOP_HOURS", "6")))
 
+# Merge the masters connected through the raw profiles of each window (graph_resolution.py)
+GRAPH_RESOLUTION_ENABLED = os.environ.get("GRAPH_RESOLUTION_ENABLED", "false").lower() == "true"
+
+# 'database': process_new_raw_profiles (PL/pgSQL), 'worker': resolution_worker.py (exact rules only)
+IDENTITY_RESOLUTION_ENGINE = os.environ.get("IDENTITY_RESOLUTION_ENGINE", "database").lower()
+
 
 def get_db_connection():
     logger.debug(f"Connecting to DB at {DB_HOST}:{DB_PORT}")
@@ -110,8 +119,13 @@ def lambda_handler(event, context):
 
             logger.info(f"Iteration {iteration_count}: Processing from {from_dt} to {to_dt}")
 
-            processed = call_process_new_raw_profiles(conn, from_dt, to_dt)
+            if IDENTITY_RESOLUTION_ENGINE == "worker":
+                processed = resolution_worker.resolve_window(conn, from_dt, to_dt)
+            else:
+                processed = call_process_new_raw_profiles(conn, from_dt, to_dt)
             logger.info(f"Iteration {iteration_count} complete. Records processed: {processed}")
+            if GRAPH_RESOLUTION_ENABLED:
+                graph_resolution.resolve_identity_graph(conn, from_dt, to_dt)
             total_processed += processed
             current_target_time = from_dt  # Move window backwards
 
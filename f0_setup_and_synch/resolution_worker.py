@@ -0,0 +1,238 @@
+"""
+Identity resolution worker running outside PostgreSQL, for the 'exact' rules.
+
+Each batch is one transaction:
+1. claim_identity_resolution_batch claims raw profiles with FOR UPDATE SKIP LOCKED into tmp_ir_batch,
+   extracts their identifiers and takes an advisory lock per identifier (16_identity_resolution_set_based.sql).
+   The locks are held until commit in the shared lock table, so batches are kept to a few hundred raw profiles
+   and the claim trims a batch to cdp.identity_resolution_max_locks identifiers.
+2. The master identifiers of the batch are loaded into a dict (find_master_by_profile_columns for the raw
+   profiles none of them matches), and the batch is resolved in memory:
+   own match by identifier priority, then the raw profiles sharing an identifier are grouped with a union-find.
+3. The assignments are written back with COPY, and apply_identity_resolution_batch creates the new masters,
+   consolidates the existing ones and inserts the links and identifiers with one statement each.
+
+Workers can run in parallel, in processes or containers: SKIP LOCKED gives each one different raw
+profiles, and the identifier locks make a worker wait for the one creating the master of a shared
+identifier, so two workers never create two masters for the same customer.
+
+    DB_HOST=localhost DB_NAME=c360 DB_USER=postgres DB_PASS=... python resolution_worker.py --workers 4
+"""
+import argparse
+import io
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import psycopg2
+
+from graph_resolution import UnionFind
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+# Raw profiles claimed per transaction, each holds an advisory lock per identifier until commit
+WORKER_BATCH_SIZE = int(os.environ.get("RESOLUTION_WORKER_BATCH_SIZE", "200"))
+
+sql_claim_batch = "SELECT claim_identity_resolution_batch(%s, %s, %s)"
+
+# Identifiers of the claimed raw profiles, in priority order for each raw profile
+sql_batch_identifiers = """
+    SELECT b.ord, i.tenant_id, i.id_type, i.id_value
+    FROM tmp_ir_identifiers i
+    JOIN tmp_ir_batch b ON b.raw_profile_id = i.raw_profile_id
+    ORDER BY b.ord, i.priority
+"""
+
+sql_load_master_identifiers = """
+    SELECT mi.tenant_id, mi.id_type, mi.id_value, mi.master_profile_id::TEXT
+    FROM (SELECT DISTINCT tenant_id, id_type, id_value FROM tmp_ir_identifiers) i
+    JOIN cdp_master_identifiers mi
+      ON mi.tenant_id = i.tenant_id AND mi.id_type = i.id_type AND mi.id_value = i.id_value
+"""
+
+# Identifiers not registered in cdp_master_identifiers (not backfilled, written outside register_master_identifiers):
+# like the database engines, the raw profiles left unmatched are looked up on the cdp_master_profiles columns
+sql_match_by_profile_columns = """
+    SELECT b.ord, m.master_profile_id::TEXT
+    FROM tmp_ir_batch b
+    JOIN cdp_raw_profiles_stage r ON r.raw_profile_id = b.raw_profile_id
+    CROSS JOIN LATERAL find_master_by_profile_columns(r) AS m(master_profile_id)
+    WHERE b.ord = ANY(%s) AND m.master_profile_id IS NOT NULL
+"""
+
+sql_create_assignments = """
+    CREATE TEMP TABLE tmp_ir_assignments (
+        ord INT PRIMARY KEY,
+        matched_master_id UUID,
+        anchor_ord INT NOT NULL,
+        final_master_id UUID NOT NULL,
+        is_creator BOOLEAN NOT NULL
+    ) ON COMMIT DROP
+"""
+
+COPY_NULL = "\\N"
+sql_copy_assignments = "COPY tmp_ir_assignments (ord, matched_master_id, anchor_ord, final_master_id, is_creator) FROM STDIN"
+
+sql_apply_assignments = """
+    UPDATE tmp_ir_batch b
+    SET matched_master_id = a.matched_master_id,
+        anchor_ord = a.anchor_ord,
+        final_master_id = a.final_master_id,
+        is_creator = a.is_creator
+    FROM tmp_ir_assignments a
+    WHERE b.ord = a.ord
+"""
+
+sql_apply_batch = "SELECT apply_identity_resolution_batch('Worker')"
+
+
+def unmatched_ords(claimed: int, identifiers, master_ids: dict) -> list:
+    """Ords of the raw profiles none of whose identifiers is in master_ids."""
+    matched = {ord_ for ord_, key in identifiers if key in master_ids}
+    return [ord_ for ord_ in range(1, claimed + 1) if ord_ not in matched]
+
+
+def resolve_batch(claimed: int, identifiers, master_ids: dict, column_matches: dict = None) -> list:
+    """
+    Resolve the raw profiles 1..claimed (ord) of a batch in memory, like resolve_customer_identities_set_based.
+
+    identifiers: (ord, identifier key) pairs in priority order for each ord.
+    master_ids: identifier key -> master_profile_id of the identifiers already owned by a master.
+    column_matches: ord -> master_profile_id found on the master columns, for the ords not matched by master_ids.
+    Returns (ord, matched_master_id, anchor_ord, final_master_id, is_creator) rows.
+    """
+    matched = {}
+    union_find = UnionFind()
+    for ord_, key in identifiers:
+        if ord_ not in matched:
+            master_profile_id = master_ids.get(key)
+            if master_profile_id is not None:
+                matched[ord_] = master_profile_id
+    for ord_, master_profile_id in (column_matches or {}).items():
+        matched.setdefault(ord_, master_profile_id)
+    # Raw profiles sharing an identifier are one group (ord keys are ints, identifier keys are tuples)
+    union_find.add_edges(identifiers)
+
+    roots = [None] * (claimed + 1)
+    anchors, group_masters = {}, {}
+    for ord_ in range(1, claimed + 1):
+        root = union_find.root(ord_)
+        if root is None:
+            root = ("ord", ord_)  # no identifier: a group of its own
+        roots[ord_] = root
+        anchors.setdefault(root, ord_)
+        if ord_ in matched:
+            group_masters.setdefault(root, matched[ord_])
+
+    new_masters = {}
+    rows = []
+    for ord_ in range(1, claimed + 1):
+        root = roots[ord_]
+        own = matched.get(ord_)
+        group = group_masters.get(root)
+        if own is None and group is None:
+            final = new_masters.get(root)
+            if final is None:
+                final = new_masters[root] = str(uuid.uuid4())
+        else:
+            final = own or group
+        is_creator = group is None and anchors[root] == ord_
+        rows.append((ord_, own, anchors[root], final, is_creator))
+    return rows
+
+
+def _copy_assignments(cursor, rows):
+    buffer = io.StringIO()
+    for ord_, own, anchor, final, is_creator in rows:
+        buffer.write(f"{ord_}\t{own or COPY_NULL}\t{anchor}\t{final}\t{'t' if is_creator else 'f'}\n")
+    buffer.seek(0)
+    cursor.copy_expert(sql_copy_assignments, buffer)
+
+
+def process_batch(conn, batch_size: int, from_dt=None, to_dt=None) -> int:
+    """Claim, resolve and write back one batch. Returns the number of raw profiles resolved, 0 when none is left."""
+    started = time.perf_counter()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(sql_claim_batch, (batch_size, from_dt, to_dt))
+            claimed = cursor.fetchone()[0]
+            if not claimed:
+                conn.commit()
+                return 0
+
+            cursor.execute(sql_batch_identifiers)
+            identifiers = [(ord_, (tenant_id, id_type, id_value)) for ord_, tenant_id, id_type, id_value in cursor]
+            cursor.execute(sql_load_master_identifiers)
+            master_ids = {(tenant_id, id_type, id_value): master_profile_id
+                          for tenant_id, id_type, id_value, master_profile_id in cursor}
+            cursor.execute(sql_match_by_profile_columns, (unmatched_ords(claimed, identifiers, master_ids),))
+            column_matches = dict(cursor.fetchall())
+            loaded = time.perf_counter()
+
+            rows = resolve_batch(claimed, identifiers, master_ids, column_matches)
+            resolved = time.perf_counter()
+
+            cursor.execute(sql_create_assignments)
+            _copy_assignments(cursor, rows)
+            cursor.execute(sql_apply_assignments)
+            cursor.execute(sql_apply_batch)
+        conn.commit()
+    except psycopg2.Error:
+        # The claim is rolled back with the batch: its raw profiles are back to status_code = 1
+        conn.rollback()
+        raise
+
+    logger.info(f"Resolved {claimed} raw profiles ({len(master_ids)} known identifiers): "
+                f"load {loaded - started:.3f}s, resolve {resolved - loaded:.3f}s, "
+                f"write {time.perf_counter() - resolved:.3f}s")
+    return claimed
+
+
+def resolve_window(conn, from_dt: datetime, to_dt: datetime, batch_size: int = WORKER_BATCH_SIZE, max_batches: int = 0) -> int:
+    """Resolve the raw profiles received in [from_dt, to_dt] batch by batch, until none is left (or max_batches)."""
+    total = batches = 0
+    while not max_batches or batches < max_batches:
+        processed = process_batch(conn, batch_size, from_dt, to_dt)
+        if processed == 0:
+            break
+        total += processed
+        batches += 1
+    return total
+
+
+def _run_worker(worker_no: int, batch_size: int, max_batches: int) -> int:
+    from main import get_db_connection
+
+    conn = get_db_connection()
+    try:
+        total = resolve_window(conn, None, None, batch_size, max_batches)
+        logger.info(f"Worker {worker_no} done: {total} raw profiles")
+        return total
+    finally:
+        conn.close()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(processName)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Resolve the pending raw profiles with parallel worker processes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--batch-size", type=int, default=WORKER_BATCH_SIZE)
+    parser.add_argument("--max-batches", type=int, default=0, help="per worker, 0 = until no raw profile is left")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        totals = list(pool.map(_run_worker, range(args.workers),
+                               [args.batch_size] * args.workers, [args.max_batches] * args.workers))
+    elapsed = time.perf_counter() - started
+    total = sum(totals)
+    logger.info(f"{total} raw profiles resolved by {args.workers} workers in {elapsed:.1f}s "
+                f"({total / elapsed if elapsed else 0:.0f} profiles/s)")
+
+
+if __name__ == "__main__":
+    main()
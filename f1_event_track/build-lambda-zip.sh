@@ -19,8 +19,17 @@ zip -r9 ../$ZIP_NAME . > /dev/null
 # Step back to project root
 cd ..
 
-# Add main.py and processor.py
-echo "➕ Adding main.py to the zip..."
+# Add main.py, db_utils.py, persona_cache.py, persona_snapshot.py, event_schema.py, metrics.py and dedup.py
+echo "➕ Adding main.py, db_utils.py, persona_cache.py, persona_snapshot.py, event_schema.py, metrics.py and dedup.py to the zip..."
 zip -g $ZIP_NAME main.py > /dev/null
+zip -g $ZIP_NAME db_utils.py > /dev/null
+zip -g $ZIP_NAME persona_cache.py > /dev/null
+zip -g $ZIP_NAME persona_snapshot.py > /dev/null
+zip -g $ZIP_NAME event_schema.py > /dev/null
+zip -g $ZIP_NAME metrics.py > /dev/null
+zip -g $ZIP_NAME dedup.py > /dev/null
+
+# Add the tracking event schema shared with f0_setup_and_synch
+zip -gj $ZIP_NAME ../f0_setup_and_synch/event_tracking_json_validation.json > /dev/null
 
 echo "✅ Package built: $ZIP_NAME"
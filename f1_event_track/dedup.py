@@ -0,0 +1,123 @@
+import hashlib
+import json
+import math
+import threading
+import time
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter sized for capacity items at false positive rate error_rate."""
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, digest: bytes):
+        # Double hashing: k positions from two 64-bit halves of one digest
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:16], "little") | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def contains(self, digest: bytes) -> bool:
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(digest))
+
+    def add(self, digest: bytes):
+        bits = self.bits
+        for p in self._positions(digest):
+            bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+
+class DuplicateFilter:
+    """
+    Time- and memory-bounded duplicate detector built on two rotating Bloom filters.
+
+    Keys go into the current filter; lookups check the current and the previous one. The current
+    filter is rotated every window_seconds or once it holds capacity keys, so a key is remembered for
+    at least one window (unless capacity is reached first) and memory stays at two filters. A key can be
+    reported as seen when it was not with probability about error_rate.
+
+    Bloom filters cannot remove a key: forget() keeps the digest aside instead, and the key is reported
+    as unseen until it is added again.
+    """
+
+    def __init__(self, capacity: int = 100000, error_rate: float = 0.001, window_seconds: float = 300):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.window_seconds = window_seconds
+        self._lock = threading.Lock()
+        self._current = BloomFilter(capacity, error_rate)
+        self._previous = None
+        self._rotated_at = time.monotonic()
+        self._forgotten = set()
+
+    @staticmethod
+    def digest(key: str) -> bytes:
+        return hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+
+    def _rotate_if_needed(self):
+        now = time.monotonic()
+        if now - self._rotated_at >= self.window_seconds or self._current.count >= self.capacity:
+            # After two windows without rotation, the previous filter is too old to keep as well
+            self._previous = self._current if now - self._rotated_at < 2 * self.window_seconds else None
+            self._current = BloomFilter(self.capacity, self.error_rate)
+            self._rotated_at = now
+            # Digests rotated out of both filters do not need to be kept aside any more
+            self._forgotten = {d for d in self._forgotten if self._in_filters(d)}
+
+    def _in_filters(self, digest: bytes) -> bool:
+        return self._current.contains(digest) or (self._previous is not None and self._previous.contains(digest))
+
+    def contains(self, key: str) -> bool:
+        """Return True if key was (probably) added in the window and not forgotten since."""
+        digest = self.digest(key)
+        with self._lock:
+            self._rotate_if_needed()
+            return digest not in self._forgotten and self._in_filters(digest)
+
+    def add(self, keys):
+        """Remember keys, e.g. once their events are queued for delivery."""
+        digests = [self.digest(key) for key in keys]
+        with self._lock:
+            self._rotate_if_needed()
+            for digest in digests:
+                self._forgotten.discard(digest)
+                self._current.add(digest)
+
+    def forget(self, keys):
+        """Report keys as unseen again, e.g. after a delivery failure, so client retries are not suppressed."""
+        digests = [self.digest(key) for key in keys]
+        with self._lock:
+            self._forgotten.update(digests)
+            if len(self._forgotten) > self.capacity:
+                # Too many to keep aside: forget every key instead
+                self._reset()
+
+    def reset(self):
+        """Forget every key."""
+        with self._lock:
+            self._reset()
+
+    def _reset(self):
+        self._current = BloomFilter(self.capacity, self.error_rate)
+        self._previous = None
+        self._rotated_at = time.monotonic()
+        self._forgotten = set()
+
+    @property
+    def bytes_used(self) -> int:
+        return len(self._current.bits) + (len(self._previous.bits) if self._previous is not None else 0)
+
+
+def event_dedup_key(event: dict) -> str:
+    """event_id when the client sends one, otherwise a hash of the whole event content."""
+    event_id = event.get("event_id")
+    if event_id:
+        return f"{event.get('tenant_id')}:id:{event_id}"
+    content = json.dumps(event, sort_keys=True, separators=(",", ":"), default=str)
+    return f"{event.get('tenant_id')}:hash:{hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()}"
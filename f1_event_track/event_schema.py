@@ -0,0 +1,67 @@
+import copy
+import json
+import logging
+import os
+
+import fastjsonschema
+
+logger = logging.getLogger()
+
+SCHEMA_FILE_NAME = "event_tracking_json_validation.json"
+
+# Look next to this module first (Lambda package), then in the repo's f0_setup_and_synch folder
+SCHEMA_SEARCH_PATHS = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), SCHEMA_FILE_NAME),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "f0_setup_and_synch", SCHEMA_FILE_NAME),
+]
+
+# Formats used by the tracking schema that draft-04 does not define
+CUSTOM_FORMATS = {
+    "uuid": r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$",
+}
+
+
+def load_event_schema(path: str = None) -> dict:
+    """Load the TrackEventModel JSON schema from EVENT_SCHEMA_PATH or the default locations."""
+    candidates = [path or os.environ.get("EVENT_SCHEMA_PATH")] + SCHEMA_SEARCH_PATHS
+    for candidate in candidates:
+        if candidate and os.path.exists(candidate):
+            with open(candidate, "r", encoding="utf-8") as f:
+                return json.load(f)
+    raise FileNotFoundError(f"Event schema {SCHEMA_FILE_NAME} not found in {candidates}")
+
+
+def with_tracking_constraints(schema: dict) -> dict:
+    """
+    Add the constraints F1 relies on to the shared schema: visid, tenant_id and metric are required
+    strings, visid and tenant_id fit in the VARCHAR(36) columns, metric is shorter than 50 chars.
+    """
+    schema = copy.deepcopy(schema)
+    schema["required"] = sorted(set(schema.get("required", [])) | {"visid", "tenant_id", "metric"})
+    properties = schema.setdefault("properties", {})
+    for field, max_length in (("visid", 36), ("tenant_id", 36), ("metric", 49)):
+        field_schema = properties.setdefault(field, {})
+        field_schema["type"] = "string"
+        field_schema["minLength"] = 1
+        field_schema["maxLength"] = max_length
+    return schema
+
+
+def compile_event_validator(schema: dict):
+    """
+    Compile the schema once into generated Python code. The returned function takes a decoded event
+    and returns a list of {"field", "reason"} errors, empty when the event is valid.
+    """
+    validate = fastjsonschema.compile(schema, formats=CUSTOM_FORMATS)
+
+    def validate_event(event) -> list:
+        try:
+            validate(event)
+            return []
+        except fastjsonschema.JsonSchemaValueException as e:
+            # The generated validator stops at the first failing rule
+            field = ".".join(str(p) for p in e.path[1:]) or "$"
+            reason = e.message.split(" ", 1)[1] if e.message.startswith(e.name + " ") else e.message
+            return [{"field": field, "reason": reason}]
+
+    return validate_event
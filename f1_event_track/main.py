@@ -1,6 +1,10 @@
+import contextvars
 import json
 import os
-import sqlite3
+import random
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
 import logging
 
@@ -8,8 +12,20 @@ import logging
 import boto3
 import psycopg2
 
+# Optional fast JSON parser, falls back to the standard library
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 # Custom utility for fetching DB credentials
 import db_utils
+import metrics
+from dedup import DuplicateFilter, event_dedup_key
+from event_schema import compile_event_validator, load_event_schema, with_tracking_constraints
+from persona_cache import PersonaProfileCache, PersonaProfileLoader, decode_persona_profiles
+from persona_snapshot import PersonaSnapshot, as_utc, fetch_snapshot
 
 # =====================================
 # Global Scope - runs on cold start only
@@ -18,140 +34,709 @@ import db_utils
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# Setup in-memory SQLite DB as a fast cache
-try:
-    sqlite_conn = sqlite3.connect(":memory:", check_same_thread=False)
-    sqlite_conn.row_factory = sqlite3.Row
-    sqlite_cursor = sqlite_conn.cursor()
-
-    # Create table to cache persona_profiles
-    sqlite_cursor.execute("""
-        CREATE TABLE IF NOT EXISTS persona_profiles_cache (
-            key TEXT PRIMARY KEY,
-            persona_profiles TEXT,
-            cached_at DATETIME NOT NULL
-        )
-    """)
-    sqlite_cursor.execute("CREATE INDEX IF NOT EXISTS idx_key ON persona_profiles_cache(key)")
-    sqlite_conn.commit()
-    logger.info("✅ In-memory SQLite cache initialized successfully.")
-except Exception as e:
-    logger.error(f"❌ CRITICAL: Failed to initialize SQLite in-memory cache: {e}")
-    sqlite_conn = None
+# Memory budget of the in-process persona cache, least recently used visitors are evicted past it
+PERSONA_CACHE_MAX_BYTES = int(os.environ.get("PERSONA_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+# Visitors without persona are cached as negative entries for this long
+PERSONA_CACHE_NEGATIVE_TTL_SECONDS = int(os.environ.get("PERSONA_CACHE_NEGATIVE_TTL_SECONDS", "300"))
+
+# Read-through lookup of cache misses in PostgreSQL
+PERSONA_LOOKUP_ENABLED = os.environ.get("PERSONA_LOOKUP_ENABLED", "true").lower() == "true"
+PERSONA_LOOKUP_MAX_PER_SECOND = float(os.environ.get("PERSONA_LOOKUP_MAX_PER_SECOND", "50"))
+PERSONA_LOOKUP_BATCH_WINDOW_MS = float(os.environ.get("PERSONA_LOOKUP_BATCH_WINDOW_MS", "0"))
+PERSONA_LOOKUP_MAX_BATCH_SIZE = int(os.environ.get("PERSONA_LOOKUP_MAX_BATCH_SIZE", "100"))
+
+def create_persona_cache() -> PersonaProfileCache:
+    return PersonaProfileCache(PERSONA_CACHE_MAX_BYTES, PERSONA_CACHE_NEGATIVE_TTL_SECONDS)
+
+# In-process persona cache keyed by (tenant_id, visitor_id); a full reload swaps in a new instance
+persona_cache = create_persona_cache()
+logger.info(f"✅ In-memory persona cache initialized with a budget of {PERSONA_CACHE_MAX_BYTES} bytes.")
 
 # Cache expiry control
 CACHE_EXPIRY_TIME = None
 CACHE_TTL_SECONDS = 300  # 5 minutes
+CACHE_WINDOW_DAYS = 7  # only visitors updated in the last 7 days are cached
+
+# Cache refresh mode: 'delta' pulls only rows changed since CACHE_WATERMARK, 'full' reloads the whole window
+CACHE_REFRESH_MODE = os.environ.get("CACHE_REFRESH_MODE", "delta").lower()
+# In delta mode, force a full reload every N refreshes to drop rows hard-deleted in PostgreSQL (0 = never)
+CACHE_FULL_RELOAD_EVERY = int(os.environ.get("CACHE_FULL_RELOAD_EVERY", "12"))
+# Re-read a small overlap behind the watermark, so rows committed late with an older updated_at are not missed
+CACHE_DELTA_OVERLAP_SECONDS = int(os.environ.get("CACHE_DELTA_OVERLAP_SECONDS", "30"))
+
+# Highest cdp_persona_profiles.updated_at seen so far, None until the first full load
+CACHE_WATERMARK = None
+CACHE_DELTA_REFRESH_COUNT = 0
+
+# Refresh strategy: 'inline' refreshes on the request that hits expiry,
+# 'background' keeps serving the current cache while a worker thread rebuilds it (stale-while-revalidate)
+CACHE_REFRESH_STRATEGY = os.environ.get("CACHE_REFRESH_STRATEGY", "inline").lower()
+# Upper bound on cache age: past it, the request waits for the refresh instead of serving stale data
+CACHE_MAX_STALENESS_SECONDS = int(os.environ.get("CACHE_MAX_STALENESS_SECONDS", "900"))
+# After a failed background refresh, wait this long before the next attempt
+CACHE_REFRESH_RETRY_SECONDS = int(os.environ.get("CACHE_REFRESH_RETRY_SECONDS", "30"))
+
+CACHE_REFRESH_THREAD = None
+CACHE_REFRESH_THREAD_LOCK = threading.Lock()
+
+# Rows fetched per round trip from the server-side cursor of the cache load
+CACHE_LOAD_CHUNK_SIZE = int(os.environ.get("CACHE_LOAD_CHUNK_SIZE", "5000"))
+
+# Random extra delay added to every expiry, so containers started together do not refresh together
+CACHE_TTL_JITTER_SECONDS = int(os.environ.get("CACHE_TTL_JITTER_SECONDS", "60"))
+# 'advisory_lock': one container at a time runs the delta query and publishes its watermark in
+# cdp_persona_cache_state (sql-scripts/13_persona_cache_state_table.sql), 'none': every container queries
+CACHE_REFRESH_COORDINATION = os.environ.get("CACHE_REFRESH_COORDINATION", "none").lower()
+CACHE_STATE_NAME = "f1_persona_cache"
+CACHE_REFRESH_LOCK_NAME = "f1_persona_cache_refresh"
+CACHE_FULL_RELOAD_LOCK_NAME = "f1_persona_cache_full_reload"
+# A Lambda container frozen in the middle of a background refresh keeps its transaction, and so the advisory
+# lock, open: PostgreSQL ends such an idle session after this long, and lock waits give up after the lock timeout
+CACHE_REFRESH_IDLE_TIMEOUT_SECONDS = int(os.environ.get("CACHE_REFRESH_IDLE_TIMEOUT_SECONDS", "60"))
+CACHE_REFRESH_LOCK_TIMEOUT_SECONDS = int(os.environ.get("CACHE_REFRESH_LOCK_TIMEOUT_SECONDS", "5"))
+# A follower runs the delta itself and publishes it when the shared state is older than this many TTLs
+CACHE_LEADER_TAKEOVER_TTLS = int(os.environ.get("CACHE_LEADER_TAKEOVER_TTLS", "2"))
+
+# Secrets Manager credentials are cached per container instead of being fetched on every refresh
+DB_CREDENTIALS_TTL_SECONDS = int(os.environ.get("DB_CREDENTIALS_TTL_SECONDS", "3600"))
+DB_CREDENTIALS = None
+DB_CREDENTIALS_EXPIRY = 0.0
+
+# Refresh metrics, logged after every refresh and exposed via get_cache_metrics()
+CACHE_METRICS = {
+    "refresh_count": 0,
+    "refresh_skipped": 0,
+    "refresh_failures": 0,
+    "last_refresh_duration_ms": None,
+    "last_refresh_at": None,
+}
+
+# Optional persona snapshot built offline by persona_snapshot.py (local path, file:// or s3:// URI).
+# It is memory-mapped at cold start, so only the rows changed since its watermark are fetched from PostgreSQL.
+PERSONA_SNAPSHOT_URI = os.environ.get("PERSONA_SNAPSHOT_URI", "")
+# Past this many visitors changed since the snapshot watermark, the snapshot is dropped and the cache fully reloaded
+PERSONA_SNAPSHOT_MAX_STALE_KEYS = int(os.environ.get("PERSONA_SNAPSHOT_MAX_STALE_KEYS", "100000"))
+
+persona_snapshot = None
+# Visitors changed since the snapshot watermark, the snapshot must not answer for them any more
+persona_snapshot_stale_keys = set()
 
 def get_datetime_now():
     return datetime.now(timezone.utc)
 
-def refresh_profiles_cache_from_pgsql():
-    """Load data from PostgreSQL and refresh the in-memory cache."""
-    global CACHE_EXPIRY_TIME
+def load_persona_snapshot(uri: str):
+    """Map the persona snapshot and start the delta watermark from it. Returns False if it cannot be used."""
+    global persona_snapshot, CACHE_WATERMARK
+    try:
+        snapshot = PersonaSnapshot(fetch_snapshot(uri))
+    except Exception as e:
+        logger.error(f"❌ Persona snapshot {uri} not loaded, falling back to a full load: {e}")
+        return False
+    persona_snapshot = snapshot
+    persona_snapshot_stale_keys.clear()
+    CACHE_WATERMARK = snapshot.watermark
+    logger.info(f"✅ Persona snapshot mapped: {len(snapshot)} visitors, watermark {snapshot.watermark.isoformat()}")
+    return True
+
+def retire_persona_snapshot():
+    """
+    Stop answering from the snapshot once too many visitors changed since it was built, so the stale
+    key set stays bounded. The next refresh is a full reload, due right away.
+    """
+    global persona_snapshot, CACHE_WATERMARK, CACHE_EXPIRY_TIME
+    stale_keys = len(persona_snapshot_stale_keys)
+    # Not closed here: a request may still be reading it, the mapping is released with the last reference
+    persona_snapshot = None
+    persona_snapshot_stale_keys.clear()
+    CACHE_WATERMARK = None
+    CACHE_EXPIRY_TIME = get_datetime_now()
+    logger.warning(f"Persona snapshot dropped: {stale_keys} visitors changed since it was built, full reload next")
+
+def _apply_profiles_to_cache(rows, full_reload: bool) -> tuple:
+    """
+    Write rows of (tenant_id, visitor_id, persona_profiles, updated_at) into the persona cache.
+    Returns (upserted, removed, max_updated_at).
+    """
+    global persona_cache
+
+    # A full reload fills a replacement cache off to the side, readers keep using the current one until the swap
+    target_cache = create_persona_cache() if full_reload else persona_cache
+    upserted = removed = 0
+    max_updated_at = None
+
+    for tenant_id, visitor_id, profiles, updated_at in rows:
+        if updated_at is not None:
+            updated_at = as_utc(updated_at)
+            if max_updated_at is None or updated_at > max_updated_at:
+                max_updated_at = updated_at
+
+        # A NULL or empty persona_profiles is a tombstone, cached as a known miss
+        profiles = decode_persona_profiles(profiles)
+        target_cache.put(tenant_id, visitor_id, profiles)
+        if persona_snapshot is not None:
+            persona_snapshot_stale_keys.add((tenant_id, visitor_id))
+        if profiles:
+            upserted += 1
+        else:
+            removed += 1
+
+    if full_reload:
+        persona_cache = target_cache
+    return upserted, removed, max_updated_at
+
+def get_db_credentials(force: bool = False) -> dict:
+    """Secrets Manager credentials, cached per container for DB_CREDENTIALS_TTL_SECONDS."""
+    global DB_CREDENTIALS, DB_CREDENTIALS_EXPIRY
+    now = time.monotonic()
+    if force or DB_CREDENTIALS is None or now > DB_CREDENTIALS_EXPIRY:
+        DB_CREDENTIALS = db_utils.get_db_credentials()
+        DB_CREDENTIALS_EXPIRY = now + DB_CREDENTIALS_TTL_SECONDS
+    return DB_CREDENTIALS
+
+def connect_to_pgsql():
+    """Open a new PostgreSQL connection, re-reading the secret once if the cached credentials are rejected."""
+    for attempt in range(2):
+        db_credentials = get_db_credentials(force=attempt > 0)
+        try:
+            return psycopg2.connect(
+                dbname=db_credentials["DB_NAME"],
+                user=db_credentials["DB_USER"],
+                password=db_credentials["DB_PASS"],
+                host=db_credentials["DB_HOST"],
+                port=int(db_credentials.get("DB_PORT", 5432)),
+                connect_timeout=5
+            )
+        except psycopg2.OperationalError:
+            # The secret may have been rotated since it was cached
+            if attempt > 0:
+                raise
+
+def _coordinate_delta_refresh(cur):
+    """
+    Decide how this container runs its delta refresh, inside the refresh transaction.
+
+    Returns ("lead", None) when this container takes the advisory lock and the shared state is older
+    than CACHE_TTL_SECONDS, or when the state is older than CACHE_LEADER_TAKEOVER_TTLS TTLs (the lock
+    holder is stuck, e.g. frozen with the lock): it runs the delta and publishes its watermark.
+    Otherwise returns ("follow", published_watermark): the caller reads at most up to the published
+    watermark, or skips the query when it is not past its own.
+    """
+    cur.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s))", (CACHE_REFRESH_LOCK_NAME,))
+    (is_leader,) = cur.fetchone()
+    cur.execute("""
+        SELECT watermark,
+               refreshed_at < NOW() - make_interval(secs => %s),
+               refreshed_at < NOW() - make_interval(secs => %s)
+        FROM cdp_persona_cache_state
+        WHERE cache_name = %s
+    """, (CACHE_TTL_SECONDS, CACHE_TTL_SECONDS * CACHE_LEADER_TAKEOVER_TTLS, CACHE_STATE_NAME))
+    state = cur.fetchone()
+    published_watermark, state_expired, leader_stuck = state if state else (None, True, True)
+    if (is_leader and state_expired) or leader_stuck:
+        if not is_leader:
+            logger.warning("Persona cache state not published for "
+                           f"{CACHE_LEADER_TAKEOVER_TTLS} TTLs, refreshing without the advisory lock")
+        return "lead", None
+    return "follow", as_utc(published_watermark) if published_watermark is not None else None
+
+def _publish_cache_watermark(cur, watermark: datetime):
+    cur.execute("""
+        INSERT INTO cdp_persona_cache_state (cache_name, watermark, refreshed_at)
+        VALUES (%s, %s, NOW())
+        ON CONFLICT (cache_name) DO UPDATE
+        SET watermark = GREATEST(cdp_persona_cache_state.watermark, EXCLUDED.watermark),
+            refreshed_at = NOW()
+    """, (CACHE_STATE_NAME, watermark))
+
+def _stream_persona_rows(pg_conn, since: datetime, until: datetime = None):
+    """
+    Yield (tenant_id, visitor_id, persona_profiles, updated_at) rows changed in [since, until] through a
+    named server-side cursor, CACHE_LOAD_CHUNK_SIZE rows per round trip, so only one chunk is held in memory.
+    The cursor lives in the refresh transaction and is closed when the generator is exhausted.
+    """
+    query = """
+        SELECT tenant_id, visitor_id, persona_profiles, updated_at
+        FROM cdp_persona_profiles
+        WHERE updated_at >= %s {until_filter}
+        ORDER BY updated_at
+    """
+    params = [since.isoformat()]
+    if until is not None:
+        params.append(until.isoformat())
+    with pg_conn.cursor(name="persona_cache_load") as cur:
+        cur.itersize = CACHE_LOAD_CHUNK_SIZE
+        cur.execute(query.format(until_filter="AND updated_at <= %s" if until is not None else ""), params)
+        while True:
+            chunk = cur.fetchmany(CACHE_LOAD_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield from chunk
+
+def _next_cache_expiry_time(seconds: int) -> datetime:
+    # Jitter spreads the refreshes of containers started together
+    return get_datetime_now() + timedelta(seconds=seconds + random.uniform(0, CACHE_TTL_JITTER_SECONDS))
+
+def refresh_profiles_cache_from_pgsql(force_full: bool = False):
+    """
+    Load data from PostgreSQL and refresh the in-memory cache.
+
+    The first call (or force_full) reloads the whole window. In 'delta' mode, later calls only pull
+    rows whose updated_at moved past CACHE_WATERMARK, so each refresh costs proportional to churn.
+    Visitors outside the window are not preloaded, they are looked up on demand by persona_loader.
+
+    With CACHE_REFRESH_COORDINATION=advisory_lock, one container at a time runs the delta query and
+    publishes its watermark in cdp_persona_cache_state; the others skip the query when nothing newer
+    was published, or read a delta bounded by the published watermark. Periodic full reloads are
+    also taken by one container at a time.
+    """
+    global CACHE_EXPIRY_TIME, CACHE_WATERMARK, CACHE_DELTA_REFRESH_COUNT
     pg_conn = None
+    started = time.perf_counter()
+    coordinated = CACHE_REFRESH_COORDINATION == "advisory_lock"
 
-    try:
-        # Load credentials via secure helper
-        db_credentials = db_utils.get_db_credentials()
-        pg_conn = psycopg2.connect(
-            dbname=db_credentials["DB_NAME"],
-            user=db_credentials["DB_USER"],
-            password=db_credentials["DB_PASS"],
-            host=db_credentials["DB_HOST"],
-            port=int(db_credentials.get("DB_PORT", 5432)),
-            connect_timeout=5
-        )
+    cutoff = get_datetime_now() - timedelta(days=CACHE_WINDOW_DAYS)
+    full_reload = force_full or CACHE_REFRESH_MODE != "delta" or CACHE_WATERMARK is None
+    # With a snapshot, hard deletes are dropped when the next snapshot is built instead
+    periodic_full_reload = (
+        not full_reload and persona_snapshot is None
+        and CACHE_FULL_RELOAD_EVERY > 0 and CACHE_DELTA_REFRESH_COUNT >= CACHE_FULL_RELOAD_EVERY
+    )
 
-        cutoff_date = (get_datetime_now() - timedelta(days=7)).isoformat()
+    try:
+        pg_conn = connect_to_pgsql()
 
         with pg_conn.cursor() as cur:
-            cur.execute("""
-                SELECT tenant_id, visitor_id, persona_profiles
-                FROM cdp_persona_profiles
-                WHERE updated_at >= %s
-            """, (cutoff_date,))
-            rows = cur.fetchall()
-
-        # Refresh cache in SQLite
-        sqlite_cursor.execute("DELETE FROM persona_profiles_cache")
-        profiles_to_insert = []
-        for tenant_id, visitor_id, profiles in rows:
-            key = f"{tenant_id}:{visitor_id}"
-            profiles_json = json.dumps(profiles) if not isinstance(profiles, str) else profiles
-            profiles_to_insert.append((key, profiles_json, get_datetime_now()))
-
-        sqlite_cursor.executemany("""
-            INSERT INTO persona_profiles_cache (key, persona_profiles, cached_at)
-            VALUES (?, ?, ?)
-        """, profiles_to_insert)
-        sqlite_conn.commit()
-
-        CACHE_EXPIRY_TIME = get_datetime_now() + timedelta(seconds=CACHE_TTL_SECONDS)
-        logger.info(f"✅ Cache refreshed. Loaded {len(rows)} profiles. Expires at {CACHE_EXPIRY_TIME.isoformat()}Z")
-
-    except (psycopg2.Error, KeyError) as e:
-        logger.error(f"❌ PostgreSQL error: {e}")
+            if coordinated:
+                # Session settings: the connection is closed after the refresh
+                cur.execute("SELECT set_config('idle_in_transaction_session_timeout', %s, false), "
+                            "set_config('lock_timeout', %s, false)",
+                            (f"{CACHE_REFRESH_IDLE_TIMEOUT_SECONDS}s", f"{CACHE_REFRESH_LOCK_TIMEOUT_SECONDS}s"))
+            if periodic_full_reload:
+                if coordinated:
+                    # Containers that do not get the lock keep running deltas and try again next time
+                    cur.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s))", (CACHE_FULL_RELOAD_LOCK_NAME,))
+                    (full_reload,) = cur.fetchone()
+                else:
+                    full_reload = True
+
+            role, until = ("lead", None) if full_reload or not coordinated else _coordinate_delta_refresh(cur)
+
+            if full_reload:
+                since = cutoff
+            elif persona_snapshot is not None:
+                # Everything the snapshot may hold stale has to be caught up, even beyond the cache window
+                since = CACHE_WATERMARK - timedelta(seconds=CACHE_DELTA_OVERLAP_SECONDS)
+            else:
+                since = max(CACHE_WATERMARK - timedelta(seconds=CACHE_DELTA_OVERLAP_SECONDS), cutoff)
+
+            if role == "follow" and (until is None or until <= CACHE_WATERMARK):
+                # Nothing was published past what this container already has
+                rows = ()
+                role = "skip"
+            else:
+                rows = _stream_persona_rows(pg_conn, since, until)
+
+            # Rows stream chunk by chunk into the cache, in updated_at order so the most recent visitors survive eviction
+            upserted, deleted, max_updated_at = _apply_profiles_to_cache(rows, full_reload)
+
+            if max_updated_at is not None and (CACHE_WATERMARK is None or max_updated_at > CACHE_WATERMARK):
+                CACHE_WATERMARK = max_updated_at
+            elif CACHE_WATERMARK is None:
+                CACHE_WATERMARK = cutoff
+            if until is not None and until > CACHE_WATERMARK:
+                CACHE_WATERMARK = until
+
+            if coordinated and role == "lead" and not full_reload:
+                _publish_cache_watermark(cur, CACHE_WATERMARK)
+        # Commit ends the transaction and releases the advisory locks
+        pg_conn.commit()
+
+        CACHE_DELTA_REFRESH_COUNT = 0 if full_reload else CACHE_DELTA_REFRESH_COUNT + 1
+        CACHE_EXPIRY_TIME = _next_cache_expiry_time(CACHE_TTL_SECONDS)
+        refresh_kind = "Full reload" if full_reload else f"Delta refresh ({role})" if coordinated else "Delta refresh"
+        logger.info(f"✅ Cache refreshed. {refresh_kind}: upserted {upserted}, removed {deleted} profiles. "
+                    f"Watermark {CACHE_WATERMARK.isoformat()}. Expires at {CACHE_EXPIRY_TIME.isoformat()}Z")
+
+        CACHE_METRICS["refresh_count"] += 1
+        if role == "skip":
+            CACHE_METRICS["refresh_skipped"] += 1
+        CACHE_METRICS["last_refresh_at"] = get_datetime_now()
+
+        if persona_snapshot is not None and len(persona_snapshot_stale_keys) > PERSONA_SNAPSHOT_MAX_STALE_KEYS:
+            retire_persona_snapshot()
+
+    except Exception as e:
+        # Secrets Manager errors (ClientError, ValueError) fail the refresh as well as PostgreSQL ones
+        CACHE_METRICS["refresh_failures"] += 1
+        logger.error(f"❌ Cache refresh error ({type(e).__name__}): {e}")
         raise
     finally:
+        CACHE_METRICS["last_refresh_duration_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        logger.info(json.dumps({"persona_cache_metrics": get_cache_metrics()}))
         if pg_conn:
             pg_conn.close()
 
+def get_cache_age_seconds():
+    """Seconds since the last successful refresh, None if the cache was never loaded."""
+    last_refresh_at = CACHE_METRICS["last_refresh_at"]
+    if last_refresh_at is None:
+        return None
+    return (get_datetime_now() - last_refresh_at).total_seconds()
+
+def get_cache_metrics() -> dict:
+    """Snapshot of the refresh metrics, JSON serializable."""
+    last_refresh_at = CACHE_METRICS["last_refresh_at"]
+    return {
+        "cache_entries": len(persona_cache),
+        "cache_bytes": persona_cache.bytes_used,
+        "cache_evictions": persona_cache.evictions,
+        "snapshot_entries": len(persona_snapshot) if persona_snapshot is not None else 0,
+        "snapshot_stale_keys": len(persona_snapshot_stale_keys),
+        "refresh_count": CACHE_METRICS["refresh_count"],
+        "refresh_skipped": CACHE_METRICS["refresh_skipped"],
+        "refresh_failures": CACHE_METRICS["refresh_failures"],
+        "last_refresh_duration_ms": CACHE_METRICS["last_refresh_duration_ms"],
+        "last_refresh_at": last_refresh_at.isoformat() if last_refresh_at else None,
+        "cache_age_seconds": get_cache_age_seconds(),
+        "refresh_in_progress": is_cache_refresh_running(),
+    }
+
+def is_cache_refresh_running() -> bool:
+    return CACHE_REFRESH_THREAD is not None and CACHE_REFRESH_THREAD.is_alive()
+
+def _background_refresh():
+    global CACHE_EXPIRY_TIME
+    try:
+        refresh_profiles_cache_from_pgsql()
+    except Exception as e:
+        # Keep serving the current cache, retry after a short pause instead of on every request
+        CACHE_EXPIRY_TIME = _next_cache_expiry_time(CACHE_REFRESH_RETRY_SECONDS)
+        logger.error(f"Background cache refresh failed: {e}")
+
+def start_background_refresh() -> bool:
+    """Start a background refresh unless one is already running. Returns True if a thread was started."""
+    global CACHE_REFRESH_THREAD
+    with CACHE_REFRESH_THREAD_LOCK:
+        if is_cache_refresh_running():
+            return False
+        CACHE_REFRESH_THREAD = threading.Thread(target=_background_refresh, name="persona-cache-refresh", daemon=True)
+        CACHE_REFRESH_THREAD.start()
+        return True
+
+def refresh_cache_if_stale():
+    """
+    Refresh the persona cache when CACHE_EXPIRY_TIME has passed.
+
+    With CACHE_REFRESH_STRATEGY=background the current cache keeps serving while a worker thread
+    rebuilds it; the request only waits when the cache is empty or older than CACHE_MAX_STALENESS_SECONDS.
+    """
+    if CACHE_EXPIRY_TIME is not None and get_datetime_now() <= CACHE_EXPIRY_TIME:
+        return
+
+    cache_age = get_cache_age_seconds()
+    if CACHE_REFRESH_STRATEGY == "background" and cache_age is not None and cache_age <= CACHE_MAX_STALENESS_SECONDS:
+        if start_background_refresh():
+            logger.info(f"Cache is stale ({cache_age:.0f}s old). Refreshing in background...")
+        return
+
+    logger.info("Cache is stale or uninitialized. Refreshing...")
+    if is_cache_refresh_running():
+        # A background refresh is already on the way, wait for it rather than running a second one
+        CACHE_REFRESH_THREAD.join()
+        if CACHE_EXPIRY_TIME is not None and get_datetime_now() <= CACHE_EXPIRY_TIME:
+            return
+    try:
+        refresh_profiles_cache_from_pgsql()
+    except Exception as e:
+        logger.error(f"Cache refresh failed: {e}")
+
+# Firehose PutRecordBatch limits
+FIREHOSE_MAX_BATCH_RECORDS = 500
+FIREHOSE_MAX_BATCH_BYTES = 4 * 1024 * 1024
+FIREHOSE_MAX_RECORD_BYTES = 1000 * 1024
+
+class InMemoryFirehose:
+    """Local stand-in for the Firehose client, keeps delivered records in memory (QUEUE_TYPE=memory)."""
+    def __init__(self, fail_first_n: int = 0):
+        self.records = []
+        self.batch_calls = 0
+        self.fail_first_n = fail_first_n  # fail this many entries first, to exercise partial-failure retries
+
+    def put_record_batch(self, DeliveryStreamName: str, Records: list) -> dict:
+        self.batch_calls += 1
+        responses = []
+        for record in Records:
+            if self.fail_first_n > 0:
+                self.fail_first_n -= 1
+                responses.append({"ErrorCode": "ServiceUnavailableException", "ErrorMessage": "Injected failure"})
+            else:
+                self.records.append(record["Data"])
+                responses.append({"RecordId": str(len(self.records))})
+        failed = sum(1 for r in responses if "ErrorCode" in r)
+        return {"FailedPutCount": failed, "RequestResponses": responses}
+
+# Keys of the events of the current request dropped by a flush, set by EventQueue.track_failures()
+_request_failures = contextvars.ContextVar("f1_request_failures", default=None)
+
 class EventQueue:
-    """Wrapper to send events to a downstream queue (e.g., Firehose)."""
-    def __init__(self):
+    """
+    Buffered sender of events to a downstream queue (e.g., Firehose).
+
+    Events are buffered in memory and delivered with put_record_batch once the buffer reaches
+    EVENT_QUEUE_BATCH_MAX_RECORDS / EVENT_QUEUE_BATCH_MAX_BYTES or the oldest event is older than
+    EVENT_QUEUE_BATCH_MAX_AGE_MS. Only the entries reported as failed are retried. When the buffer
+    holds EVENT_QUEUE_MAX_BUFFERED events, send() flushes inline before accepting more (backpressure).
+    The owner must call flush() when the invocation ends. A dropped event is reported to the request that
+    sent it, whichever flush dropped it (its own, another request's or the periodic flusher's): requests
+    run inside track_failures() and read their keys with take_request_failures(). Events sent outside of
+    a request are reported by take_failures(). on_dropped(keys), when set, is called for every drop.
+    """
+    def __init__(self, client=None):
         self.queue_type = os.environ.get("QUEUE_TYPE", "firehose").lower()
         if self.queue_type == "firehose":
             self.stream_name = os.environ.get("FIREHOSE_STREAM_NAME")
             if not self.stream_name:
                 raise ValueError("FIREHOSE_STREAM_NAME not set.")
-            self.client = boto3.client("firehose")
+            self.client = client or boto3.client("firehose")
+        elif self.queue_type == "memory":
+            self.stream_name = os.environ.get("FIREHOSE_STREAM_NAME", "in-memory")
+            self.client = client or InMemoryFirehose()
         else:
             raise ValueError(f"Unsupported QUEUE_TYPE: {self.queue_type}")
 
-    def send(self, event: dict) -> dict:
-        """Send an event to Firehose."""
-        data = json.dumps(event).encode("utf-8")
-        return self.client.put_record(
-            DeliveryStreamName=self.stream_name,
-            Record={"Data": data}
+        self.batch_max_records = min(int(os.environ.get("EVENT_QUEUE_BATCH_MAX_RECORDS", "500")), FIREHOSE_MAX_BATCH_RECORDS)
+        self.batch_max_bytes = min(int(os.environ.get("EVENT_QUEUE_BATCH_MAX_BYTES", str(FIREHOSE_MAX_BATCH_BYTES))), FIREHOSE_MAX_BATCH_BYTES)
+        self.batch_max_age_seconds = int(os.environ.get("EVENT_QUEUE_BATCH_MAX_AGE_MS", "1000")) / 1000
+        self.max_buffered = int(os.environ.get("EVENT_QUEUE_MAX_BUFFERED", "10000"))
+        self.max_retries = int(os.environ.get("EVENT_QUEUE_MAX_RETRIES", "3"))
+
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._oldest_at = None
+        self._failed_keys = []
+        self.on_dropped = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def send(self, event: dict, key=None):
+        """Buffer an event for delivery, flushing when a batch is full or too old."""
+        self.send_batch([event], [key])
+
+    def send_batch(self, events: list, keys: list = None):
+        """Buffer several events for delivery in one operation. keys identify the events in the failure reports."""
+        # Each record carries the failure list of the request that sent it
+        failures = _request_failures.get()
+        records = []
+        for event, key in zip(events, keys or [None] * len(events)):
+            data = json.dumps(event).encode("utf-8")
+            if len(data) > FIREHOSE_MAX_RECORD_BYTES:
+                raise ValueError(f"Event of {len(data)} bytes exceeds the Firehose record limit")
+            records.append((data, key, failures))
+
+        for record in records:
+            if len(self._buffer) >= self.max_buffered:
+                # Backpressure: the caller pays for delivery before the buffer grows further
+                self.flush()
+            with self._lock:
+                if self._oldest_at is None:
+                    self._oldest_at = time.monotonic()
+                self._buffer.append(record)
+                self._buffer_bytes += len(record[0])
+
+        if self._should_flush():
+            self.flush()
+
+    def _should_flush(self) -> bool:
+        return (
+            len(self._buffer) >= self.batch_max_records
+            or self._buffer_bytes >= self.batch_max_bytes
+            or (self._oldest_at is not None and time.monotonic() - self._oldest_at >= self.batch_max_age_seconds)
         )
 
+    def pending_count(self) -> int:
+        return len(self._buffer)
+
+    def flush(self) -> int:
+        """Deliver every buffered event. Returns the number of events that could not be delivered."""
+        with self._flush_lock:
+            with self._lock:
+                records, self._buffer = self._buffer, []
+                self._buffer_bytes = 0
+                self._oldest_at = None
+
+            failed = []
+            for batch in self._split_batches(records):
+                failed.extend(self._put_batch_with_retries(batch))
+            if failed:
+                with self._lock:
+                    for _, key, failures in failed:
+                        (self._failed_keys if failures is None else failures).append(key)
+                if self.on_dropped is not None:
+                    self.on_dropped([key for _, key, _ in failed if key is not None])
+            return len(failed)
+
+    @contextmanager
+    def track_failures(self):
+        """Scope of one request: the events it sends are reported to it by take_request_failures()."""
+        token = _request_failures.set([])
+        try:
+            yield
+        finally:
+            _request_failures.reset(token)
+
+    def take_request_failures(self) -> list:
+        """Keys of the events of the current request dropped since the last call (None for events sent without a key)."""
+        failures = _request_failures.get()
+        if failures is None:
+            return []
+        with self._lock:
+            failed_keys = failures[:]
+            del failures[:]
+        return failed_keys
+
+    def take_failures(self) -> list:
+        """Keys of the events sent outside of track_failures() dropped by any flush since the last call."""
+        with self._lock:
+            failed_keys, self._failed_keys = self._failed_keys, []
+        return failed_keys
+
+    def _split_batches(self, records: list):
+        batch, batch_bytes = [], 0
+        for record in records:
+            size = len(record[0])
+            if batch and (len(batch) >= self.batch_max_records or batch_bytes + size > self.batch_max_bytes):
+                yield batch
+                batch, batch_bytes = [], 0
+            batch.append(record)
+            batch_bytes += size
+        if batch:
+            yield batch
+
+    def _put_batch_with_retries(self, batch: list) -> list:
+        """Deliver (data, key, failures) records, retrying the failed entries. Returns the records that were dropped."""
+        pending = batch
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                time.sleep(min(0.05 * (2 ** (attempt - 1)), 1.0))
+            try:
+                response = self.client.put_record_batch(
+                    DeliveryStreamName=self.stream_name,
+                    Records=[{"Data": record[0]} for record in pending]
+                )
+            except Exception as e:
+                logger.warning(f"put_record_batch failed for {len(pending)} records (attempt {attempt + 1}): {e}")
+                continue
+
+            if response.get("FailedPutCount", 0) == 0:
+                return []
+            # Retry only the entries Firehose reported as failed
+            pending = [
+                record for record, result in zip(pending, response["RequestResponses"])
+                if "ErrorCode" in result
+            ]
+            logger.warning(f"put_record_batch: {len(pending)} records failed (attempt {attempt + 1}), retrying")
+
+        logger.error(f"❌ Dropped {len(pending)} events after {self.max_retries} retries")
+        return pending
+
+# Compile the tracking event schema once per container
+try:
+    validate_event_schema = compile_event_validator(with_tracking_constraints(load_event_schema()))
+    logger.info("✅ Tracking event schema compiled.")
+except Exception as e:
+    logger.error(f"❌ Failed to compile tracking event schema, falling back to basic checks: {e}")
+    validate_event_schema = None
+
+# Max events accepted in one batch request
+EVENT_BATCH_MAX_SIZE = int(os.environ.get("EVENT_BATCH_MAX_SIZE", "500"))
+
+# Duplicate suppression: an event whose event_id (or content hash) was seen in the window is acknowledged but not forwarded
+EVENT_DEDUP_ENABLED = os.environ.get("EVENT_DEDUP_ENABLED", "true").lower() == "true"
+EVENT_DEDUP_WINDOW_SECONDS = int(os.environ.get("EVENT_DEDUP_WINDOW_SECONDS", "300"))
+EVENT_DEDUP_CAPACITY = int(os.environ.get("EVENT_DEDUP_CAPACITY", "100000"))
+EVENT_DEDUP_ERROR_RATE = float(os.environ.get("EVENT_DEDUP_ERROR_RATE", "0.0001"))
+
 class WebEventProcessor:
     """Main handler to process incoming web events."""
-    def __init__(self, event_queue: EventQueue):
+    def __init__(self, event_queue: EventQueue, duplicate_filter: DuplicateFilter = None):
         self.event_queue = event_queue
+        self.duplicate_filter = duplicate_filter
+        if duplicate_filter is not None:
+            # Also covers the events dropped after their request has answered (periodic flusher)
+            event_queue.on_dropped = duplicate_filter.forget
+
+    def _is_duplicate(self, key: str) -> bool:
+        return self.duplicate_filter is not None and self.duplicate_filter.contains(key)
+
+    def _mark_seen(self, keys: list):
+        # Only once the events are queued: an event that could not be queued is not suppressed on retry
+        if self.duplicate_filter is not None:
+            self.duplicate_filter.add(keys)
+
+    def collect_failures(self) -> set:
+        """
+        Keys of the events of the current request dropped by any flush since the last call. The client
+        will retry them, so they are forgotten by the duplicate filter, again: a drop inside send() is
+        reported before the key is marked as seen.
+        """
+        failed_keys = {key for key in self.event_queue.take_request_failures() if key is not None}
+        if failed_keys and self.duplicate_filter is not None:
+            self.duplicate_filter.forget(failed_keys)
+        return failed_keys
+
+    def _deliver(self, flush: bool) -> set:
+        """Flush the queue when asked (end of a Lambda invocation), then return the keys of the dropped events."""
+        if flush:
+            with metrics.current().stage("flush"):
+                self.event_queue.flush()
+        return self.collect_failures()
 
     def _parse_event_body(self, event: dict) -> dict:
         body = event.get("body")
         if not body:
             raise ValueError("Missing event body")
-        return json.loads(body) if isinstance(body, str) else body
+        return json_loads(body) if isinstance(body, (str, bytes)) else body
 
-    def _is_valid_event(self, body: dict) -> bool:
-        return (
-            isinstance(body, dict) and
+    def _validate_event(self, body: dict) -> list:
+        """Return field-level errors of the event against the tracking schema, empty if valid."""
+        if not isinstance(body, dict):
+            return [{"field": "$", "reason": "must be object"}]
+        if validate_event_schema is not None:
+            return validate_event_schema(body)
+        if not (
             all(isinstance(body.get(k), str) and 1 <= len(body[k]) <= 36 for k in ["visid", "tenant_id"]) and
             isinstance(body.get("metric"), str) and len(body["metric"]) < 50
-        )
+        ):
+            return [{"field": "$", "reason": "must contain visid, tenant_id and metric"}]
+        return []
 
     def _get_persona_profiles(self, tenant_id: str, visitor_id: str) -> list:
         default_profile = ["persona_web_visitor"]
-        if not sqlite_conn:
-            logger.error("SQLite unavailable.")
-            return default_profile
-
-        try:
-            key = f"{tenant_id}:{visitor_id}"
-            cursor = sqlite_conn.cursor()
-            cursor.execute("SELECT persona_profiles FROM persona_profiles_cache WHERE key = ?", (key,))
-            row = cursor.fetchone()
-            return json.loads(row["persona_profiles"]) if row else default_profile
-        except sqlite3.Error as e:
-            logger.error(f"SQLite error for key {key}: {e}")
-            return default_profile
+        request_metrics = metrics.current()
+        with request_metrics.stage("cache_lookup"):
+            profiles = persona_cache.get(tenant_id, visitor_id)
+            if profiles is not None:
+                request_metrics.incr("cache_hit")
+            elif (persona_snapshot is not None
+                    and (tenant_id, visitor_id) not in persona_snapshot_stale_keys):
+                # Served straight from the mapped snapshot, not copied into the LRU cache
+                profiles = persona_snapshot.get(tenant_id, visitor_id)
+                if profiles is not None:
+                    request_metrics.incr("snapshot_hit")
+            if profiles is None:
+                request_metrics.incr("cache_miss")
+            if profiles is None and persona_loader is not None:
+                # Cache miss: single-key read-through, a visitor without persona is cached as a known miss
+                profiles = persona_loader.load(tenant_id, visitor_id)
+                if profiles is not None:
+                    persona_cache.put(tenant_id, visitor_id, profiles)
+        return profiles or default_profile
 
     def _build_response(self, status_code: int, body: dict) -> dict:
+        with metrics.current().stage("response"):
+            return self._build_response_dict(status_code, body)
+
+    def _build_response_dict(self, status_code: int, body: dict) -> dict:
         return {
             "statusCode": status_code,
             "headers": {
@@ -163,14 +748,122 @@ class WebEventProcessor:
             "body": json.dumps(body)
         }
 
-    def handle_event(self, event: dict):
+    def _get_batch_events(self, body):
+        """Return the list of events if the body is a batch (a JSON array or {"events": [...]}), else None."""
+        if isinstance(body, list):
+            return body
+        if isinstance(body, dict) and isinstance(body.get("events"), list):
+            return body["events"]
+        return None
+
+    def handle_batch(self, events: list, flush: bool = True):
+        """Validate every event, forward the valid ones in one queue operation and report per-item status."""
+        if len(events) > EVENT_BATCH_MAX_SIZE:
+            return self._build_response(413, {"message": f"Batch exceeds {EVENT_BATCH_MAX_SIZE} events"})
+
+        request_metrics = metrics.current()
+        request_metrics.incr("events", len(events))
+        results = []
+        valid_items = []
+        new_events = []
+        new_keys = []
+        batch_keys = set()
+        with request_metrics.stage("validate"):
+            for index, item in enumerate(events):
+                errors = self._validate_event(item)
+                if errors:
+                    results.append({"index": index, "status": "invalid", "message": "Invalid event payload", "errors": errors})
+                    continue
+                key = event_dedup_key(item)
+                # Events are marked as seen once queued, so a repeat inside the batch is caught here
+                is_duplicate = self._is_duplicate(key) or (self.duplicate_filter is not None and key in batch_keys)
+                result = {"index": index, "status": "duplicate" if is_duplicate else "ok"}
+                if not is_duplicate:
+                    new_events.append(item)
+                    new_keys.append(key)
+                    batch_keys.add(key)
+                results.append(result)
+                valid_items.append((item, key, result))
+        request_metrics.incr("invalid_events", len(events) - len(valid_items))
+        request_metrics.incr("duplicate_events", len(valid_items) - len(new_events))
+
+        if not valid_items:
+            logger.warning(f"Invalid batch payload: {len(events)} events, none valid")
+            return self._build_response(400, {"message": "Invalid event payload", "results": results})
+
+        if new_events:
+            with request_metrics.stage("queue_send"):
+                self.event_queue.send_batch(new_events, new_keys)
+            self._mark_seen(new_keys)
+        failed_keys = self._deliver(flush)
+
+        # One persona lookup per visitor, however many events the visitor sent, returned once per visitor
+        persona_profiles = {}
+        failed = 0
+        for item, key, result in valid_items:
+            if result["status"] == "ok" and key in failed_keys:
+                result["status"] = "failed"
+                result["message"] = "Event could not be delivered"
+                failed += 1
+            visitor = f"{item['tenant_id']}:{item['visid']}"
+            if visitor not in persona_profiles:
+                persona_profiles[visitor] = self._get_persona_profiles(item["tenant_id"], item["visid"])
+
+        if failed:
+            # The client retries the batch: delivered items come back as duplicates, failed ones go through
+            return self._build_response(500, {
+                "success": False,
+                "message": f"{failed} of {len(events)} events could not be delivered.",
+                "results": results,
+                "persona_profiles": persona_profiles
+            })
+        return self._build_response(200, {
+            "success": True,
+            "message": f"{len(valid_items)} of {len(events)} events received successfully.",
+            "results": results,
+            "persona_profiles": persona_profiles
+        })
+
+    def handle_event(self, event: dict, flush: bool = True):
+        """Handle one request body, a single event or a batch. flush delivers the buffered events before responding."""
+        # Concurrent requests (server mode) only see the failures of their own events
+        with self.event_queue.track_failures():
+            return self._handle_event(event, flush)
+
+    def _handle_event(self, event: dict, flush: bool):
+        request_metrics = metrics.current()
         try:
-            body = self._parse_event_body(event)
-            if not self._is_valid_event(body):
-                logger.warning(f"Invalid payload: {body}")
-                return self._build_response(400, {"message": "Invalid event payload"})
+            with request_metrics.stage("parse"):
+                body = self._parse_event_body(event)
+            batch_events = self._get_batch_events(body)
+            if batch_events is not None:
+                return self.handle_batch(batch_events, flush)
 
-            self.event_queue.send(body)
+            request_metrics.incr("events")
+            with request_metrics.stage("validate"):
+                errors = self._validate_event(body)
+            if errors:
+                request_metrics.incr("invalid_events")
+                logger.warning(f"Invalid payload: {errors}")
+                return self._build_response(400, {"message": "Invalid event payload", "errors": errors})
+
+            key = event_dedup_key(body)
+            if self._is_duplicate(key):
+                # Retried or double-fired event: acknowledged, not forwarded again
+                request_metrics.incr("duplicate_events")
+                profiles = self._get_persona_profiles(body["tenant_id"], body["visid"])
+                return self._build_response(200, {
+                    "success": True,
+                    "message": "Duplicate event ignored.",
+                    "duplicate": True,
+                    "persona_profiles": profiles
+                })
+
+            with request_metrics.stage("queue_send"):
+                self.event_queue.send(body, key)
+            self._mark_seen([key])
+            if key in self._deliver(flush):
+                return self._build_response(500, {"message": "Internal Server Error"})
             profiles = self._get_persona_profiles(body["tenant_id"], body["visid"])
             return self._build_response(200, {
                 "success": True,
@@ -184,17 +877,52 @@ class WebEventProcessor:
             logger.error(f"Error processing event: {e}", exc_info=True)
             return self._build_response(500, {"message": "Internal Server Error"})
 
+# Per-request stage timings, emitted as CloudWatch EMF lines (METRICS_SINK: stdout, memory or none)
+METRICS_SINK = os.environ.get("METRICS_SINK", "stdout").lower()
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "C360/F1")
+METRICS_SAMPLE_RATE = float(os.environ.get("METRICS_SAMPLE_RATE", "1.0"))
+
 # ===================== Lambda Entry Point =====================
 # Initialize reusable clients/handlers during cold start
+if PERSONA_SNAPSHOT_URI:
+    load_persona_snapshot(PERSONA_SNAPSHOT_URI)
 event_queue_client = EventQueue()
-event_processor = WebEventProcessor(event_queue_client)
+event_processor = WebEventProcessor(
+    event_queue_client,
+    DuplicateFilter(EVENT_DEDUP_CAPACITY, EVENT_DEDUP_ERROR_RATE, EVENT_DEDUP_WINDOW_SECONDS) if EVENT_DEDUP_ENABLED else None
+)
+persona_loader = PersonaProfileLoader(
+    connect_to_pgsql,
+    max_queries_per_second=PERSONA_LOOKUP_MAX_PER_SECOND,
+    batch_window_ms=PERSONA_LOOKUP_BATCH_WINDOW_MS,
+    max_batch_size=PERSONA_LOOKUP_MAX_BATCH_SIZE,
+) if PERSONA_LOOKUP_ENABLED else None
 
-def lambda_handler(event, context):
-    if CACHE_EXPIRY_TIME is None or get_datetime_now() > CACHE_EXPIRY_TIME:
-        logger.info("Cache is stale or uninitialized. Refreshing...")
-        try:
-            refresh_profiles_cache_from_pgsql()
-        except Exception as e:
-            logger.error(f"Cache refresh failed: {e}")
+metrics_emitter = metrics.MetricsEmitter(
+    METRICS_NAMESPACE, "f1_event_track", metrics.create_sink(METRICS_SINK), METRICS_SAMPLE_RATE
+)
+
+def process_event(event: dict, flush: bool = True) -> dict:
+    """
+    Handle one API Gateway style event ({"body": ...}) and return the proxy response.
+    With flush=False the buffered events are left to a periodic flusher (server.py).
+    """
+    with metrics_emitter.request() as request_metrics:
+        with request_metrics.stage("refresh"):
+            refresh_cache_if_stale()
+        request_metrics.gauge("cache_age_seconds", get_cache_age_seconds())
 
-    return event_processor.handle_event(event)
\ No newline at end of file
+        # Dropped events are reported by the handler, whichever flush of the invocation dropped them
+        response = event_processor.handle_event(event, flush)
+
+        if flush and event_queue_client.pending_count():
+            # An error path returned before delivery, the buffer is still emptied before the container is frozen;
+            # the duplicate filter forgets the dropped events through on_dropped
+            with request_metrics.stage("flush"), event_queue_client.track_failures():
+                event_queue_client.flush()
+        request_metrics.set_property("status_code", response["statusCode"])
+        return response
+
+def lambda_handler(event, context):
+    # Deliver everything buffered during this invocation before Lambda freezes the container
+    return process_event(event, flush=True)
\ No newline at end of file
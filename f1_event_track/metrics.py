@@ -0,0 +1,153 @@
+import contextvars
+import json
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+class RequestMetrics:
+    """Per-request stage timers and counters, accumulated in place and emitted once at the end of the request."""
+
+    __slots__ = ("timings", "counters", "gauges", "properties")
+
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+        self.gauges = {}
+        self.properties = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + (time.perf_counter() - started) * 1000
+
+    def incr(self, name: str, value: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name: str, value):
+        if value is not None:
+            self.gauges[name] = value
+
+    def set_property(self, name: str, value):
+        self.properties[name] = value
+
+
+class _NoopMetrics:
+    """Stand-in used outside of a measured request, every call is a no-op."""
+
+    @contextmanager
+    def stage(self, name: str):
+        yield
+
+    def incr(self, name: str, value: int = 1):
+        pass
+
+    def gauge(self, name: str, value):
+        pass
+
+    def set_property(self, name: str, value):
+        pass
+
+
+_NOOP = _NoopMetrics()
+_current = contextvars.ContextVar("f1_request_metrics", default=_NOOP)
+
+
+def current():
+    """Metrics of the request being handled in this thread/task, or a no-op recorder."""
+    return _current.get()
+
+
+class StdoutSink:
+    """Write EMF documents as raw JSON lines on stdout, where CloudWatch Logs extracts the metrics."""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._lock = threading.Lock()
+
+    def __call__(self, document: dict):
+        line = json.dumps(document, separators=(",", ":")) + "\n"
+        with self._lock:
+            self.stream.write(line)
+            self.stream.flush()
+
+
+class MemorySink:
+    """Keep EMF documents in memory, for local runs and tests."""
+
+    def __init__(self, max_documents: int = 10000):
+        self.max_documents = max_documents
+        self.documents = []
+
+    def __call__(self, document: dict):
+        if len(self.documents) >= self.max_documents:
+            self.documents.pop(0)
+        self.documents.append(document)
+
+
+class MetricsEmitter:
+    """
+    Build one CloudWatch Embedded Metric Format document per request and hand it to a sink.
+
+    Only a sample_rate fraction of the requests is emitted; the others are still timed (a few
+    perf_counter calls) but nothing is serialized or written.
+    """
+
+    def __init__(self, namespace: str, service: str, sink, sample_rate: float = 1.0):
+        self.namespace = namespace
+        self.service = service
+        self.sink = sink
+        self.sample_rate = sample_rate
+
+    @contextmanager
+    def request(self):
+        """Measure one request: make a RequestMetrics current, time the whole block as 'total' and emit it."""
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            with metrics.stage("total"):
+                yield metrics
+        finally:
+            _current.reset(token)
+            if self.sink is not None and (self.sample_rate >= 1 or random.random() < self.sample_rate):
+                self.sink(self.to_emf(metrics))
+
+    def to_emf(self, metrics: RequestMetrics) -> dict:
+        document = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [["Service"]],
+                    "Metrics": [],
+                }],
+            },
+            "Service": self.service,
+        }
+        definitions = document["_aws"]["CloudWatchMetrics"][0]["Metrics"]
+        for name, value in metrics.timings.items():
+            definitions.append({"Name": f"{name}_ms", "Unit": "Milliseconds"})
+            document[f"{name}_ms"] = round(value, 3)
+        for name, value in metrics.counters.items():
+            definitions.append({"Name": name, "Unit": "Count"})
+            document[name] = value
+        for name, value in metrics.gauges.items():
+            definitions.append({"Name": name, "Unit": "Seconds" if name.endswith("_seconds") else "None"})
+            document[name] = value
+        # Properties are searchable in CloudWatch Logs Insights but are not metrics
+        document.update(metrics.properties)
+        return document
+
+
+def create_sink(kind: str):
+    """Sink from METRICS_SINK: 'stdout' (CloudWatch EMF), 'memory' (local capture) or 'none'."""
+    if kind == "stdout":
+        return StdoutSink()
+    if kind == "memory":
+        return MemorySink()
+    return None
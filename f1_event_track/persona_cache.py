@@ -0,0 +1,199 @@
+import json
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger()
+
+# Rough per-entry overhead of the OrderedDict slot, key tuple and entry tuple (CPython, 64-bit)
+ENTRY_OVERHEAD_BYTES = 200
+
+
+def decode_persona_profiles(value) -> list:
+    """cdp_persona_profiles.persona_profiles may come back as a JSON string or an already decoded list."""
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = value.strip()
+        return json.loads(value) or [] if value else []
+    return list(value)
+
+
+class PersonaProfileCache:
+    """
+    Memory-bounded LRU cache of persona profiles keyed by (tenant_id, visitor_id).
+
+    Entries are evicted least-recently-used first once the estimated size goes over max_bytes.
+    A visitor known to have no persona is cached as a negative entry (empty list) that expires
+    after negative_ttl_seconds, so repeated misses do not hit PostgreSQL again.
+    """
+
+    def __init__(self, max_bytes: int, negative_ttl_seconds: int = 300):
+        self.max_bytes = max_bytes
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self._entries = OrderedDict()  # key -> (profiles tuple, size, negative expiry or None)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    @staticmethod
+    def _estimate_size(key: tuple, profiles: tuple) -> int:
+        # Persona names are interned, so they are shared across entries and only the references count
+        return ENTRY_OVERHEAD_BYTES + len(key[0]) + len(key[1]) + 8 * len(profiles)
+
+    def get(self, tenant_id: str, visitor_id: str):
+        """Return the cached persona list ([] for a known miss), or None if the visitor is not cached."""
+        key = (tenant_id, visitor_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            profiles, size, expires_at = entry
+            if expires_at is not None and time.monotonic() > expires_at:
+                del self._entries[key]
+                self._bytes -= size
+                return None
+            self._entries.move_to_end(key)
+            return list(profiles)
+
+    def put(self, tenant_id: str, visitor_id: str, profiles):
+        """Cache the persona list of a visitor, an empty list is cached as a negative entry."""
+        key = (tenant_id, visitor_id)
+        profiles = tuple(sys.intern(p) if isinstance(p, str) else p for p in (profiles or ()))
+        expires_at = None if profiles else time.monotonic() + self.negative_ttl_seconds
+        size = self._estimate_size(key, profiles)
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (profiles, size, expires_at)
+            self._bytes += size
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def delete(self, tenant_id: str, visitor_id: str):
+        with self._lock:
+            old = self._entries.pop((tenant_id, visitor_id), None)
+            if old is not None:
+                self._bytes -= old[1]
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def bytes_used(self) -> int:
+        return self._bytes
+
+
+class _PendingLookup:
+    __slots__ = ("event", "profiles")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.profiles = None
+
+
+class PersonaProfileLoader:
+    """
+    Read-through lookup of persona profiles in PostgreSQL for visitors missing from the cache.
+
+    Concurrent misses are coalesced: the first caller waits batch_window_ms, then fetches every
+    pending key in one query. Queries are rate-limited with a token bucket; when no token is left
+    the lookup returns None and the caller falls back to the default persona without caching.
+    """
+
+    def __init__(self, connection_factory, max_queries_per_second: float = 50,
+                 batch_window_ms: float = 0, max_batch_size: int = 100, timeout_seconds: float = 2):
+        self.connection_factory = connection_factory
+        self.max_queries_per_second = max_queries_per_second
+        self.batch_window_seconds = batch_window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.timeout_seconds = timeout_seconds
+
+        self._conn = None
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()  # (tenant_id, visitor_id) -> _PendingLookup
+        self._leader_active = False
+
+        self._tokens = float(max_queries_per_second)
+        self._tokens_updated_at = time.monotonic()
+
+    def _take_token(self) -> bool:
+        now = time.monotonic()
+        self._tokens = min(
+            float(self.max_queries_per_second),
+            self._tokens + (now - self._tokens_updated_at) * self.max_queries_per_second
+        )
+        self._tokens_updated_at = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def load(self, tenant_id: str, visitor_id: str):
+        """Return the persona list of a visitor ([] if it has none), or None if the lookup was skipped or failed."""
+        key = (tenant_id, visitor_id)
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = _PendingLookup()
+            is_leader = not self._leader_active
+            self._leader_active = True
+
+        if is_leader:
+            self._run_batches()
+
+        pending.event.wait(self.timeout_seconds)
+        return pending.profiles
+
+    def _run_batches(self):
+        if self.batch_window_seconds > 0:
+            time.sleep(self.batch_window_seconds)
+        while True:
+            with self._lock:
+                batch = []
+                while self._pending and len(batch) < self.max_batch_size:
+                    batch.append(self._pending.popitem(last=False))
+                if not batch:
+                    self._leader_active = False
+                    return
+                allowed = self._take_token()
+
+            results = self._fetch([key for key, _ in batch]) if allowed else None
+            if not allowed:
+                logger.warning(f"Persona lookup rate limit reached, skipped {len(batch)} keys")
+            for key, pending in batch:
+                if results is not None:
+                    pending.profiles = results.get(key, [])
+                pending.event.set()
+
+    def _fetch(self, keys: list):
+        """Fetch persona profiles for the keys in one query. Returns {key: profiles} or None on error."""
+        try:
+            if self._conn is None or self._conn.closed:
+                self._conn = self.connection_factory()
+                self._conn.autocommit = True
+            with self._conn.cursor() as cur:
+                cur.execute("""
+                    SELECT p.tenant_id, p.visitor_id, p.persona_profiles
+                    FROM cdp_persona_profiles p
+                    JOIN unnest(%s::text[], %s::text[]) AS k(tenant_id, visitor_id)
+                      ON p.tenant_id = k.tenant_id AND p.visitor_id = k.visitor_id
+                """, ([k[0] for k in keys], [k[1] for k in keys]))
+                rows = cur.fetchall()
+        except Exception as e:
+            logger.error(f"Persona lookup failed for {len(keys)} keys: {e}")
+            if self._conn is not None:
+                try:
+                    self._conn.close()
+                except Exception:
+                    pass
+                self._conn = None
+            return None
+
+        return {(tenant_id, visitor_id): decode_persona_profiles(profiles) for tenant_id, visitor_id, profiles in rows}
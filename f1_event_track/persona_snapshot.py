@@ -0,0 +1,291 @@
+"""
+Versioned binary snapshot of visitor -> persona mappings, memory-mapped by F1 at cold start.
+
+File layout (little-endian):
+
+    header      MAGIC, format version, bucket bits, watermark (epoch micros), entry count,
+                offsets of the sections below
+    strings     interned persona names: u32 count, then (u32 offset, u32 length) per name, then UTF-8 bytes
+    lists       interned persona lists: u32 count, then u32 offset per list into the list data,
+                list data = u16 count followed by u32 string ids
+    buckets     (2^bucket_bits + 1) u32: first entry index of each hash bucket
+    entries     fixed-size records sorted by key hash: u64 hash, u32 key offset, u16 key length, u16 pad, u32 list id
+    keys        UTF-8 "tenant_id<US>visitor_id" keys referenced by the entries
+
+A lookup hashes the key, reads the bucket bounds, scans the few entries of the bucket and compares
+the key bytes in place, so the file is used zero-copy straight from the page cache.
+
+Build a snapshot offline with:
+
+    python persona_snapshot.py --output /tmp/persona_snapshot.bin [--upload s3://bucket/key]
+"""
+import argparse
+import hashlib
+import logging
+import mmap
+import os
+import struct
+from datetime import datetime, timedelta, timezone
+
+from persona_cache import decode_persona_profiles
+
+logger = logging.getLogger()
+
+MAGIC = b"C360PSNP"
+FORMAT_VERSION = 1
+KEY_SEPARATOR = "\x1f"
+
+HEADER = struct.Struct("<8sIIqQQQQQQ")  # magic, version, bucket bits, watermark, entries, 5 section offsets
+ENTRY = struct.Struct("<QIHHI")
+U16 = struct.Struct("<H")
+U32 = struct.Struct("<I")
+U32_PAIR = struct.Struct("<II")
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def as_utc(value: datetime) -> datetime:
+    """Treat naive timestamps from PostgreSQL as UTC, so they compare with aware ones."""
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def _key_bytes(tenant_id: str, visitor_id: str) -> bytes:
+    return f"{tenant_id}{KEY_SEPARATOR}{visitor_id}".encode("utf-8")
+
+
+def _key_hash(key: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+def _bucket_bits_for(count: int) -> int:
+    # Around 4 entries per bucket, between 2^4 and 2^24 buckets
+    bits = 4
+    while (1 << bits) * 4 < count and bits < 24:
+        bits += 1
+    return bits
+
+
+def build_snapshot(rows, path: str, watermark: datetime) -> int:
+    """
+    Write a snapshot from rows of (tenant_id, visitor_id, persona_profiles) to path, atomically.
+    watermark is the highest cdp_persona_profiles.updated_at covered by the snapshot.
+    Returns the number of visitors written.
+    """
+    string_ids = {}
+    list_ids = {}
+    lists = []
+    records = []
+    keys_blob = bytearray()
+
+    for tenant_id, visitor_id, profiles in rows:
+        profiles = decode_persona_profiles(profiles)
+        if not profiles:
+            continue
+        persona_list = tuple(string_ids.setdefault(p, len(string_ids)) for p in profiles)
+        list_id = list_ids.get(persona_list)
+        if list_id is None:
+            list_id = list_ids[persona_list] = len(lists)
+            lists.append(persona_list)
+
+        key = _key_bytes(tenant_id, visitor_id)
+        records.append((_key_hash(key), len(keys_blob), len(key), list_id))
+        keys_blob += key
+
+    records.sort(key=lambda r: r[0])
+    bucket_bits = _bucket_bits_for(len(records))
+    shift = 64 - bucket_bits
+
+    # Strings section
+    names = [name.encode("utf-8") for name, _ in sorted(string_ids.items(), key=lambda item: item[1])]
+    strings = bytearray(U32.pack(len(names)))
+    data_offset = 0
+    for name in names:
+        strings += U32_PAIR.pack(data_offset, len(name))
+        data_offset += len(name)
+    for name in names:
+        strings += name
+
+    # Lists section
+    list_data = bytearray()
+    list_offsets = []
+    for persona_list in lists:
+        list_offsets.append(len(list_data))
+        list_data += U16.pack(len(persona_list))
+        for string_id in persona_list:
+            list_data += U32.pack(string_id)
+    lists_section = bytearray(U32.pack(len(lists)))
+    for offset in list_offsets:
+        lists_section += U32.pack(offset)
+    lists_section += list_data
+
+    # Buckets section
+    buckets = [0] * ((1 << bucket_bits) + 1)
+    for h, _, _, _ in records:
+        buckets[(h >> shift) + 1] += 1
+    for i in range(1, len(buckets)):
+        buckets[i] += buckets[i - 1]
+    buckets_section = struct.pack(f"<{len(buckets)}I", *buckets)
+
+    entries_section = b"".join(ENTRY.pack(h, key_offset, key_len, 0, list_id) for h, key_offset, key_len, list_id in records)
+
+    strings_offset = HEADER.size
+    lists_offset = strings_offset + len(strings)
+    buckets_offset = lists_offset + len(lists_section)
+    entries_offset = buckets_offset + len(buckets_section)
+    keys_offset = entries_offset + len(entries_section)
+
+    watermark_us = int((as_utc(watermark) - EPOCH) / timedelta(microseconds=1))
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, bucket_bits, watermark_us, len(records),
+                         strings_offset, lists_offset, buckets_offset, entries_offset, keys_offset)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        for section in (header, strings, lists_section, buckets_section, entries_section, keys_blob):
+            f.write(section)
+    os.replace(tmp_path, path)
+    return len(records)
+
+
+class PersonaSnapshot:
+    """Read-only, memory-mapped persona snapshot written by build_snapshot."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mm)
+
+        (magic, version, self.bucket_bits, watermark_us, self.entry_count, strings_offset,
+         lists_offset, self._buckets_offset, self._entries_offset, self._keys_offset) = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self.close()
+            raise ValueError(f"Unsupported persona snapshot {path}: magic={magic!r} version={version}")
+
+        self.watermark = EPOCH + timedelta(microseconds=watermark_us)
+        self._shift = 64 - self.bucket_bits
+
+        # Persona names are few and shared, decode them once
+        (name_count,) = U32.unpack_from(self._mm, strings_offset)
+        names_data = strings_offset + 4 + name_count * U32_PAIR.size
+        self._names = []
+        for i in range(name_count):
+            offset, length = U32_PAIR.unpack_from(self._mm, strings_offset + 4 + i * U32_PAIR.size)
+            self._names.append(bytes(self._view[names_data + offset:names_data + offset + length]).decode("utf-8"))
+
+        (list_count,) = U32.unpack_from(self._mm, lists_offset)
+        self._list_offsets = lists_offset + 4
+        self._list_data = lists_offset + 4 + list_count * 4
+
+    def __len__(self):
+        return self.entry_count
+
+    def _persona_list(self, list_id: int) -> list:
+        (offset,) = U32.unpack_from(self._mm, self._list_offsets + list_id * 4)
+        position = self._list_data + offset
+        (count,) = U16.unpack_from(self._mm, position)
+        ids = struct.unpack_from(f"<{count}I", self._mm, position + 2)
+        return [self._names[i] for i in ids]
+
+    def get(self, tenant_id: str, visitor_id: str):
+        """Return the persona list of a visitor, or None if the visitor is not in the snapshot."""
+        key = _key_bytes(tenant_id, visitor_id)
+        h = _key_hash(key)
+        bucket = h >> self._shift
+        start, end = struct.unpack_from("<II", self._mm, self._buckets_offset + bucket * 4)
+        for index in range(start, end):
+            entry_hash, key_offset, key_len, _, list_id = ENTRY.unpack_from(self._mm, self._entries_offset + index * ENTRY.size)
+            if entry_hash == h and key_len == len(key):
+                key_start = self._keys_offset + key_offset
+                if self._view[key_start:key_start + key_len] == key:
+                    return self._persona_list(list_id)
+            elif entry_hash > h:
+                break
+        return None
+
+    def close(self):
+        if getattr(self, "_view", None) is not None:
+            self._view.release()
+            self._view = None
+        if getattr(self, "_mm", None) is not None:
+            self._mm.close()
+            self._mm = None
+        self._file.close()
+
+
+def fetch_snapshot(uri: str, local_dir: str = "/tmp") -> str:
+    """
+    Return a local path for the snapshot at uri. s3://bucket/key is downloaded once into local_dir
+    (Lambda keeps /tmp across warm invocations), file:// URIs and plain paths are used as they are.
+    """
+    if uri.startswith("s3://"):
+        import boto3
+
+        bucket, _, key = uri[len("s3://"):].partition("/")
+        local_path = os.path.join(local_dir, os.path.basename(key) or "persona_snapshot.bin")
+        if not os.path.exists(local_path):
+            boto3.client("s3").download_file(bucket, key, f"{local_path}.download")
+            os.replace(f"{local_path}.download", local_path)
+        return local_path
+    if uri.startswith("file://"):
+        return uri[len("file://"):]
+    return uri
+
+
+def upload_snapshot(path: str, uri: str):
+    """Upload a built snapshot to s3://bucket/key."""
+    import boto3
+
+    bucket, _, key = uri[len("s3://"):].partition("/")
+    boto3.client("s3").upload_file(path, bucket, key)
+
+
+def main():
+    """Offline builder: dump every cdp_persona_profiles row into a snapshot file."""
+    import psycopg2
+    import db_utils
+
+    parser = argparse.ArgumentParser(description="Build the F1 persona snapshot from cdp_persona_profiles")
+    parser.add_argument("--output", required=True, help="local path of the snapshot file")
+    parser.add_argument("--upload", help="optional s3://bucket/key to publish the snapshot to")
+    parser.add_argument("--days", type=int, default=0, help="only visitors updated in the last N days (0 = all)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    db_credentials = db_utils.get_db_credentials()
+    conn = psycopg2.connect(
+        dbname=db_credentials["DB_NAME"],
+        user=db_credentials["DB_USER"],
+        password=db_credentials["DB_PASS"],
+        host=db_credentials["DB_HOST"],
+        port=int(db_credentials.get("DB_PORT", 5432)),
+        connect_timeout=5
+    )
+    try:
+        with conn.cursor() as cur:
+            # The watermark is read first, rows updated while the dump runs are picked up by the F1 delta
+            cur.execute("SELECT COALESCE(MAX(updated_at), NOW()) FROM cdp_persona_profiles")
+            (watermark,) = cur.fetchone()
+            watermark = as_utc(watermark)
+
+        since = datetime.now(timezone.utc) - timedelta(days=args.days) if args.days > 0 else EPOCH
+        with conn.cursor(name="persona_snapshot_dump") as cur:
+            cur.itersize = 10000
+            cur.execute("""
+                SELECT tenant_id, visitor_id, persona_profiles
+                FROM cdp_persona_profiles
+                WHERE updated_at >= %s AND updated_at <= %s
+            """, (since, watermark))
+            count = build_snapshot(cur, args.output, watermark)
+    finally:
+        conn.close()
+
+    logger.info(f"✅ Persona snapshot written to {args.output}: {count} visitors, watermark {watermark.isoformat()}")
+    if args.upload:
+        upload_snapshot(args.output, args.upload)
+        logger.info(f"✅ Persona snapshot uploaded to {args.upload}")
+
+
+if __name__ == "__main__":
+    main()
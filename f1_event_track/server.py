@@ -0,0 +1,123 @@
+"""
+Standalone HTTP server for F1: serves the same WebEventProcessor as the Lambda handler, for load
+tests and container deployments.
+
+    F1_WORKERS=4 QUEUE_TYPE=memory ./start-server.sh
+
+Each uvicorn worker is a separate process with its own persona cache, preloaded on startup.
+A persona snapshot (PERSONA_SNAPSHOT_URI) is memory-mapped, so all workers share its pages.
+"""
+import logging
+import os
+import threading
+from contextlib import asynccontextmanager
+
+# Serving threads keep answering while the persona cache refreshes in the background
+os.environ.setdefault("CACHE_REFRESH_STRATEGY", "background")
+
+from fastapi import FastAPI, Request, Response
+from starlette.concurrency import run_in_threadpool
+
+import main
+
+logger = logging.getLogger()
+
+# Paths of the tracking endpoint, as exposed by API Gateway
+TRACK_PATHS = ("/c360-profile-track", "/id-resolution/c360-profile-track")
+# Load the persona cache before the worker accepts traffic
+F1_PRELOAD_PERSONA_CACHE = os.environ.get("F1_PRELOAD_PERSONA_CACHE", "true").lower() == "true"
+# Buffered events are delivered by a background thread instead of at the end of every request
+F1_FLUSH_INTERVAL_MS = int(os.environ.get("F1_FLUSH_INTERVAL_MS", os.environ.get("EVENT_QUEUE_BATCH_MAX_AGE_MS", "1000")))
+
+
+class PeriodicFlusher:
+    """Flush the event queue of the processor every interval_seconds from a daemon thread, and once more on stop()."""
+
+    def __init__(self, event_processor, interval_seconds: float):
+        self.event_processor = event_processor
+        self.interval_seconds = interval_seconds
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="f1-event-flusher", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval_seconds):
+            self._flush()
+
+    def _flush(self):
+        try:
+            # Dropped events are reported to their requests and forgotten by the duplicate filter (on_dropped)
+            failed = self.event_processor.event_queue.flush()
+            if failed:
+                logger.error(f"❌ {failed} events could not be delivered")
+        except Exception as e:
+            logger.error(f"❌ Event flush failed: {e}", exc_info=True)
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join(timeout=self.interval_seconds + 5)
+        self._flush()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if F1_PRELOAD_PERSONA_CACHE:
+        try:
+            await run_in_threadpool(main.refresh_profiles_cache_from_pgsql)
+        except Exception as e:
+            # Requests still work, the cache is loaded on the first request instead
+            logger.error(f"❌ Persona cache preload failed: {e}")
+
+    flusher = PeriodicFlusher(main.event_processor, F1_FLUSH_INTERVAL_MS / 1000)
+    flusher.start()
+    logger.info(f"✅ F1 worker {os.getpid()} ready, queue type {main.event_queue_client.queue_type}")
+    try:
+        yield
+    finally:
+        flusher.stop()
+
+
+app = FastAPI(title="F1 event track", lifespan=lifespan)
+
+
+async def track(request: Request) -> Response:
+    body = await request.body()
+    # The handler may block on PostgreSQL (read-through lookups), so it runs off the event loop
+    result = await run_in_threadpool(main.process_event, {"body": body}, False)
+    return Response(content=result["body"], status_code=result["statusCode"], headers=result["headers"])
+
+
+async def preflight() -> Response:
+    return Response(status_code=204, headers={
+        "Access-Control-Allow-Origin": "*",
+        "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Requested-With",
+        "Access-Control-Allow-Methods": "GET,POST,PUT,DELETE,OPTIONS",
+    })
+
+
+for path in TRACK_PATHS:
+    app.add_api_route(path, track, methods=["POST"])
+    app.add_api_route(path, preflight, methods=["OPTIONS"])
+
+
+@app.get("/health")
+def health():
+    return {
+        "status": "ok",
+        "pid": os.getpid(),
+        "pending_events": main.event_queue_client.pending_count(),
+        "persona_cache": main.get_cache_metrics(),
+    }
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "server:app",
+        host=os.environ.get("F1_HOST", "0.0.0.0"),
+        port=int(os.environ.get("F1_PORT", "8080")),
+        workers=int(os.environ.get("F1_WORKERS", "4")),
+    )
@@ -0,0 +1,6 @@
+#!/bin/bash
+# Run F1 as a standalone HTTP server with several worker processes (see server.py)
+if [ -f .local_env ]; then
+  export $(cat .local_env | xargs)
+fi
+uvicorn server:app --host ${F1_HOST:-0.0.0.0} --port ${F1_PORT:-8080} --workers ${F1_WORKERS:-4}
@@ -0,0 +1,211 @@
+"""
+Backfill the canonical identifiers of the rows written before F2 canonicalized them.
+
+    SECRET_NAME=... python backfill_canonical_identifiers.py
+    DB_HOST=localhost DB_NAME=c360 DB_USER=postgres DB_PASS=... python backfill_canonical_identifiers.py --batch-size 5000
+
+The values are converted by the same functions as canonicalize_profile_rows (processor.py), so a backfilled
+row is identical to the row F2 would write today: phone_number in E.164 (any number phonenumbers can parse,
+not only the Vietnamese local ones), email NFKC-normalized and lowercased, email_raw / phone_number_raw set
+to the values as stored, and name_folded from first_name + last_name.
+
+1. cdp_raw_profiles_stage: phone_number, email, email_raw, phone_number_raw and name_folded.
+2. cdp_master_profiles: phone_number, secondary_phone_numbers, email and secondary_emails. When
+   cdp_master_identifiers exists (17_master_identifiers_table.sql), the email and phone_number identifiers
+   of the changed masters are replaced by their canonical values.
+
+Rows are scanned by primary key and each batch is one transaction, so the backfill can be stopped and run
+again: rows already canonical are left untouched.
+"""
+import argparse
+import time
+
+from psycopg2.extras import execute_values
+
+import db_utils
+from processor import canonical_email, canonical_phone_number, folded_full_name
+
+sql_select_raw_profiles = """
+    SELECT raw_profile_id::TEXT, email::TEXT, phone_number, first_name, last_name,
+           email_raw::TEXT, phone_number_raw, name_folded
+    FROM cdp_raw_profiles_stage
+    WHERE raw_profile_id > %s::UUID
+    ORDER BY raw_profile_id
+    LIMIT %s
+"""
+
+sql_update_raw_profiles = """
+    UPDATE cdp_raw_profiles_stage r
+    SET email = v.email,
+        phone_number = v.phone_number,
+        email_raw = v.email_raw,
+        phone_number_raw = v.phone_number_raw,
+        name_folded = v.name_folded
+    FROM (VALUES %s) AS v(raw_profile_id, email, phone_number, email_raw, phone_number_raw, name_folded)
+    WHERE r.raw_profile_id = v.raw_profile_id
+"""
+raw_profile_template = "(%s::UUID, %s::CITEXT, %s, %s::CITEXT, %s, %s)"
+
+sql_select_masters = """
+    SELECT master_profile_id::TEXT, email::TEXT, secondary_emails, phone_number, secondary_phone_numbers
+    FROM cdp_master_profiles
+    WHERE master_profile_id > %s::UUID
+    ORDER BY master_profile_id
+    LIMIT %s
+"""
+
+sql_update_masters = """
+    UPDATE cdp_master_profiles mp
+    SET email = v.email,
+        secondary_emails = v.secondary_emails,
+        phone_number = v.phone_number,
+        secondary_phone_numbers = v.secondary_phone_numbers
+    FROM (VALUES %s) AS v(master_profile_id, email, secondary_emails, phone_number, secondary_phone_numbers)
+    WHERE mp.master_profile_id = v.master_profile_id
+"""
+master_template = "(%s::UUID, %s::CITEXT, %s::TEXT[], %s, %s::TEXT[])"
+
+sql_has_master_identifiers = "SELECT to_regclass('cdp_master_identifiers') IS NOT NULL"
+
+sql_delete_master_identifiers = """
+    DELETE FROM cdp_master_identifiers
+    WHERE master_profile_id = ANY(%s::UUID[]) AND id_type IN ('email', 'phone_number')
+"""
+
+# Same rule as the backfill of 17_master_identifiers_table.sql: an identifier already owned by another master stays there
+sql_register_master_identifiers = """
+    INSERT INTO cdp_master_identifiers (tenant_id, id_type, id_value, master_profile_id)
+    SELECT mp.tenant_id, i.id_type, i.id_value, mp.master_profile_id
+    FROM cdp_master_profiles mp
+    CROSS JOIN LATERAL (
+        SELECT 'email', lower(NULLIF(btrim(mp.email::TEXT), ''))
+        UNION ALL
+        SELECT 'email', lower(NULLIF(btrim(elem), '')) FROM unnest(mp.secondary_emails) AS elem
+        UNION ALL
+        SELECT 'phone_number', NULLIF(btrim(mp.phone_number), '')
+        UNION ALL
+        SELECT 'phone_number', NULLIF(btrim(elem), '') FROM unnest(mp.secondary_phone_numbers) AS elem
+    ) AS i(id_type, id_value)
+    WHERE mp.master_profile_id = ANY(%s::UUID[])
+      AND mp.tenant_id IS NOT NULL
+      AND i.id_value IS NOT NULL
+    ORDER BY mp.created_at, mp.master_profile_id
+    ON CONFLICT (tenant_id, id_type, id_value) DO NOTHING
+"""
+
+# Smaller than any UUID, the start of the keyset scans
+FIRST_KEY = "00000000-0000-0000-0000-000000000000"
+
+
+def _canonical(value, canonicalize):
+    return canonicalize(value) if value else value
+
+
+def _canonical_list(values, canonicalize, primary):
+    """Canonical values of a secondary array, without duplicates nor the primary value, in their first order."""
+    if values is None:
+        return None
+    canonical_values = []
+    for value in values:
+        value = _canonical(value, canonicalize)
+        if value and value != primary and value not in canonical_values:
+            canonical_values.append(value)
+    return canonical_values
+
+
+def backfill_raw_profile(row):
+    """Canonical (raw_profile_id, email, phone_number, email_raw, phone_number_raw, name_folded) of a row, None if unchanged."""
+    raw_profile_id, email, phone_number, first_name, last_name, email_raw, phone_number_raw, name_folded = row
+    canonical = (
+        raw_profile_id,
+        _canonical(email, canonical_email),
+        _canonical(phone_number, canonical_phone_number),
+        # Rows written before canonicalization store the values as sent
+        email_raw if email_raw is not None else email,
+        phone_number_raw if phone_number_raw is not None else phone_number,
+        folded_full_name(first_name, last_name),
+    )
+    current = (raw_profile_id, email, phone_number, email_raw, phone_number_raw, name_folded)
+    return None if canonical == current else canonical
+
+
+def backfill_master(row):
+    """Canonical (master_profile_id, email, secondary_emails, phone_number, secondary_phone_numbers), None if unchanged."""
+    master_profile_id, email, secondary_emails, phone_number, secondary_phone_numbers = row
+    email = _canonical(email, canonical_email)
+    phone_number = _canonical(phone_number, canonical_phone_number)
+    canonical = (
+        master_profile_id,
+        email,
+        _canonical_list(secondary_emails, canonical_email, email),
+        phone_number,
+        _canonical_list(secondary_phone_numbers, canonical_phone_number, phone_number),
+    )
+    return None if canonical == tuple(row) else canonical
+
+
+def backfill_raw_profiles(connection, batch_size: int) -> int:
+    last_key, updated = FIRST_KEY, 0
+    while True:
+        with connection.cursor() as cursor:
+            cursor.execute(sql_select_raw_profiles, (last_key, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            changes = [change for change in map(backfill_raw_profile, rows) if change is not None]
+            if changes:
+                execute_values(cursor, sql_update_raw_profiles, changes, template=raw_profile_template, page_size=len(changes))
+        connection.commit()
+        last_key, updated = rows[-1][0], updated + len(changes)
+        print(f"✅ [RAW PROFILES] {updated} rows updated, up to {last_key}")
+    return updated
+
+
+def backfill_masters(connection, batch_size: int) -> int:
+    with connection.cursor() as cursor:
+        cursor.execute(sql_has_master_identifiers)
+        has_master_identifiers = cursor.fetchone()[0]
+    connection.commit()
+
+    last_key, updated = FIRST_KEY, 0
+    while True:
+        with connection.cursor() as cursor:
+            cursor.execute(sql_select_masters, (last_key, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            changes = [change for change in map(backfill_master, rows) if change is not None]
+            if changes:
+                execute_values(cursor, sql_update_masters, changes, template=master_template, page_size=len(changes))
+                if has_master_identifiers:
+                    master_profile_ids = [change[0] for change in changes]
+                    cursor.execute(sql_delete_master_identifiers, (master_profile_ids,))
+                    cursor.execute(sql_register_master_identifiers, (master_profile_ids,))
+        connection.commit()
+        last_key, updated = rows[-1][0], updated + len(changes)
+        print(f"✅ [MASTER PROFILES] {updated} rows updated, up to {last_key}")
+    return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Canonicalize the identifiers stored before F2 canonicalized them")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--skip-raw-profiles", action="store_true")
+    parser.add_argument("--skip-masters", action="store_true")
+    args = parser.parse_args()
+
+    manager = db_utils.DatabaseConnectionManager(credentials_provider=db_utils.credentials_from_env_or_secret)
+    connection = manager.get_connection()
+    started = time.perf_counter()
+    try:
+        if not args.skip_raw_profiles:
+            backfill_raw_profiles(connection, args.batch_size)
+        if not args.skip_masters:
+            backfill_masters(connection, args.batch_size)
+    finally:
+        manager.invalidate()
+    print(f"🏁 Backfill done in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
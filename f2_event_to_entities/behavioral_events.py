@@ -0,0 +1,121 @@
+"""
+Behavioral part of the tracking events, written to cdp_behavioral_events from the same Firehose batch
+as the profiles. The event of a record is decoded once and gives both its profile and its event row.
+"""
+import hashlib
+from datetime import datetime, timezone
+
+import psycopg2
+from psycopg2.extras import execute_values, Json
+
+from processor import decode_event_record
+
+sql_behavioral_event_columns = """
+        id, event_name, event_type, created_at, source_system,
+        tenant_id, web_visitor_id, master_profile_id, session_id, mediahost, web_url,
+        item_id, item_description, item_category, product_code, text_message,
+        user_agent, metadata
+"""
+BEHAVIORAL_EVENT_COLUMNS = [column.strip() for column in sql_behavioral_event_columns.split(",")]
+
+# Fields of the event kept in metadata, next to the dedicated columns
+EVENT_METADATA_FIELDS = (
+    "event_id", "observer_id", "schema_version", "refvisid", "tprefurl", "tprefdomain", "tpname", "utmdata",
+    "fgp", "language", "platform", "device", "app_version", "open_in_app", "is_in_app_browser",
+    "purchase_flow", "invoice_number", "event_payload",
+)
+
+# Columns of event_payload copied to the item columns
+EVENT_PAYLOAD_COLUMNS = ("item_id", "item_description", "item_category", "product_code", "text_message")
+
+# Inserting an event twice (Firehose retry, duplicate send) is a no-op thanks to the hashed id
+sql_insert_behavioral_events = f"""
+    INSERT INTO public.cdp_behavioral_events ({sql_behavioral_event_columns})
+    VALUES %s
+    ON CONFLICT (id) DO NOTHING
+"""
+
+
+def event_created_at(event: dict, arrival_timestamp=None):
+    """
+    ISO time of the event: datetime, else unix_timestamp (milliseconds), else the approximateArrivalTimestamp
+    of its Firehose record (milliseconds), else None. The time is hashed into the event id, so it has to be
+    the same when Firehose retries the record.
+    """
+    if event.get("datetime"):
+        return event["datetime"]
+    if isinstance(event.get("unix_timestamp"), (int, float)):
+        return datetime.fromtimestamp(event["unix_timestamp"] / 1000, timezone.utc).isoformat()
+    if isinstance(arrival_timestamp, (int, float)):
+        return datetime.fromtimestamp(arrival_timestamp / 1000, timezone.utc).isoformat()
+    return None
+
+
+def build_behavioral_event(event: dict, arrival_timestamp=None):
+    """
+    Row of cdp_behavioral_events for a tracking event, in BEHAVIORAL_EVENT_COLUMNS order with id left
+    empty for assign_event_ids. None for records without visid (CRM / data lake imports), and for events
+    without any time, whose id would change on every retry.
+    """
+    web_visitor_id = event.get("visid")
+    if not isinstance(web_visitor_id, str) or not web_visitor_id.strip() or not event.get("metric"):
+        return None
+    created_at = event_created_at(event, arrival_timestamp)
+    if created_at is None:
+        print(f"[WARN] Behavioral event of visitor {web_visitor_id} skipped: no datetime, unix_timestamp or arrival time")
+        return None
+    payload = event.get("event_payload") or {}
+    traits = event.get("profile_traits") or {}
+    metadata = {field: event[field] for field in EVENT_METADATA_FIELDS if event.get(field) is not None}
+    return (
+        None,
+        event["metric"],
+        "behavioral",
+        created_at,
+        traits.get("source_system") or traits.get("usersource") or "websdk",
+        event.get("tenant_id"),
+        web_visitor_id.strip(),
+        None,  # set once the visitor is linked to a master profile
+        event.get("sessionid") or "",
+        event.get("mediahost") or "",
+        event.get("tpurl") or "",
+        *(payload.get(column) for column in EVENT_PAYLOAD_COLUMNS),
+        event.get("user_agent"),
+        Json(metadata),
+    )
+
+
+def convert_record(record: dict, to_profile) -> tuple:
+    """(profile, behavioral event row or None) of a Firehose record, profile built by to_profile(event)."""
+    event = decode_event_record(record.get("data", ""))
+    return to_profile(event), build_behavioral_event(event, record.get("approximateArrivalTimestamp"))
+
+
+# Columns hashed into id, as documented on cdp_behavioral_events.id
+EVENT_ID_POSITIONS = [BEHAVIORAL_EVENT_COLUMNS.index(column) for column in (
+    "event_name", "web_visitor_id", "master_profile_id", "created_at", "web_url", "user_agent", "session_id",
+)]
+
+
+def assign_event_ids(rows) -> list:
+    """Set id = sha256 of {event_name, web_visitor_id, master_profile_id, created_at, web_url, user_agent, session_id} for a batch."""
+    keys = ["|".join("" if row[i] is None else str(row[i]) for i in EVENT_ID_POSITIONS) for row in rows]
+    return [(hashlib.sha256(key.encode("utf-8")).hexdigest(),) + row[1:] for key, row in zip(keys, rows)]
+
+
+def save_behavioral_events(rows, db_connection):
+    """Bulk insert event rows in one statement, ignoring the events already stored."""
+    if not rows:
+        return
+    try:
+        with db_connection.cursor() as cursor:
+            execute_values(cursor, sql_insert_behavioral_events, assign_event_ids(rows), page_size=len(rows))
+        db_connection.commit()
+        print(f"✅ [SAVED] save_behavioral_events, commit values: {len(rows)}")
+    except psycopg2.Error:
+        db_connection.rollback()
+        raise
+
+
+def event_visitor_id(row):
+    return row[BEHAVIORAL_EVENT_COLUMNS.index("web_visitor_id")]
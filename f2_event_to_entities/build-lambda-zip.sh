@@ -28,5 +28,8 @@ zip -g $ZIP_NAME db_utils.py > /dev/null
 
 # Add processor.py for domain data processing
 zip -g $ZIP_NAME processor.py > /dev/null
+zip -g $ZIP_NAME pipeline.py > /dev/null
+zip -g $ZIP_NAME field_mapping.py > /dev/null
+zip -g $ZIP_NAME behavioral_events.py > /dev/null
 
 echo "✅ Package built: $ZIP_NAME"
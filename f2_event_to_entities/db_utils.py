@@ -3,6 +3,10 @@ import json
 import os
 import logging
 import base64
+import time
+import random
+import psycopg2
+import psycopg2.errors
 from botocore.exceptions import ClientError, BotoCoreError
 from botocore.config import Config
 
@@ -77,4 +81,133 @@ def get_db_credentials(secret_name=SECRET_NAME, region_name=REGION_NAME):
         raise
     except Exception as e:
         logger.exception("Unexpected error while retrieving DB credentials")
-        raise
\ No newline at end of file
+        raise
+
+def credentials_from_env_or_secret():
+    """Credentials from DB_HOST / DB_NAME / DB_USER / DB_PASS / DB_PORT when DB_HOST is set, else from Secrets Manager (scripts run outside Lambda)."""
+    if os.environ.get("DB_HOST"):
+        return {
+            "DB_HOST": os.environ["DB_HOST"],
+            "DB_NAME": os.environ.get("DB_NAME", "postgres"),
+            "DB_USER": os.environ.get("DB_USER", "postgres"),
+            "DB_PASS": os.environ.get("DB_PASS", ""),
+            "DB_PORT": int(os.environ.get("DB_PORT", "5432")),
+        }
+    return get_db_credentials()
+
+class DatabaseConnectionManager:
+    """
+    One PostgreSQL connection per container, reused across warm invocations.
+
+    The connection is not probed before use: run() executes the operation and, only if it fails
+    with a connection-level error, reconnects (with backoff) and runs it once more, so operations
+    must be idempotent. A deadlock or serialization failure rolls back and reruns the operation on
+    the same connection, a few times with jittered backoff. Every operation ends with commit or
+    rollback and no session state is set, which keeps the connection usable behind transaction-mode
+    poolers (pgbouncer, RDS Proxy).
+    """
+
+    # Transactions worth running again: deadlock_detected (40P01), serialization_failure (40001)
+    RETRYABLE_TRANSACTION_ERRORS = (psycopg2.errors.DeadlockDetected, psycopg2.errors.SerializationFailure)
+
+    def __init__(self, credentials_provider=get_db_credentials, connect_timeout=5,
+                 max_connect_attempts=3, backoff_base_seconds=0.2, max_transaction_retries=3):
+        self.credentials_provider = credentials_provider
+        self.connect_timeout = connect_timeout
+        self.max_connect_attempts = max_connect_attempts
+        self.backoff_base_seconds = backoff_base_seconds
+        self.max_transaction_retries = max_transaction_retries
+        self._credentials = None
+        self._connection = None
+
+    def _connect(self):
+        last_error = None
+        for attempt in range(self.max_connect_attempts):
+            if attempt > 0:
+                time.sleep(self.backoff_base_seconds * (2 ** (attempt - 1)))
+            try:
+                # Re-read the secret after a failed attempt, it may have been rotated
+                if self._credentials is None or attempt > 0:
+                    self._credentials = self.credentials_provider()
+                creds = self._credentials
+                connection = psycopg2.connect(
+                    host=creds["DB_HOST"],
+                    database=creds["DB_NAME"],
+                    user=creds["DB_USER"],
+                    password=creds["DB_PASS"],
+                    port=int(creds.get("DB_PORT", 5432)),
+                    connect_timeout=self.connect_timeout,
+                    # Detect dead TCP connections of frozen containers instead of hanging on them
+                    keepalives=1,
+                    keepalives_idle=30,
+                    keepalives_interval=10,
+                    keepalives_count=3
+                )
+                logger.info(f"✅ [DB CONNECT] Connected to {creds['DB_HOST']}:{creds.get('DB_PORT', 5432)} (attempt {attempt + 1})")
+                return connection
+            except (psycopg2.OperationalError, KeyError) as e:
+                last_error = e
+                logger.warning(f"DB connection attempt {attempt + 1} failed: {e}")
+        raise last_error
+
+    def get_connection(self):
+        """Return the cached connection, opening one if there is none or it was closed."""
+        if self._connection is None or self._connection.closed:
+            self._connection = self._connect()
+        return self._connection
+
+    def invalidate(self):
+        """Drop the cached connection, the next get_connection() reconnects."""
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+        self._connection = None
+
+    @staticmethod
+    def is_connection_error(error, connection) -> bool:
+        """
+        True when the connection itself is gone: it was closed, or the error is in SQLSTATE class 08
+        (connection exception). Other OperationalErrors (QueryCanceled, TransactionRollbackError, ...)
+        are errors of the statement on a live connection.
+        """
+        if not isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+            return False
+        pgcode = getattr(error, "pgcode", None)
+        return bool(connection.closed) or (pgcode is not None and pgcode.startswith("08"))
+
+    def _rollback(self, connection):
+        try:
+            connection.rollback()
+        except psycopg2.Error:
+            self.invalidate()
+
+    def run(self, operation):
+        """
+        Run operation(connection) and return its result. On a connection-level error the connection
+        is replaced and the operation retried once. On a deadlock or serialization failure the
+        operation is retried up to max_transaction_retries times. Other errors are raised.
+        """
+        reconnected = False
+        transaction_retries = 0
+        while True:
+            connection = self.get_connection()
+            try:
+                return operation(connection)
+            except psycopg2.Error as e:
+                if self.is_connection_error(e, connection):
+                    self.invalidate()
+                    if reconnected:
+                        raise
+                    reconnected = True
+                    logger.warning(f"DB connection lost ({e}), reconnecting and retrying")
+                    continue
+                self._rollback(connection)
+                if not isinstance(e, self.RETRYABLE_TRANSACTION_ERRORS) or transaction_retries >= self.max_transaction_retries:
+                    raise
+                transaction_retries += 1
+                # Jitter, so the transactions that deadlocked do not retry in lockstep
+                delay = self.backoff_base_seconds * (2 ** (transaction_retries - 1)) * random.uniform(0.5, 1.5)
+                logger.warning(f"DB transaction aborted ({type(e).__name__}), retry {transaction_retries} in {delay:.2f}s")
+                time.sleep(delay)
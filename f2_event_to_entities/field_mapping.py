@@ -0,0 +1,264 @@
+"""
+Declarative SDK-event-to-row mapping, compiled into one specialized transform function.
+
+The mapping comes from cdp_profile_field_mappings, completed by the ACTIVE attributes of
+cdp_profile_attributes (mapped from the trait of the same name). compile_profile_transform generates
+the Python source of transform(event) for that mapping, with the source keys, defaults, validators
+and the column order of cdp_raw_profiles_stage written inline, and compiles it once per container.
+The transform returns the row tuple loaded by save_profile_rows, which canonicalizes and fingerprints it.
+"""
+import json
+import re
+from datetime import datetime, timezone
+from typing import NamedTuple, Optional
+
+import psycopg2
+from psycopg2.extras import Json
+
+from processor import (
+    RAW_PROFILE_COLUMNS, create_uuid_from_string, decode_event_record, has_string_value,
+    is_valid_basic_phone, is_valid_email, sanitize_input,
+)
+
+
+class FieldMapping(NamedTuple):
+    target_field: str
+    source_keys: tuple                  # priority order; '$.key' reads the event instead of profile_traits
+    value_type: str = "text"            # 'text', 'json' or 'raw'
+    default_value: Optional[str] = None # used when no source key is present (JSON text for 'json')
+    validator: Optional[str] = None
+    fallback: Optional[str] = None
+    storage_type: Optional[str] = None  # 'JSON_FIELD' stores the value in ext_attributes
+
+
+# Same as the seed of sql-scripts/14_profile_field_mapping_table.sql, used when the table does not exist yet
+DEFAULT_FIELD_MAPPINGS = (
+    FieldMapping("tenant_id", ("$.tenant_id",), default_value=""),
+    FieldMapping("source_system", ("usersource", "source_system"), default_value="websdk"),
+    FieldMapping("email", ("email",), validator="email"),
+    FieldMapping("phone_number", ("phone", "phone_number"), validator="phone_basic"),
+    FieldMapping("web_visitor_id", ("$.visid",), fallback="visitor_id_from_key_hint"),
+    FieldMapping("crm_contact_id", ("userid", "crm_contact_id")),
+    FieldMapping("first_name", ("name", "firstname", "first_name")),
+    FieldMapping("last_name", ("lastname", "last_name")),
+    FieldMapping("gender", ("gender",), default_value="unknown"),
+    FieldMapping("date_of_birth", ("birthday", "date_of_birth")),
+    FieldMapping("preferred_communication", ("preferred_communication",), "json", "{}"),
+    FieldMapping("ext_attributes", ("ext_attributes",), "json", "{}"),
+)
+
+# Filled by the transform (received_at, status_code) or by save_profile_rows (name_folded, email_raw, phone_number_raw, profile_fingerprint)
+SYSTEM_COLUMNS = {"received_at", "status_code", "name_folded", "email_raw", "phone_number_raw", "profile_fingerprint"}
+
+sql_load_field_mappings = """
+    SELECT m.target_field, m.source_keys,
+           COALESCE(m.value_type, CASE WHEN upper(a.data_type) IN ('JSON', 'JSONB') THEN 'json' ELSE 'text' END),
+           m.default_value, m.validator, m.fallback, a.storage_type
+    FROM cdp_profile_field_mappings m
+    LEFT JOIN cdp_profile_attributes a ON a.attribute_internal_code = m.target_field
+    WHERE m.status = 'ACTIVE' AND (a.id IS NULL OR a.status = 'ACTIVE')
+    UNION ALL
+    SELECT a.attribute_internal_code, ARRAY[a.attribute_internal_code::TEXT],
+           CASE WHEN upper(a.data_type) IN ('JSON', 'JSONB') THEN 'json' ELSE 'text' END,
+           NULL, NULL, NULL, a.storage_type
+    FROM cdp_profile_attributes a
+    WHERE a.status = 'ACTIVE'
+      AND NOT EXISTS (SELECT 1 FROM cdp_profile_field_mappings m WHERE m.target_field = a.attribute_internal_code)
+"""
+
+
+def load_field_mappings(db_connection) -> tuple:
+    """Read the mapping from PostgreSQL, or DEFAULT_FIELD_MAPPINGS when cdp_profile_field_mappings does not exist."""
+    try:
+        with db_connection.cursor() as cursor:
+            cursor.execute(sql_load_field_mappings)
+            rows = cursor.fetchall()
+        db_connection.commit()
+    except psycopg2.errors.UndefinedTable:
+        db_connection.rollback()
+        print("[WARN] cdp_profile_field_mappings not found, using the default field mapping")
+        return DEFAULT_FIELD_MAPPINGS
+    return tuple(
+        FieldMapping(target, tuple(source_keys), value_type, default_value, validator, fallback, storage_type)
+        for target, source_keys, value_type, default_value, validator, fallback, storage_type in rows
+    )
+
+
+# --- Helpers referenced by the generated code ---
+
+VALIDATORS = {
+    "email": is_valid_email,
+    "phone_basic": is_valid_basic_phone,
+}
+
+
+def visitor_id_from_key_hint(event: dict, traits: dict) -> str:
+    # Data from the CRM or the data lake has no visid: derive a stable one from the identity of the record
+    key_hint = "".join(str(value or "") for value in (
+        event.get("tenant_id"), event.get("observer_id"), event.get("mediahost"), event.get("schema_version"),
+        traits.get("phone_number"), traits.get("email"),
+    ))
+    return str(create_uuid_from_string(key_hint))
+
+
+FALLBACKS = {
+    "visitor_id_from_key_hint": visitor_id_from_key_hint,
+}
+
+# sanitize_input only changes a stripped string that contains one of these characters
+_needs_escape = re.compile(r"[&<>\"']").search
+
+
+def _value_expression(key: str) -> tuple:
+    """(container, key) of a source key: event-level keys start with '$.'."""
+    if key.startswith("$."):
+        return "event", key[2:]
+    return "traits", key
+
+
+def _generate_field(lines: list, var: str, mapping: FieldMapping):
+    for i, key in enumerate(mapping.source_keys):
+        container, name = _value_expression(key)
+        lines.append(f"    {'if' if i == 0 else 'elif'} {name!r} in {container}:")
+        lines.append(f"        {var} = {container}[{name!r}]")
+    default = mapping.default_value if mapping.value_type != "json" else None
+    if mapping.source_keys:
+        lines.append("    else:")
+        lines.append(f"        {var} = {default!r}")
+    else:
+        lines.append(f"    {var} = {default!r}")
+
+    if mapping.validator:
+        if mapping.validator not in VALIDATORS:
+            raise ValueError(f"Unknown validator '{mapping.validator}' for {mapping.target_field}")
+        lines.append(f"    if {var}.__class__ is str and {var}.strip() and not _validators[{mapping.validator!r}]({var}):")
+        lines.append(f"        raise ValueError(f\"Invalid {mapping.target_field}: '{{{var}}}'\")")
+
+    if mapping.fallback:
+        if mapping.fallback not in FALLBACKS:
+            raise ValueError(f"Unknown fallback '{mapping.fallback}' for {mapping.target_field}")
+        lines.append(f"    if not _has_string_value({var}):")
+        lines.append(f"        {var} = _fallbacks[{mapping.fallback!r}](event, traits)")
+
+    if mapping.value_type == "text":
+        # Same result as sanitize_input, which only runs when there is something to escape
+        lines.append(f"    if {var}.__class__ is str:")
+        lines.append(f"        {var} = {var}.strip()")
+        lines.append(f"        if _needs_escape({var}):")
+        lines.append(f"            {var} = _sanitize_input({var})")
+    elif mapping.value_type == "json":
+        if mapping.default_value is not None:
+            lines.append(f"    {var} = _Json({var} or {json.loads(mapping.default_value)!r})")
+        else:
+            lines.append(f"    {var} = _Json({var}) if {var} is not None else None")
+    elif mapping.value_type != "raw":
+        raise ValueError(f"Unknown value_type '{mapping.value_type}' for {mapping.target_field}")
+
+
+def generate_transform_source(mappings) -> str:
+    """Python source of transform(event) -> row tuple in RAW_PROFILE_COLUMNS order, without profile_fingerprint."""
+    by_target = {m.target_field: m for m in mappings}
+    row_columns = [c for c in RAW_PROFILE_COLUMNS if c != "profile_fingerprint"]
+    ext_fields = [
+        m for m in mappings
+        if m.target_field not in SYSTEM_COLUMNS
+        and (m.target_field not in row_columns or m.storage_type == "JSON_FIELD")
+        and m.target_field != "ext_attributes"
+    ]
+
+    lines = [
+        "def transform(event):",
+        "    traits = event.get('profile_traits') or {}",
+    ]
+    row = []
+    for column in row_columns:
+        if column == "received_at":
+            row.append("_now(_utc)")
+            continue
+        if column == "status_code":
+            row.append("1")
+            continue
+        if column in ("name_folded", "email_raw", "phone_number_raw"):
+            row.append("None")
+            continue
+        var = f"v_{column}"
+        mapping = by_target.get(column)
+        if mapping is not None and mapping.storage_type == "JSON_FIELD":
+            # Stored in ext_attributes instead
+            row.append("None")
+            continue
+        if mapping is None:
+            # A column with no mapping is read from the trait of the same name
+            mapping = FieldMapping(column, (column,), "json" if column == "ext_attributes" else "text",
+                                   "{}" if column == "ext_attributes" else None)
+        if column == "ext_attributes" and ext_fields:
+            # Attributes without a column of their own are added to ext_attributes before it is wrapped
+            _generate_field(lines, var, mapping._replace(value_type="raw", default_value=None))
+            lines.append(f"    {var} = dict({var}) if {var} else {{}}")
+            for i, ext in enumerate(ext_fields):
+                ext_var = f"x_{i}"
+                _generate_field(lines, ext_var, ext._replace(value_type="raw") if ext.value_type == "json" else ext)
+                lines.append(f"    if {ext_var} is not None:")
+                lines.append(f"        {var}[{ext.target_field!r}] = {ext_var}")
+            lines.append(f"    {var} = _Json({var})")
+        else:
+            _generate_field(lines, var, mapping)
+        row.append(var)
+
+    lines.append("    return (" + ", ".join(row) + ",)")
+    return "\n".join(lines) + "\n"
+
+
+def compile_profile_transform(mappings):
+    """Compile the mapping into a transform(event) function. Its source is kept in transform.__source__."""
+    source = generate_transform_source(mappings)
+    namespace = {
+        "_now": datetime.now,
+        "_utc": timezone.utc,
+        "_Json": Json,
+        "_has_string_value": has_string_value,
+        "_needs_escape": _needs_escape,
+        "_sanitize_input": sanitize_input,
+        "_validators": VALIDATORS,
+        "_fallbacks": FALLBACKS,
+    }
+    exec(compile(source, "<profile_transform>", "exec"), namespace)
+    transform = namespace["transform"]
+    transform.__source__ = source
+    return transform
+
+
+# --- Transform of the container, compiled once ---
+
+_profile_transform = None
+_profile_mappings = None
+
+
+def install_profile_transform(mappings):
+    """Compile and install the transform of mappings. Also the initializer of the process pool workers."""
+    global _profile_transform, _profile_mappings
+    _profile_transform = compile_profile_transform(mappings)
+    _profile_mappings = tuple(mappings)
+    print(f"✅ [FIELD MAPPING] compiled transform for {len(mappings)} mapped fields")
+    return _profile_transform
+
+
+def get_profile_transform():
+    return _profile_transform
+
+
+def get_profile_mappings():
+    """Mappings of the installed transform, None before install_profile_transform."""
+    return _profile_mappings
+
+
+def transform_event(event: dict) -> tuple:
+    """Transform a decoded event into a row for save_profile_rows."""
+    if _profile_transform is None:
+        raise RuntimeError("❌ Field mapping is not compiled, call install_profile_transform first")
+    return _profile_transform(event)
+
+
+def convert_event_to_row(record_data: str) -> tuple:
+    """Decode a Firehose record and transform it into a row for save_profile_rows."""
+    return transform_event(decode_event_record(record_data))
@@ -1,60 +1,89 @@
 import base64
 import json
 import os
-import psycopg2
-import socket
-from processor import convert_event_to_profile, save_to_postgresql
+from functools import partial
+from processor import convert_event_to_profile, event_to_profile, save_to_postgresql, save_profile_rows, save_with_failure_isolation
+from pipeline import convert_record_data, process_records_pipelined
+import behavioral_events
+import field_mapping
 
 
-# --- load db_credentials ---
+# --- Database connection, reused across warm invocations ---
 import db_utils
-db_credentials = db_utils.get_db_credentials()
-DB_HOST = db_credentials.get("DB_HOST")
-DB_NAME = db_credentials.get("DB_NAME")
-DB_USER = db_credentials.get("DB_USER")
-DB_PASS = db_credentials.get("DB_PASS")
-DB_PORT = int(db_credentials.get("DB_PORT", "5432"))
+db_manager = db_utils.DatabaseConnectionManager()
 
 # batch size to commit
 C360_RAW_PROFILE_BATCH_SIZE = int(os.environ.get("C360_RAW_PROFILE_BATCH_SIZE", "150"))   
 
+# pipelined mode: decode/transform chunks of records on a worker pool while the previous batch is saved (0 = serial)
+C360_RAW_PROFILE_DECODE_WORKERS = int(os.environ.get("C360_RAW_PROFILE_DECODE_WORKERS", "0"))
+C360_RAW_PROFILE_DECODE_CHUNK_SIZE = int(os.environ.get("C360_RAW_PROFILE_DECODE_CHUNK_SIZE", "250"))
+C360_RAW_PROFILE_DECODE_POOL = os.environ.get("C360_RAW_PROFILE_DECODE_POOL", "thread").lower()  # 'thread' or 'process'
+
+# field mapping: 'legacy' (convert_event_to_profile + save_to_postgresql) or 'compiled' (cdp_profile_field_mappings
+# compiled at cold start into one transform that emits the rows to load)
+C360_FIELD_MAPPING_ENGINE = os.environ.get("C360_FIELD_MAPPING_ENGINE", "legacy").lower()
+
+def use_compiled_field_mapping() -> bool:
+    """Compile the field mapping on the first invocation of the container. Returns True when it is in use."""
+    if C360_FIELD_MAPPING_ENGINE != "compiled":
+        return False
+    if field_mapping.get_profile_transform() is None:
+        field_mapping.install_profile_transform(db_manager.run(field_mapping.load_field_mappings))
+    return True
+
+# also write the behavioral part of every event (metric, tpurl, utmdata, ...) to cdp_behavioral_events
+C360_BEHAVIORAL_EVENTS_ENABLED = os.environ.get("C360_BEHAVIORAL_EVENTS_ENABLED", "false").lower() == "true"
+
+def get_record_converter(compiled: bool):
+    """Function converting a Firehose record into what save_profiles_batch takes."""
+    # a partial of module-level functions can be sent to a process pool
+    if C360_BEHAVIORAL_EVENTS_ENABLED:
+        return partial(behavioral_events.convert_record,
+                       to_profile=field_mapping.transform_event if compiled else event_to_profile)
+    return partial(convert_record_data, convert=field_mapping.convert_event_to_row if compiled else convert_event_to_profile)
+
+def save_profiles_batch(profiles) -> list:
+    """
+    Save a batch of profiles, isolating the rows rejected by the database. Returns their positions in the batch.
+    With C360_BEHAVIORAL_EVENTS_ENABLED, the batch holds (profile, event row) pairs and the event rows are
+    inserted with one more statement after the profiles.
+    """
+    save = save_profile_rows if C360_FIELD_MAPPING_ENGINE == "compiled" else save_to_postgresql
+    if not C360_BEHAVIORAL_EVENTS_ENABLED:
+        return save_with_failure_isolation(
+            profiles, lambda batch: db_manager.run(lambda db_connection: save(batch, db_connection))
+        )
+
+    failed_positions = save_with_failure_isolation(
+        [profile for profile, _ in profiles], lambda batch: db_manager.run(lambda db_connection: save(batch, db_connection))
+    )
+    event_positions = [position for position, (_, event_row) in enumerate(profiles) if event_row is not None]
+    if event_positions:
+        failed_events = save_with_failure_isolation(
+            [profiles[position][1] for position in event_positions],
+            lambda batch: db_manager.run(lambda db_connection: behavioral_events.save_behavioral_events(batch, db_connection)),
+            describe=behavioral_events.event_visitor_id,
+        )
+        failed_positions = sorted(set(failed_positions) | {event_positions[i] for i in failed_events})
+    return failed_positions
+
+def mark_failed_records(output, output_positions, failed_positions):
+    for position in failed_positions:
+        output[output_positions[position]]["result"] = "ProcessingFailed"
+
 def lambda_handler(event, context):
     print("🔥 [START] Lambda triggered. Using version 2025.05.15 10h")
-    
-    # --- Validate Configuration ---
-    missing_env = [var for var in ["DB_HOST", "DB_NAME", "DB_USER", "DB_PASS"] if not db_credentials.get(var)]
-    if missing_env:
-        print(f"[CONFIG ERROR] Missing environment variables: {missing_env}")
-        return {
-            "records": [
-                {"recordId": r['recordId'], "result": "ProcessingFailed", "data": r['data']}
-                for r in records
-            ]
-        }
 
     records = event.get("records", [])
-    db_connection = None
-    
-    # --- Check Reachability & Connect ---
+
+    # --- Connect (only when there is no live connection from a previous invocation) ---
     try:
-        print(f"[DEBUG] Attempting to reach DB at {DB_HOST}:{DB_PORT}")
-        socket.create_connection((DB_HOST, DB_PORT), timeout=3)
-        print(f"✅ [REACHABLE] Host {DB_HOST}:{DB_PORT} is reachable")
-
-        db_connection = psycopg2.connect(
-            host=DB_HOST,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASS,
-            port=DB_PORT,
-            connect_timeout=5
-        )
-        with db_connection.cursor() as cursor:
-            cursor.execute("SELECT 1;")
-            _ = cursor.fetchone()
-        print("✅ [DB CONNECT] Connection and health check successful.")
+        db_manager.get_connection()
+        compiled = use_compiled_field_mapping()
+        convert = get_record_converter(compiled)
     except Exception as e:
-        print(f"[FATAL] Database connection or health check failed: {str(e)}")
+        print(f"[FATAL] Database connection failed: {str(e)}")
         return {
             "records": [
                 {"recordId": r['recordId'], "result": "ProcessingFailed", "data": r['data']}
@@ -62,33 +91,29 @@ def lambda_handler(event, context):
             ]
         }
 
+    if C360_RAW_PROFILE_DECODE_WORKERS > 0:
+        output = process_records_pipelined(
+            records, save_profiles_batch, C360_RAW_PROFILE_BATCH_SIZE,
+            C360_RAW_PROFILE_DECODE_WORKERS, C360_RAW_PROFILE_DECODE_CHUNK_SIZE, C360_RAW_PROFILE_DECODE_POOL,
+            convert=convert,
+            # worker processes compile the same mapping, they do not inherit it under spawn / forkserver
+            initializer=field_mapping.install_profile_transform if compiled else None,
+            initargs=(field_mapping.get_profile_mappings(),) if compiled else ()
+        )
+        print(f"✅ [COMPLETE] Processed {len(output)} records (pipelined).")
+        return {"records": output}
 
     # --- Process Each Record ---
     valid_profiles = []
+    valid_positions = []  # position in output of the record of each valid profile
     output = []
     for record in records:
         record_id = record.get("recordId", "N/A")
-        record_data = record.get("data", "") 
         print(f"✨ [PROCESSING] Record ID: {record_id}")
 
         try:
-            # event to profile
-            profile = convert_event_to_profile(record_data)
-            
-            # only save valid profiles
-            valid_profiles.append(profile) 
-            if len(valid_profiles) >= C360_RAW_PROFILE_BATCH_SIZE:
-                 # --- Save batch to PostgreSQL ---
-                save_to_postgresql(valid_profiles, db_connection)
-                # reset batch 
-                valid_profiles = []
-             
-            # "Ok" (processed successfully)
-            output.append({
-                "recordId": record_id,
-                "result": "Ok",
-                "data": record["data"]
-            })
+            # event to profile (a row tuple with the compiled field mapping)
+            profile = convert(record)
         except Exception as e:
             print(f"[ERROR] Record ID {record_id} failed: {str(e)}")
             # "Dropped" (discard this record)
@@ -97,18 +122,29 @@ def lambda_handler(event, context):
                 "result": "Dropped",
                 "data": record["data"]
             })
+            continue
+
+        # only save valid profiles; "Ok" unless the database rejects the row
+        valid_profiles.append(profile)
+        valid_positions.append(len(output))
+        output.append({
+            "recordId": record_id,
+            "result": "Ok",
+            "data": record["data"]
+        })
+
+        if len(valid_profiles) >= C360_RAW_PROFILE_BATCH_SIZE:
+            # --- Save batch to PostgreSQL ---
+            mark_failed_records(output, valid_positions, save_profiles_batch(valid_profiles))
+            # reset batch 
+            valid_profiles = []
+            valid_positions = []
 
     # check and flush all to PostgreSQL
     if len(valid_profiles) > 0:        
-        save_to_postgresql(valid_profiles, db_connection)
+        mark_failed_records(output, valid_positions, save_profiles_batch(valid_profiles))
 
-    # --- Close Connection ---
-    if db_connection:
-        try:
-            db_connection.close()
-            print("✅ [DB CLOSED] Connection closed cleanly.")
-        except Exception as e:
-            print(f"[WARN] Error while closing DB connection: {str(e)}")
+    # The connection stays open for the next warm invocation
 
     print(f"✅ [COMPLETE] Processed {len(output)} records.")
     return {"records": output}
\ No newline at end of file
@@ -0,0 +1,91 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from processor import convert_event_to_profile
+
+
+def convert_record_data(record: dict, convert=convert_event_to_profile):
+    """Convert the data of a Firehose record with convert(data)."""
+    return convert(record.get("data", ""))
+
+
+def transform_chunk(chunk, convert=convert_record_data):
+    """Decode and convert a chunk of Firehose records. Returns (profile, None) or (None, error) per record, in order."""
+    results = []
+    for record in chunk:
+        try:
+            results.append((convert(record), None))
+        except Exception as e:
+            results.append((None, str(e)))
+    return results
+
+
+def create_pool(kind: str, workers: int, initializer=None, initargs=()):
+    """
+    Process pool for CPU-bound transforms, or thread pool where processes are not available.
+    initializer(*initargs) runs in every worker process: state installed at runtime in the parent
+    is not inherited under the spawn and forkserver start methods. Threads share it already.
+    """
+    if kind == "process":
+        try:
+            return ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs)
+        except OSError as e:
+            # AWS Lambda has no /dev/shm, which multiprocessing queues need
+            print(f"[WARN] Process pool not available ({e}), using threads")
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="f2-transform")
+
+
+def process_records_pipelined(records, save_batch, batch_size: int, workers: int, chunk_size: int, pool_kind: str = "thread",
+                              convert=convert_record_data, initializer=None, initargs=()):
+    """
+    Transform records in chunks on a worker pool while a single writer thread saves the previous batch.
+
+    Chunk results are consumed in submission order, so the output keeps the Firehose recordId order
+    with one Ok/Dropped result per record. save_batch(profiles) returns the positions of the profiles the
+    database rejected, their records are reported as ProcessingFailed. Only one save is in flight at a
+    time, since the batches share one database connection. Other save errors are raised.
+    convert(record) turns one Firehose record into what save_batch takes: a profile dict, or a row of the
+    compiled field mapping. It must be a module-level function (or a partial of one) when pool_kind is 'process',
+    and the state it needs in the worker processes is set up by initializer(*initargs).
+    """
+    output = []
+    pending_profiles = []
+    pending_positions = []
+    write_future = None
+    write_positions = None
+
+    def wait_for_write():
+        if write_future is not None:
+            for position in write_future.result():
+                output[write_positions[position]]["result"] = "ProcessingFailed"
+
+    def submit_write(batch, positions):
+        nonlocal write_future, write_positions
+        wait_for_write()
+        write_future = writer.submit(save_batch, batch)
+        write_positions = positions
+
+    chunk_starts = range(0, len(records), chunk_size)
+    with create_pool(pool_kind, workers, initializer, initargs) as pool, ThreadPoolExecutor(max_workers=1, thread_name_prefix="f2-db-writer") as writer:
+        futures = [
+            pool.submit(transform_chunk, records[start:start + chunk_size], convert)
+            for start in chunk_starts
+        ]
+        for start, future in zip(chunk_starts, futures):
+            for record, (profile, error) in zip(records[start:start + chunk_size], future.result()):
+                record_id = record.get("recordId", "N/A")
+                if error is not None:
+                    print(f"[ERROR] Record ID {record_id} failed: {error}")
+                    output.append({"recordId": record_id, "result": "Dropped", "data": record["data"]})
+                    continue
+                pending_profiles.append(profile)
+                pending_positions.append(len(output))
+                output.append({"recordId": record_id, "result": "Ok", "data": record["data"]})
+                if len(pending_profiles) >= batch_size:
+                    submit_write(pending_profiles, pending_positions)
+                    pending_profiles, pending_positions = [], []
+
+        if pending_profiles:
+            submit_write(pending_profiles, pending_positions)
+        wait_for_write()
+
+    return output
@@ -5,28 +5,41 @@ from botocore.exceptions import ClientError
 import phonenumbers
 import psycopg2
 from psycopg2.extras import execute_values, Json
+import hashlib
 import html
+import io
+import os
 import re
 import json
+import unicodedata
 from datetime import datetime, timezone
+from functools import lru_cache
 import uuid
+from unidecode import unidecode
 
 
-# convert event to profile, event is from queue
-def convert_event_to_profile(record_data:str):
+# decode the event of a Firehose record
+def decode_event_record(record_data:str) -> dict:
     decoded_bytes = base64.b64decode(record_data)
     decoded_str = decoded_bytes.decode('utf-8')
     
     # build json event_data
-    event_data = json.loads(decoded_str)
-    
+    return json.loads(decoded_str)
+
+
+# convert event to profile, event is from queue
+def convert_event_to_profile(record_data:str):
+    return event_to_profile(decode_event_record(record_data))
+
+
+def event_to_profile(event_data:dict):
     tenant_id = event_data.get("tenant_id",'')
     observer_id = event_data.get("observer_id",'')
     mediahost = event_data.get("mediahost",'')
     schema_version = event_data.get("schema_version",'')
     
     web_visitor_id = event_data.get("visid")
-    profile = event_data.get("profile_traits", {})
+    profile = dict(event_data.get("profile_traits") or {})
     profile["tenant_id"] = tenant_id         
     
     # if event has phone_number, check for valid phone_number  
@@ -183,10 +196,57 @@ def validate_phone_number(phone_number_str):
 
 
 
+# --- Canonical forms of identifiers, so that exact identity resolution is a btree equality ---
+
+# Region of the phone numbers written without a country code
+C360_PHONE_DEFAULT_REGION = os.environ.get("C360_PHONE_DEFAULT_REGION", "VN")
+# Canonicalize phone_number / email (keeping the values as sent in email_raw / phone_number_raw) and fill name_folded before saving
+C360_CANONICALIZE_IDENTIFIERS = os.environ.get("C360_CANONICALIZE_IDENTIFIERS", "true").lower() == "true"
+# Distinct values remembered by each canonicalization function (the same visitors come back batch after batch)
+C360_CANONICAL_CACHE_SIZE = int(os.environ.get("C360_CANONICAL_CACHE_SIZE", "65536"))
+
+
+@lru_cache(maxsize=C360_CANONICAL_CACHE_SIZE)
+def canonical_phone_number(phone_number: str) -> str:
+    """
+    E.164 form of a phone number, e.g. '0901234567' -> '+84901234567' with the default region VN.
+    A number phonenumbers cannot parse as a possible number is returned stripped but otherwise unchanged.
+    """
+    phone_number = phone_number.strip()
+    try:
+        parsed_number = phonenumbers.parse(phone_number, C360_PHONE_DEFAULT_REGION)
+    except phonenumbers.phonenumberutil.NumberParseException:
+        return phone_number
+    if not phonenumbers.is_possible_number(parsed_number):
+        return phone_number
+    return phonenumbers.format_number(parsed_number, phonenumbers.PhoneNumberFormat.E164)
+
+
+@lru_cache(maxsize=C360_CANONICAL_CACHE_SIZE)
+def canonical_email(email: str) -> str:
+    """Trimmed, NFKC-normalized and lowercased email."""
+    return unicodedata.normalize("NFKC", email).strip().lower()
+
+
+@lru_cache(maxsize=C360_CANONICAL_CACHE_SIZE)
+def fold_name(name: str) -> str:
+    """Lowercased name without diacritics and repeated spaces, e.g. 'Nguyễn  Văn Đức' -> 'nguyen van duc'."""
+    return " ".join(unidecode(name).lower().split())
+
+
+def folded_full_name(first_name, last_name):
+    """name_folded of a row: 'first_name last_name' folded from the unescaped column values, None without a name."""
+    full_name = " ".join(name for name in (first_name, last_name) if name.__class__ is str and name)
+    return fold_name(html.unescape(full_name)) or None
+
+
+
 ################# SQL to upsert profile #################
 
-sql_upsert_profile = """
-    INSERT INTO public.cdp_raw_profiles_stage (
+# Write engine of save_to_postgresql: 'execute_values' (multi-row INSERT) or 'copy' (COPY into a staging table + one merge)
+C360_RAW_PROFILE_WRITE_ENGINE = os.environ.get("C360_RAW_PROFILE_WRITE_ENGINE", "execute_values").lower()
+
+sql_raw_profile_columns = """
         tenant_id, source_system, received_at, status_code,
         email, phone_number, web_visitor_id, crm_contact_id, crm_source_id, social_user_id,
         first_name, last_name, gender, date_of_birth,
@@ -195,13 +255,30 @@ sql_upsert_profile = """
         preferred_language, preferred_currency, preferred_communication,
         last_seen_at, last_seen_observer_id, last_seen_touchpoint_id,
         last_seen_touchpoint_url, last_known_channel,
-        ext_attributes
-    )
-    VALUES %s -- the list of tuples
+        ext_attributes, name_folded, email_raw, phone_number_raw, profile_fingerprint
+"""
+RAW_PROFILE_COLUMNS = [column.strip() for column in sql_raw_profile_columns.split(",")]
+
+# Activity fields that change on every event: left out of the fingerprint, so a returning visitor
+# with the same identity and traits only gets its activity columns refreshed, and is not re-queued for identity resolution
+PROFILE_FINGERPRINT_EXCLUDED_COLUMNS = {
+    "received_at", "status_code", "profile_fingerprint", "name_folded", "email_raw", "phone_number_raw",
+    "last_seen_at", "last_seen_observer_id", "last_seen_touchpoint_id", "last_seen_touchpoint_url", "last_known_channel",
+}
+
+# Equal fingerprints mean equal traits, so the trait columns can always be set from EXCLUDED; only received_at
+# and status_code (re-queue for identity resolution) depend on the fingerprint. Exact replays are skipped.
+sql_upsert_profile_on_conflict = """
     ON CONFLICT (tenant_id, web_visitor_id) DO UPDATE SET
         source_system = EXCLUDED.source_system,
-        received_at = NOW(), -- Or EXCLUDED.received_at if you want to keep the original time on conflict
-        status_code = 1, -- Or EXCLUDED.status_code
+        received_at = CASE
+            WHEN cdp_raw_profiles_stage.profile_fingerprint IS DISTINCT FROM EXCLUDED.profile_fingerprint THEN NOW()
+            ELSE cdp_raw_profiles_stage.received_at
+        END,
+        status_code = CASE
+            WHEN cdp_raw_profiles_stage.profile_fingerprint IS DISTINCT FROM EXCLUDED.profile_fingerprint THEN 1
+            ELSE cdp_raw_profiles_stage.status_code
+        END,
         email = EXCLUDED.email,
         phone_number = EXCLUDED.phone_number,
         crm_contact_id = EXCLUDED.crm_contact_id,
@@ -227,78 +304,247 @@ sql_upsert_profile = """
         last_seen_touchpoint_id = EXCLUDED.last_seen_touchpoint_id,
         last_seen_touchpoint_url = EXCLUDED.last_seen_touchpoint_url,
         last_known_channel = EXCLUDED.last_known_channel,
-        ext_attributes = EXCLUDED.ext_attributes;
+        ext_attributes = EXCLUDED.ext_attributes,
+        name_folded = EXCLUDED.name_folded,
+        email_raw = EXCLUDED.email_raw,
+        phone_number_raw = EXCLUDED.phone_number_raw,
+        profile_fingerprint = EXCLUDED.profile_fingerprint
+    WHERE cdp_raw_profiles_stage.profile_fingerprint IS DISTINCT FROM EXCLUDED.profile_fingerprint
+       OR (cdp_raw_profiles_stage.last_seen_at, cdp_raw_profiles_stage.last_seen_observer_id,
+           cdp_raw_profiles_stage.last_seen_touchpoint_id, cdp_raw_profiles_stage.last_seen_touchpoint_url,
+           cdp_raw_profiles_stage.last_known_channel)
+          IS DISTINCT FROM
+          (EXCLUDED.last_seen_at, EXCLUDED.last_seen_observer_id,
+           EXCLUDED.last_seen_touchpoint_id, EXCLUDED.last_seen_touchpoint_url,
+           EXCLUDED.last_known_channel);
 """
 
-def save_to_postgresql(profiles, db_connection):
+sql_upsert_profile = f"""
+    INSERT INTO public.cdp_raw_profiles_stage ({sql_raw_profile_columns})
+    VALUES %s -- the list of tuples
+    {sql_upsert_profile_on_conflict}"""
+
+# COPY engine: the batch is streamed into a temp table created and dropped in the same transaction
+# (no session state, so it also works through transaction-mode poolers), then merged in one statement
+sql_create_profile_load_table = f"""
+    CREATE TEMP TABLE tmp_raw_profiles_load ON COMMIT DROP AS
+    SELECT {sql_raw_profile_columns}
+    FROM public.cdp_raw_profiles_stage
+    WITH NO DATA;
+"""
+
+sql_copy_profile_load_table = f"COPY tmp_raw_profiles_load ({sql_raw_profile_columns}) FROM STDIN"
+
+sql_merge_profile_load_table = f"""
+    INSERT INTO public.cdp_raw_profiles_stage ({sql_raw_profile_columns})
+    SELECT {sql_raw_profile_columns} FROM tmp_raw_profiles_load
+    {sql_upsert_profile_on_conflict}"""
+
+# Characters escaped in COPY text format
+COPY_TEXT_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+def _copy_text_value(value) -> str:
+    if value is None:
+        return "\\N"
+    if isinstance(value, Json):
+        value = json.dumps(value.adapted)
+    elif isinstance(value, datetime):
+        value = value.isoformat()
+    return str(value).translate(COPY_TEXT_ESCAPES)
+
+def compute_profile_fingerprint(row) -> str:
+    """Hash of the identity and trait columns of a raw profile row (in RAW_PROFILE_COLUMNS order)."""
+    content = [
+        value.adapted if isinstance(value, Json) else value
+        for column, value in zip(RAW_PROFILE_COLUMNS, row)
+        if column not in PROFILE_FINGERPRINT_EXCLUDED_COLUMNS
+    ]
+    encoded = json.dumps(content, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.blake2b(encoded.encode("utf-8"), digest_size=16).hexdigest()
+
+def write_profiles_execute_values(cursor, values):
+    execute_values(cursor, sql_upsert_profile, values)
+
+def write_profiles_copy(cursor, values):
+    buffer = io.StringIO()
+    for row in values:
+        buffer.write("\t".join(_copy_text_value(v) for v in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    cursor.execute(sql_create_profile_load_table)
+    cursor.copy_expert(sql_copy_profile_load_table, buffer)
+    cursor.execute(sql_merge_profile_load_table)
+
+PROFILE_WRITE_ENGINES = {
+    "execute_values": write_profiles_execute_values,
+    "copy": write_profiles_copy,
+}
+
+# Positions in a row of cdp_raw_profiles_stage
+ROW_TENANT_ID = RAW_PROFILE_COLUMNS.index("tenant_id")
+ROW_WEB_VISITOR_ID = RAW_PROFILE_COLUMNS.index("web_visitor_id")
+ROW_EMAIL = RAW_PROFILE_COLUMNS.index("email")
+ROW_PHONE_NUMBER = RAW_PROFILE_COLUMNS.index("phone_number")
+ROW_FIRST_NAME = RAW_PROFILE_COLUMNS.index("first_name")
+ROW_LAST_NAME = RAW_PROFILE_COLUMNS.index("last_name")
+ROW_NAME_FOLDED = RAW_PROFILE_COLUMNS.index("name_folded")
+ROW_EMAIL_RAW = RAW_PROFILE_COLUMNS.index("email_raw")
+ROW_PHONE_NUMBER_RAW = RAW_PROFILE_COLUMNS.index("phone_number_raw")
+
+def build_profile_row(profile) -> tuple:
+    """
+    Row of a profile dict in RAW_PROFILE_COLUMNS order, without profile_fingerprint.
+    name_folded, email_raw and phone_number_raw are left empty for canonicalize_profile_rows.
+    """
+    # received_at must be the value of system time UTC
+    received_at = datetime.now(timezone.utc)
+    status_code = 1
+    row = (
+        sanitize_input(profile.get("tenant_id")),
+        sanitize_input(profile.get("source_system","websdk")),
+        received_at,  
+        status_code, 
+        sanitize_input(profile.get("email")),
+        sanitize_input(profile.get("phone_number")),
+        sanitize_input(profile.get("web_visitor_id")),
+        sanitize_input(profile.get("crm_contact_id")),
+        sanitize_input(profile.get("crm_source_id")),
+        sanitize_input(profile.get("social_user_id")),
+        sanitize_input(profile.get("first_name")),
+        sanitize_input(profile.get("last_name")),
+        sanitize_input(profile.get("gender","unknown")),
+        sanitize_input(profile.get("date_of_birth")),
+        sanitize_input(profile.get("address_line1")),
+        sanitize_input(profile.get("address_line2")),
+        sanitize_input(profile.get("city")),
+        sanitize_input(profile.get("state")),
+        sanitize_input(profile.get("zip_code")),
+        sanitize_input(profile.get("country")),
+        sanitize_input(profile.get("latitude")),
+        sanitize_input(profile.get("longitude")),
+        sanitize_input(profile.get("preferred_language")),
+        sanitize_input(profile.get("preferred_currency")),
+        Json(profile.get("preferred_communication") or {}),
+        sanitize_input(profile.get("last_seen_at")),
+        sanitize_input(profile.get("last_seen_observer_id")),
+        sanitize_input(profile.get("last_seen_touchpoint_id")),
+        sanitize_input(profile.get("last_seen_touchpoint_url")),
+        sanitize_input(profile.get("last_known_channel")),
+        Json(profile.get("ext_attributes") or {}),
+        None,
+        None,
+        None,
+    )
+    return row
+
+def save_to_postgresql(profiles, db_connection, write_engine=None):
     if not profiles:
         raise RuntimeError("❌ profiles is null or empty")
+
+    deduped_profiles = {}
+    for profile in profiles:
+        tenant_id = profile.get("tenant_id")
+        web_visitor_id = profile.get("web_visitor_id")
+        if not tenant_id or not web_visitor_id:
+            continue
+        key = (tenant_id.strip(), web_visitor_id.strip())
+        deduped_profiles[key] = profile  # Only keep the last occurrence
+
+    rows = []
+    for profile in deduped_profiles.values():
+        rows.append(build_profile_row(profile))
+        print(f"✅ [PROFILE] is ready to save with phone_number {profile.get('phone_number')} email {profile.get('email')}")
+
+    save_profile_rows(rows, db_connection, write_engine)
+
+def _canonical_values(rows, position, canonicalize) -> dict:
+    values = {row[position] for row in rows}
+    return {value: canonicalize(value) for value in values if value.__class__ is str and value}
+
+def canonicalize_profile_rows(rows) -> list:
+    """
+    Batched canonicalization stage: phone_number in E.164, email lowercased and name_folded from
+    first_name + last_name. Each distinct value of the batch is canonicalized once (and memoized
+    across batches), then the rows are rebuilt with the canonical forms. The values as sent are kept
+    in phone_number_raw / email_raw, and names are folded from their unescaped text, not from the
+    HTML-escaped column value.
+    """
+    phone_numbers = _canonical_values(rows, ROW_PHONE_NUMBER, canonical_phone_number)
+    emails = _canonical_values(rows, ROW_EMAIL, canonical_email)
+    canonical_rows = []
+    for row in rows:
+        row = list(row)
+        row[ROW_PHONE_NUMBER_RAW] = row[ROW_PHONE_NUMBER]
+        row[ROW_EMAIL_RAW] = row[ROW_EMAIL]
+        row[ROW_PHONE_NUMBER] = phone_numbers.get(row[ROW_PHONE_NUMBER], row[ROW_PHONE_NUMBER])
+        row[ROW_EMAIL] = emails.get(row[ROW_EMAIL], row[ROW_EMAIL])
+        row[ROW_NAME_FOLDED] = folded_full_name(row[ROW_FIRST_NAME], row[ROW_LAST_NAME])
+        canonical_rows.append(tuple(row))
+    return canonical_rows
+
+def save_profile_rows(rows, db_connection, write_engine=None):
+    """
+    Upsert rows built by build_profile_row or by the compiled field mapping, keeping the last row of each
+    visitor. The rows are canonicalized (C360_CANONICALIZE_IDENTIFIERS) and fingerprinted here.
+    """
+    if not rows:
+        raise RuntimeError("❌ rows is null or empty")
     
     if not isinstance(db_connection, psycopg2.extensions.connection):
         raise RuntimeError("❌ Failed to connect to PostgreSQL")
 
     try:
-        deduped_profiles = {}
-        for profile in profiles:
-            tenant_id = profile.get("tenant_id")
-            web_visitor_id = profile.get("web_visitor_id")
+        deduped_rows = {}
+        for row in rows:
+            tenant_id = row[ROW_TENANT_ID]
+            web_visitor_id = row[ROW_WEB_VISITOR_ID]
             if not tenant_id or not web_visitor_id:
                 continue
-            key = (tenant_id.strip(), web_visitor_id.strip())
-            deduped_profiles[key] = profile  # Only keep the last occurrence
-
-        values = []
-        for key, profile in deduped_profiles.items():
-            
-            # received_at must be the value of system time UTC
-            received_at = datetime.now(timezone.utc)
-            status_code = 1
-            email = profile.get("email")
-            phone_number = profile.get("phone_number")            
-            
-            values.append((
-                sanitize_input(profile.get("tenant_id")),
-                sanitize_input(profile.get("source_system","websdk")),
-                received_at,  
-                status_code, 
-                sanitize_input(email),
-                sanitize_input(phone_number),
-                sanitize_input(profile.get("web_visitor_id")),
-                sanitize_input(profile.get("crm_contact_id")),
-                sanitize_input(profile.get("crm_source_id")),
-                sanitize_input(profile.get("social_user_id")),
-                sanitize_input(profile.get("first_name")),
-                sanitize_input(profile.get("last_name")),
-                sanitize_input(profile.get("gender","unknown")),
-                sanitize_input(profile.get("date_of_birth")),
-                sanitize_input(profile.get("address_line1")),
-                sanitize_input(profile.get("address_line2")),
-                sanitize_input(profile.get("city")),
-                sanitize_input(profile.get("state")),
-                sanitize_input(profile.get("zip_code")),
-                sanitize_input(profile.get("country")),
-                sanitize_input(profile.get("latitude")),
-                sanitize_input(profile.get("longitude")),
-                sanitize_input(profile.get("preferred_language")),
-                sanitize_input(profile.get("preferred_currency")),
-                Json(profile.get("preferred_communication") or {}),
-                sanitize_input(profile.get("last_seen_at")),
-                sanitize_input(profile.get("last_seen_observer_id")),
-                sanitize_input(profile.get("last_seen_touchpoint_id")),
-                sanitize_input(profile.get("last_seen_touchpoint_url")),
-                sanitize_input(profile.get("last_known_channel")),
-                Json(profile.get("ext_attributes") or {})
-            ))
-            print(f"✅ [PROFILE] is ready to save with phone_number {phone_number} email {email}")
+            deduped_rows[(tenant_id, web_visitor_id)] = row  # Only keep the last occurrence
+        values = list(deduped_rows.values())
+        if C360_CANONICALIZE_IDENTIFIERS:
+            values = canonicalize_profile_rows(values)
+        values = [row + (compute_profile_fingerprint(row),) for row in values]
 
         if values:
+            engine = write_engine or C360_RAW_PROFILE_WRITE_ENGINE
             with db_connection.cursor() as cursor:
-                execute_values(cursor, sql_upsert_profile, values)
+                PROFILE_WRITE_ENGINES[engine](cursor, values)
             db_connection.commit()
-            print(f"✅ [SAVED] save_to_postgresql, commit values: {len(values)}")
+            print(f"✅ [SAVED] save_profile_rows ({engine}), commit values: {len(values)}")
 
     except psycopg2.Error as db_error:
         db_connection.rollback()
         raise db_error
     except Exception as e:
-        raise e
\ No newline at end of file
+        raise e
+
+
+def profile_visitor_id(profile):
+    """web_visitor_id of a profile dict or of a row tuple."""
+    return profile.get("web_visitor_id") if isinstance(profile, dict) else profile[ROW_WEB_VISITOR_ID]
+
+def save_with_failure_isolation(profiles, save_batch, describe=profile_visitor_id):
+    """
+    Save profiles with save_batch(profiles). When the database rejects a batch because of its data
+    (CHECK, NOT NULL, value too long, ...), the batch is split in halves and each half retried, so the
+    offending rows are isolated in O(log n) sub-batches per bad row and all the others are committed.
+    Returns the positions (in profiles) of the rows that could not be saved. Other errors are raised.
+    describe(row) names a rejected row in the log.
+    """
+    failed_positions = []
+    pending = [(0, len(profiles))]
+    while pending:
+        start, end = pending.pop()
+        try:
+            save_batch(profiles[start:end])
+        except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+            if end - start == 1:
+                print(f"[ERROR] Row rejected by the database (web_visitor_id {describe(profiles[start])}): {e}")
+                failed_positions.append(start)
+                continue
+            middle = (start + end) // 2
+            # Left half first, to keep the write order
+            pending.append((middle, end))
+            pending.append((start, middle))
+    return failed_positions
@@ -14,7 +14,7 @@ CREATE TABLE cdp_raw_profiles_stage (
 
     -- core ID fields for identity resolution 
     email citext, -- Sử dụng kiểu citext cho email để tìm kiếm không phân biệt chữ hoa/thường
-    phone_number VARCHAR(50), -- Cần chuẩn hóa số điện thoại trước hoặc trong quá trình xử lý   
+    phone_number VARCHAR(50), -- Dạng E.164 (vd: '+84901234567'), F2 chuẩn hóa trước khi lưu   
     web_visitor_id VARCHAR(36), -- Web Visitor ID (từ cookie hoặc tracking script)
     crm_contact_id VARCHAR(100), -- ID contact CRM chính hoặc đã được hợp nhất (nếu có)
     crm_source_id VARCHAR(100), -- ID của bản ghi hồ sơ gốc từ hệ thống CRM nguồn cụ thể
@@ -51,11 +51,27 @@ CREATE TABLE cdp_raw_profiles_stage (
     -- Trường dữ liệu mở rộng dưới dạng JSONB
     ext_attributes JSONB,
 
+    -- Tên (first_name + last_name) đã bỏ dấu và viết thường (tính ở F2), vd: 'nguyen van duc'
+    name_folded VARCHAR(500),
+
+    -- email / phone_number như khi nhận (trước khi F2 chuẩn hóa), email và phone_number lưu dạng chuẩn
+    email_raw citext,
+    phone_number_raw VARCHAR(50),
+
+    -- Fingerprint của các trường identity/trait (tính ở F2), upsert bỏ qua bản ghi không thay đổi
+    profile_fingerprint VARCHAR(32),
+
     -- thời gian cuối cùng mà profile đã được xử lý
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
     persona_tags TEXT[], -- e.g., ['history_lover', 'luxury_traveler']
 );
 
+-- Cho các database đã tạo bảng trước khi có cột profile_fingerprint
+ALTER TABLE cdp_raw_profiles_stage ADD COLUMN IF NOT EXISTS profile_fingerprint VARCHAR(32);
+ALTER TABLE cdp_raw_profiles_stage ADD COLUMN IF NOT EXISTS name_folded VARCHAR(500);
+ALTER TABLE cdp_raw_profiles_stage ADD COLUMN IF NOT EXISTS email_raw citext;
+ALTER TABLE cdp_raw_profiles_stage ADD COLUMN IF NOT EXISTS phone_number_raw VARCHAR(50);
+
 
 
 -- Tạo Index cho các trường quan trọng dùng cho ghép nối
@@ -203,6 +219,17 @@ BEGIN
     END IF;
 END$$;
 
+-- Compound index on tenant_id and name_folded: F2 ghi tên đã bỏ dấu, so khớp tên là so sánh bằng (btree)
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_indexes
+        WHERE schemaname = 'public' AND indexname = 'idx_raw_profiles_stage_tenant_id_name_folded'
+    ) THEN
+        CREATE INDEX idx_raw_profiles_stage_tenant_id_name_folded ON cdp_raw_profiles_stage (tenant_id, name_folded);
+    END IF;
+END$$;
+
 -- Index on social_user_id for efficient filtering
 DO $$
 BEGIN
@@ -9,6 +9,7 @@ AS $$
 DECLARE
     _unprocessed_count INTEGER;
     _batch_size INTEGER := 100; -- default batch size
+    _set_based_batch_size INTEGER := 500; -- one claim per run for the set_based engine
     _total_max_process INTEGER := 10000; -- limit total records per session
     _to_process_this_batch INTEGER;
     _from_ts TIMESTAMPTZ;
@@ -17,6 +18,10 @@ DECLARE
     _log_id BIGINT;
     _tenant_id TEXT := 'demo'; -- default tenant_id, can be parameterized if needed
     _existing_status TEXT;
+    -- 'set_based' dùng resolve_customer_identities_set_based (16_identity_resolution_set_based.sql), mặc định 'dynamic'
+    -- vd: ALTER DATABASE c360 SET cdp.identity_resolution_engine = 'set_based';
+    _engine TEXT := COALESCE(NULLIF(current_setting('cdp.identity_resolution_engine', true), ''), 'dynamic');
+    _resolved INTEGER;
 BEGIN
     -- Determine time range first
     SELECT r.received_at INTO _latest_ts
@@ -76,6 +81,20 @@ BEGIN
             _to_process_this_batch := LEAST(_batch_size, _total_max_process - _total_processed);
             EXIT WHEN _to_process_this_batch <= 0;
 
+            IF _engine = 'set_based' THEN
+                -- One bounded batch per run: the procedure runs in a single transaction and advisory locks are
+                -- held until it ends. Batches claimed one after another would pile up locks (one per identifier,
+                -- the shared lock table has room for a few thousand) with no global order, so two runs (or a run
+                -- and the Python worker, which commits per batch) could deadlock. The profiles left over are
+                -- picked up by the next run; claim_identity_resolution_batch also caps the locks it takes.
+                -- Errors, lock failures included, are not swallowed: the job is marked 'failed' and re-raised.
+                _to_process_this_batch := LEAST(_set_based_batch_size, _total_max_process - _total_processed);
+                _resolved := resolve_customer_identities_set_based(_to_process_this_batch, _from_ts, _to_ts);
+                _total_processed := _total_processed + _resolved;
+                RAISE NOTICE 'Processed % profiles (total so far: %)', _resolved, _total_processed;
+                EXIT;
+            END IF;
+
             BEGIN
                 PERFORM resolve_customer_identities_dynamic(_to_process_this_batch, _from_ts, _to_ts);
                 _total_processed := _total_processed + _to_process_this_batch;
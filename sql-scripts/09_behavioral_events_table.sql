@@ -29,7 +29,7 @@ CREATE TABLE cdp_behavioral_events (
     text_message TEXT,                                  -- For user chat messages, feedback text, or other textual input. Nullable.
     feedback_rating SMALLINT,                           -- For user-provided ratings (e.g., 1-5 stars). Nullable.
     social_context TEXT[], -- e.g., ['shared_on_zalo', 'exclusive_offer_seen']
-    story_context TEXT; -- e.g., 'shared_trip_experience', 'complaint_story'
+    story_context TEXT, -- e.g., 'shared_trip_experience', 'complaint_story'
     emotion TEXT, -- e.g., 'joy', 'surprise', 'awe', 'anger'
     practical_value_type TEXT, -- e.g., 'tip', 'deal', 'how_to'
 
@@ -147,6 +147,9 @@ BEGIN
         -- RAISE NOTICE '[LINK_OR_CREATE] Created new master_profile_id % for raw_profile_id %', v_final_master_id, p_raw_profile.raw_profile_id;
     END IF;
 
+    -- Keep the identifier index in sync (cdp_master_identifiers, 17_master_identifiers_table.sql)
+    PERFORM register_master_identifiers(v_final_master_id, p_raw_profile);
+
     -- Link raw profile to master profile (either existing or new)
     BEGIN
         INSERT INTO cdp_profile_links (raw_profile_id, master_profile_id, match_rule)
@@ -190,18 +193,22 @@ RETURNS VOID AS $$
 DECLARE
     r_profile cdp_raw_profiles_stage;
     matched_master_id UUID;
-    identity_configs_array identity_config_type[];
-    v_where_conditions TEXT[] := '{}';
-    v_condition_text TEXT;
-    v_identity_config_rec identity_config_type;
-    v_raw_value_text TEXT;
-    v_master_col_name TEXT;
-    v_dynamic_select_query TEXT;
     v_start_time TIMESTAMPTZ;
 BEGIN
     v_start_time := NOW(); 
     RAISE NOTICE '[RESOLVE_IDENTITIES] Bắt đầu xử lý với batch_size % tại thời điểm %', batch_size, v_start_time;
 
+    IF NOT EXISTS (
+        SELECT 1 FROM cdp_profile_attributes
+        WHERE is_identity_resolution = TRUE
+          AND status = 'ACTIVE'
+          AND matching_rule IS NOT NULL
+          AND matching_rule <> 'none'
+    ) THEN
+        RAISE WARNING '[RESOLVE_IDENTITIES] Không có cấu hình IR đang hoạt động!';
+        RETURN;
+    END IF;
+
     -- Bước 1: Đánh dấu trước batch
     -- Use FOR UPDATE SKIP LOCKED to avoid locking conflicts and deadlocks between concurrent workers
     WITH picked_rows AS (
@@ -234,107 +241,13 @@ BEGIN
         -- RAISE NOTICE '[RESOLVE_IDENTITIES] Đang xử lý raw_profile_id: % (tenant_id: %)', r_profile.raw_profile_id, r_profile.tenant_id;
 
         matched_master_id := NULL;
-        v_where_conditions := '{}';
-
-        -- Bước 3: Load cấu hình IR nếu chưa có
-        IF identity_configs_array IS NULL THEN
-            SELECT array_agg(
-                ROW(id, attribute_internal_code, data_type, matching_rule, matching_threshold, consolidation_rule)::identity_config_type
-            )
-            INTO identity_configs_array
-            FROM cdp_profile_attributes
-            WHERE is_identity_resolution = TRUE
-              AND status = 'ACTIVE'
-              AND matching_rule IS NOT NULL
-              AND matching_rule <> 'none';
-
-            IF identity_configs_array IS NULL OR array_length(identity_configs_array, 1) = 0 THEN
-                RAISE WARNING '[RESOLVE_IDENTITIES] Không có cấu hình IR đang hoạt động!';
-                RETURN;
-            END IF;
-        END IF;
-
-        -- Bước 4: Build điều kiện
-        FOREACH v_identity_config_rec IN ARRAY identity_configs_array LOOP
-            v_raw_value_text := NULL;
-
-            CASE v_identity_config_rec.attr_code
-                WHEN 'phone_number' THEN v_raw_value_text := r_profile.phone_number::TEXT;
-                WHEN 'crm_source_id' THEN v_raw_value_text := r_profile.crm_source_id::TEXT;
-                WHEN 'social_user_id' THEN v_raw_value_text := r_profile.social_user_id::TEXT;
-                WHEN 'email' THEN v_raw_value_text := r_profile.email::TEXT;
-                ELSE
-                    BEGIN
-                        SELECT r_profile.ext_attributes ->> v_identity_config_rec.attr_code
-                        INTO v_raw_value_text;
-                    EXCEPTION
-                        WHEN OTHERS THEN
-                            RAISE WARNING '[RESOLVE_IDENTITIES] Lỗi lấy ext_attr %: %', v_identity_config_rec.attr_code, SQLERRM;
-                    END;
-            END CASE;
-
-            IF v_raw_value_text IS NOT NULL AND (
-                (v_identity_config_rec.data_type IN ('VARCHAR', 'citext', 'TEXT') AND v_raw_value_text <> '')
-                OR v_identity_config_rec.data_type NOT IN ('VARCHAR', 'citext', 'TEXT')
-            ) THEN
-                v_master_col_name := v_identity_config_rec.attr_code;
 
-                -- Compose matching condition based on the matching rule
-                CASE v_identity_config_rec.match_rule
-                    WHEN 'exact' THEN
-                        v_condition_text := format('mp.%I = %L', v_master_col_name, v_raw_value_text);
-                    WHEN 'fuzzy_trgm' THEN
-                        IF v_identity_config_rec.threshold IS NOT NULL THEN
-                            v_condition_text := format('similarity(mp.%I, %L) >= %s', v_master_col_name, v_raw_value_text, v_identity_config_rec.threshold);
-                        ELSE
-                            RAISE WARNING '[RESOLVE_IDENTITIES] fuzzy_trgm thiếu threshold cho attr %', v_master_col_name;
-                            CONTINUE;
-                        END IF;
-                    WHEN 'fuzzy_dmetaphone' THEN
-                        v_condition_text := format('dmetaphone(mp.%I) = dmetaphone(%L)', v_master_col_name, v_raw_value_text);
-                    ELSE
-                        RAISE WARNING '[RESOLVE_IDENTITIES] match_rule không hợp lệ: %', v_identity_config_rec.match_rule;
-                        CONTINUE;
-                END CASE;
-
-                v_where_conditions := array_append(v_where_conditions, v_condition_text);
-            END IF;
-        END LOOP;
-
-        -- Bước 5: Dynamic SQL sử dụng UNION ALL
-        IF array_length(v_where_conditions, 1) > 0 THEN
-            v_dynamic_select_query := '';
-
-            FOR i IN 1..array_length(v_where_conditions, 1) LOOP
-                IF i > 1 THEN
-                    v_dynamic_select_query := v_dynamic_select_query || ' UNION ALL ';
-                END IF;
-
-                v_dynamic_select_query := v_dynamic_select_query || format(
-                    'SELECT mp.master_profile_id FROM cdp_master_profiles mp WHERE mp.tenant_id = %L AND %s',
-                    r_profile.tenant_id,
-                    v_where_conditions[i]
-                );
-            END LOOP;
-
-            -- Lấy 1 bản ghi đầu tiên sau khi UNION
-            v_dynamic_select_query := format(
-                'SELECT master_profile_id FROM (%s) AS unioned LIMIT 1',
-                v_dynamic_select_query
-            );
-
-            -- RAISE NOTICE '[RESOLVE_IDENTITIES] Query động (UNION): %', v_dynamic_select_query;
-
-            BEGIN
-                EXECUTE v_dynamic_select_query INTO matched_master_id;
-            EXCEPTION
-                WHEN OTHERS THEN
-                    RAISE WARNING '[RESOLVE_IDENTITIES] Lỗi khi chạy query động: %', SQLERRM;
-                    matched_master_id := NULL;
-            END;
-        END IF;
+        -- Bước 3: So khớp theo cấu hình IR bằng hàm đã biên dịch (18_identity_matching_plans.sql): các query tĩnh
+        -- với giá trị của profile làm bind parameter, plan được cache trong session. Lỗi của một rule được raise,
+        -- không bị coi là "không khớp" rồi tạo master mới.
+        matched_master_id := match_master_by_identity_rules(r_profile);
 
-        -- Bước 6: Gọi hàm liên kết
+        -- Bước 4: Gọi hàm liên kết
         IF matched_master_id IS NOT NULL THEN
             matched_master_id := link_or_create_master_profile(r_profile, matched_master_id, 'DynamicMatch');
         ELSE
@@ -343,7 +256,7 @@ BEGIN
 
        
 
-        -- Bước 7: Cập nhật trạng thái đã xử lý
+        -- Bước 5: Cập nhật trạng thái đã xử lý
         UPDATE cdp_raw_profiles_stage
         SET status_code = 3,
             updated_at = NOW()
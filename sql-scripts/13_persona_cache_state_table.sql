@@ -0,0 +1,30 @@
+-- Bảng Metadata: cdp_persona_cache_state
+-- Trạng thái refresh của persona cache trong F1 (f1_event_track), dùng chung giữa các container.
+-- Container giữ advisory lock chạy delta query và publish watermark; các container khác chỉ đọc
+-- watermark này để bỏ qua query (không có gì mới) hoặc chỉ đọc một delta giới hạn.
+
+CREATE TABLE IF NOT EXISTS cdp_persona_cache_state (
+    cache_name VARCHAR(64) PRIMARY KEY,
+
+    -- Highest cdp_persona_profiles.updated_at read by the last leader refresh
+    watermark TIMESTAMP WITH TIME ZONE,
+
+    -- When the last leader refresh published its watermark
+    refreshed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);
+
+INSERT INTO cdp_persona_cache_state (cache_name, watermark, refreshed_at)
+VALUES ('f1_persona_cache', NULL, '-infinity')
+ON CONFLICT (cache_name) DO NOTHING;
+
+-- Delta refreshes filter cdp_persona_profiles on updated_at
+DO $$
+BEGIN
+    IF to_regclass('cdp_persona_profiles') IS NOT NULL AND NOT EXISTS (
+        SELECT 1 FROM pg_indexes
+        WHERE tablename = 'cdp_persona_profiles' AND indexname = 'idx_cdp_persona_profiles_updated_at'
+    ) THEN
+        CREATE INDEX idx_cdp_persona_profiles_updated_at ON cdp_persona_profiles (updated_at);
+    END IF;
+END
+$$;
@@ -0,0 +1,49 @@
+-- Bảng Metadata: cdp_profile_field_mappings
+-- Mapping từ event của JavaScript SDK / CRM sang cột của cdp_raw_profiles_stage, dùng bởi F2 (f2_event_to_entities).
+-- F2 đọc bảng này (cùng với cdp_profile_attributes) một lần khi cold start và compile thành một hàm transform.
+-- Thuộc tính ACTIVE trong cdp_profile_attributes không có dòng mapping được map theo chính tên của nó;
+-- thuộc tính không phải là cột của cdp_raw_profiles_stage (hoặc storage_type = 'JSON_FIELD') được lưu trong ext_attributes.
+
+CREATE TABLE IF NOT EXISTS cdp_profile_field_mappings (
+    id BIGSERIAL PRIMARY KEY,
+
+    -- Cột của cdp_raw_profiles_stage, hoặc key trong ext_attributes
+    target_field VARCHAR(100) UNIQUE NOT NULL,
+
+    -- Các key nguồn theo thứ tự ưu tiên: key đầu tiên có mặt trong event được dùng.
+    -- Key thường là key trong profile_traits, key bắt đầu bằng '$.' là key ở cấp event (vd: '$.visid')
+    source_keys TEXT[] NOT NULL,
+
+    -- 'text' (trim + escape HTML), 'json' (giá trị JSON) hoặc 'raw' (giữ nguyên).
+    -- NULL: suy ra từ cdp_profile_attributes.data_type
+    value_type VARCHAR(20) NULL,
+
+    -- Giá trị mặc định khi không có key nguồn nào trong event (JSON text cho value_type 'json')
+    default_value TEXT NULL,
+
+    -- Kiểm tra giá trị trước khi lưu, record bị drop nếu sai: 'email', 'phone_basic'
+    validator VARCHAR(50) NULL,
+
+    -- Cách tạo giá trị khi rỗng: 'visitor_id_from_key_hint'
+    fallback VARCHAR(50) NULL,
+
+    status VARCHAR(50) DEFAULT 'ACTIVE', -- vd: 'ACTIVE', 'INACTIVE'
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    update_at TIMESTAMP WITH TIME ZONE NULL
+);
+
+-- Mapping mặc định, giống với mapping trước đây được viết cứng trong convert_event_to_profile
+INSERT INTO cdp_profile_field_mappings (target_field, source_keys, value_type, default_value, validator, fallback) VALUES
+('tenant_id', ARRAY['$.tenant_id'], 'text', '', NULL, NULL),
+('source_system', ARRAY['usersource', 'source_system'], 'text', 'websdk', NULL, NULL),
+('email', ARRAY['email'], 'text', NULL, 'email', NULL),
+('phone_number', ARRAY['phone', 'phone_number'], 'text', NULL, 'phone_basic', NULL),
+('web_visitor_id', ARRAY['$.visid'], 'text', NULL, NULL, 'visitor_id_from_key_hint'),
+('crm_contact_id', ARRAY['userid', 'crm_contact_id'], 'text', NULL, NULL, NULL),
+('first_name', ARRAY['name', 'firstname', 'first_name'], 'text', NULL, NULL, NULL),
+('last_name', ARRAY['lastname', 'last_name'], 'text', NULL, NULL, NULL),
+('gender', ARRAY['gender'], 'text', 'unknown', NULL, NULL),
+('date_of_birth', ARRAY['birthday', 'date_of_birth'], 'text', NULL, NULL, NULL),
+('preferred_communication', ARRAY['preferred_communication'], 'json', '{}', NULL, NULL),
+('ext_attributes', ARRAY['ext_attributes'], 'json', '{}', NULL, NULL)
+ON CONFLICT (target_field) DO NOTHING;
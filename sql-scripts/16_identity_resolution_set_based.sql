@@ -0,0 +1,433 @@
+----------------- resolve_customer_identities_set_based -----------------------
+-- Engine set-based cho các rule 'exact': thay vì xử lý từng raw profile (dynamic SQL + EXECUTE +
+-- link_or_create_master_profile + UPDATE status, khoảng 5 câu lệnh cho mỗi profile), cả batch được xử lý
+-- bằng một số câu lệnh cố định:
+--   1. Claim batch (FOR UPDATE SKIP LOCKED) vào temp table tmp_ir_batch
+--   2. Tách identifier của batch (profile_identifiers) vào tmp_ir_identifiers
+--   3. Join một lần với cdp_master_identifiers để tìm master đã có (find_master_by_profile_columns cho phần còn lại)
+--   4. Gom các raw profile trong batch có chung identifier (label propagation, thường 1-2 vòng)
+--   5. INSERT ... SELECT các master mới, UPDATE ... FROM để tổng hợp dữ liệu vào master đã có
+--   6. INSERT ... SELECT các identifier mới vào cdp_master_identifiers
+--   7. INSERT ... SELECT các link, UPDATE status_code = 3 cho cả batch
+-- Chỉ xử lý các rule 'exact'; rule fuzzy vẫn dùng engine dynamic.
+-- Cần 17_master_identifiers_table.sql.
+-- Chọn engine cho process_new_raw_profiles: ALTER DATABASE ... SET cdp.identity_resolution_engine = 'set_based';
+-- Bước 1-2 (claim_identity_resolution_batch) và 5-7 (apply_identity_resolution_batch) cũng được dùng bởi
+-- worker Python (f0_setup_and_synch/resolution_worker.py), worker chỉ thay bước 3-4 bằng hash map trong bộ nhớ.
+
+
+----------------- claim_identity_resolution_batch -----------------------
+-- Bước 1-2: claim batch vào tmp_ir_batch, identifier vào tmp_ir_identifiers, và khóa các identifier.
+-- Trả về số raw profile đã claim. Temp tables bị xóa khi transaction kết thúc.
+-- Khi có nhiều lần chạy song song, mỗi transaction chỉ nên claim một batch (worker Python commit sau mỗi batch,
+-- process_new_raw_profiles claim một batch cho mỗi lần chạy): advisory lock chỉ được sắp xếp trong một batch,
+-- các batch nối tiếp trong cùng transaction sẽ giữ lock không theo thứ tự toàn cục và có thể deadlock.
+-- Mỗi identifier là một advisory lock trong lock table dùng chung (max_locks_per_transaction * max_connections,
+-- mặc định khoảng 6400 slot): batch được cắt bớt để không giữ quá cdp.identity_resolution_max_locks lock
+-- (mặc định 1000), các raw profile bị cắt được trả lại status_code = 1 cho batch sau.
+CREATE OR REPLACE FUNCTION claim_identity_resolution_batch(
+    batch_size INT DEFAULT 1000,
+    from_ts TIMESTAMPTZ DEFAULT NULL,
+    to_ts TIMESTAMPTZ DEFAULT NULL
+)
+RETURNS INTEGER AS $$
+DECLARE
+    v_claimed INTEGER;
+    v_max_locks INTEGER := COALESCE(NULLIF(current_setting('cdp.identity_resolution_max_locks', true), '')::INT, 1000);
+    v_cut INTEGER;
+BEGIN
+    -- Temp tables sống đến hết transaction, có thể còn lại từ một batch trước bị lỗi trong cùng session
+    DROP TABLE IF EXISTS tmp_ir_batch;
+    DROP TABLE IF EXISTS tmp_ir_identifiers;
+
+    CREATE TEMP TABLE tmp_ir_batch (
+        LIKE cdp_raw_profiles_stage,
+        ord INT,                      -- thứ tự xử lý trong batch (received_at)
+        matched_master_id UUID,       -- master đã có khớp với chính raw profile này
+        anchor_ord INT,               -- ord nhỏ nhất trong nhóm raw profile có chung identifier
+        final_master_id UUID,
+        is_creator BOOLEAN DEFAULT FALSE
+    ) ON COMMIT DROP;
+
+    -- Bước 1: Claim batch
+    WITH picked_rows AS (
+        SELECT raw_profile_id
+        FROM cdp_raw_profiles_stage
+        WHERE status_code = 1
+          AND NOT EXISTS (
+              SELECT 1 FROM cdp_profile_links WHERE raw_profile_id = cdp_raw_profiles_stage.raw_profile_id
+          )
+          AND (from_ts IS NULL OR received_at >= from_ts)
+          AND (to_ts IS NULL OR received_at <= to_ts)
+        ORDER BY received_at
+        LIMIT batch_size
+        FOR UPDATE SKIP LOCKED
+    ),
+    claimed AS (
+        UPDATE cdp_raw_profiles_stage r
+        SET status_code = 2,
+            updated_at = NOW()
+        FROM picked_rows p
+        WHERE r.raw_profile_id = p.raw_profile_id
+        RETURNING r.*
+    )
+    INSERT INTO tmp_ir_batch
+    SELECT c.*, row_number() OVER (ORDER BY c.received_at, c.raw_profile_id)::INT
+    FROM claimed c;
+
+    GET DIAGNOSTICS v_claimed = ROW_COUNT;
+    IF v_claimed = 0 THEN
+        RETURN 0;
+    END IF;
+
+    UPDATE tmp_ir_batch SET anchor_ord = ord;
+    ANALYZE tmp_ir_batch;
+
+    -- Bước 2: Identifier của batch theo cấu hình IR đang hoạt động (rule 'exact')
+    CREATE TEMP TABLE tmp_ir_identifiers ON COMMIT DROP AS
+    SELECT b.raw_profile_id, b.tenant_id, i.id_type, i.id_value, a.id AS priority
+    FROM tmp_ir_batch b
+    CROSS JOIN LATERAL profile_identifiers(
+        b.email::TEXT, b.phone_number, b.web_visitor_id, b.source_system, b.crm_source_id, b.social_user_id
+    ) i
+    JOIN cdp_profile_attributes a
+      ON a.attribute_internal_code = i.id_type
+     AND a.is_identity_resolution = TRUE
+     AND a.status = 'ACTIVE'
+     AND a.matching_rule = 'exact'
+    WHERE b.tenant_id IS NOT NULL;
+
+    -- Giới hạn số lock: giữ các raw profile đầu tiên (theo ord) mà số identifier khác nhau của chúng
+    -- không vượt quá v_max_locks, luôn giữ ít nhất raw profile đầu tiên
+    SELECT min(f.first_ord) - 1 INTO v_cut
+    FROM (
+        SELECT first_ord, count(*) OVER (ORDER BY first_ord) AS lock_count
+        FROM (
+            SELECT min(b.ord) AS first_ord
+            FROM tmp_ir_identifiers i
+            JOIN tmp_ir_batch b ON b.raw_profile_id = i.raw_profile_id
+            GROUP BY i.tenant_id, i.id_type, i.id_value
+        ) firsts
+    ) f
+    WHERE f.lock_count > v_max_locks;
+
+    IF v_cut IS NOT NULL THEN
+        v_cut := GREATEST(v_cut, 1);
+        UPDATE cdp_raw_profiles_stage r
+        SET status_code = 1
+        FROM tmp_ir_batch b
+        WHERE b.ord > v_cut AND r.raw_profile_id = b.raw_profile_id;
+
+        DELETE FROM tmp_ir_identifiers i
+        USING tmp_ir_batch b
+        WHERE b.ord > v_cut AND i.raw_profile_id = b.raw_profile_id;
+
+        DELETE FROM tmp_ir_batch WHERE ord > v_cut;
+
+        RAISE NOTICE '[CLAIM_IR_BATCH] Giới hạn % advisory lock: giữ % / % raw profile', v_max_locks, v_cut, v_claimed;
+        v_claimed := v_cut;
+    END IF;
+
+    CREATE INDEX ON tmp_ir_identifiers (tenant_id, id_type, id_value);
+    ANALYZE tmp_ir_identifiers;
+
+    -- Hai batch chạy song song có cùng một identifier mới sẽ tạo hai master: khóa identifier (advisory lock
+    -- đến hết transaction, theo thứ tự tăng dần để không deadlock). Batch sau chờ batch trước commit, rồi
+    -- thấy identifier đã được ghi vào cdp_master_identifiers.
+    PERFORM count(pg_advisory_xact_lock(k.lock_key))
+    FROM (
+        SELECT DISTINCT hashtextextended(tenant_id || ':' || id_type || ':' || id_value, 0) AS lock_key
+        FROM tmp_ir_identifiers
+        ORDER BY 1
+    ) k;
+
+    RETURN v_claimed;
+END;
+$$ LANGUAGE plpgsql;
+
+
+----------------- resolve_customer_identities_set_based -----------------------
+CREATE OR REPLACE FUNCTION resolve_customer_identities_set_based(
+    batch_size INT DEFAULT 1000,
+    from_ts TIMESTAMPTZ DEFAULT NULL,
+    to_ts TIMESTAMPTZ DEFAULT NULL
+)
+RETURNS INTEGER AS $$
+DECLARE
+    v_claimed INTEGER;
+    v_changed INTEGER;
+    v_rounds INTEGER := 0;
+    v_start_time TIMESTAMPTZ := clock_timestamp();
+BEGIN
+    -- Bước 1-2
+    v_claimed := claim_identity_resolution_batch(batch_size, from_ts, to_ts);
+    IF v_claimed = 0 THEN
+        RETURN 0;
+    END IF;
+
+    -- Bước 3: Master đã có, một semi-join cho cả batch trên khóa chính của cdp_master_identifiers
+    UPDATE tmp_ir_batch b
+    SET matched_master_id = m.master_profile_id
+    FROM (
+        SELECT DISTINCT ON (i.raw_profile_id) i.raw_profile_id, mi.master_profile_id
+        FROM tmp_ir_identifiers i
+        JOIN cdp_master_identifiers mi
+          ON mi.tenant_id = i.tenant_id AND mi.id_type = i.id_type AND mi.id_value = i.id_value
+        ORDER BY i.raw_profile_id, i.priority
+    ) m
+    WHERE b.raw_profile_id = m.raw_profile_id;
+
+    -- Identifier chưa có trong cdp_master_identifiers (chưa backfill, ghi ngoài register_master_identifiers):
+    -- như engine dynamic, tìm trên các cột của cdp_master_profiles cho các raw profile chưa khớp
+    UPDATE tmp_ir_batch b
+    SET matched_master_id = find_master_by_profile_columns(r)
+    FROM cdp_raw_profiles_stage r
+    WHERE b.matched_master_id IS NULL
+      AND r.raw_profile_id = b.raw_profile_id;
+
+    -- Bước 4: Nhóm các raw profile trong batch có chung identifier (như engine dynamic, nơi raw profile
+    -- sau khớp với master vừa được tạo bởi raw profile trước). Mỗi vòng lan truyền anchor_ord nhỏ nhất.
+    LOOP
+        UPDATE tmp_ir_batch b
+        SET anchor_ord = n.min_anchor
+        FROM (
+            SELECT i1.raw_profile_id, min(b2.anchor_ord) AS min_anchor
+            FROM tmp_ir_identifiers i1
+            JOIN tmp_ir_identifiers i2
+              ON i2.tenant_id = i1.tenant_id AND i2.id_type = i1.id_type AND i2.id_value = i1.id_value
+             AND i2.raw_profile_id <> i1.raw_profile_id
+            JOIN tmp_ir_batch b2 ON b2.raw_profile_id = i2.raw_profile_id
+            GROUP BY i1.raw_profile_id
+        ) n
+        WHERE b.raw_profile_id = n.raw_profile_id
+          AND n.min_anchor < b.anchor_ord;
+
+        GET DIAGNOSTICS v_changed = ROW_COUNT;
+        v_rounds := v_rounds + 1;
+        EXIT WHEN v_changed = 0;
+    END LOOP;
+
+    -- Master của mỗi nhóm: master khớp với raw profile đầu tiên của nhóm, hoặc một master mới
+    -- được tạo từ raw profile đầu tiên (anchor)
+    UPDATE tmp_ir_batch b
+    SET final_master_id = COALESCE(b.matched_master_id, g.matched_master_id, g.new_master_id),
+        is_creator = (g.matched_master_id IS NULL AND b.ord = b.anchor_ord)
+    FROM (
+        SELECT anchor_ord,
+               (array_agg(matched_master_id ORDER BY ord) FILTER (WHERE matched_master_id IS NOT NULL))[1] AS matched_master_id,
+               gen_random_uuid() AS new_master_id
+        FROM tmp_ir_batch
+        GROUP BY anchor_ord
+    ) g
+    WHERE g.anchor_ord = b.anchor_ord;
+
+    PERFORM apply_identity_resolution_batch('SetBased');
+
+    RAISE NOTICE '[RESOLVE_SET_BASED] % raw profiles, % grouping rounds, thời gian: %',
+        v_claimed, v_rounds, clock_timestamp() - v_start_time;
+    RETURN v_claimed;
+END;
+$$ LANGUAGE plpgsql;
+
+
+----------------- apply_identity_resolution_batch -----------------------
+-- Bước 5-7: ghi kết quả của tmp_ir_batch (final_master_id, is_creator, matched_master_id đã được điền).
+-- p_engine là tiền tố của match_rule trong cdp_profile_links, vd: 'SetBasedMatch', 'WorkerBatchMatch'.
+CREATE OR REPLACE FUNCTION apply_identity_resolution_batch(p_engine VARCHAR DEFAULT 'SetBased')
+RETURNS INTEGER AS $$
+DECLARE
+    v_applied INTEGER;
+BEGIN
+    -- Bước 5a: Master mới, giống nhánh INSERT của link_or_create_master_profile
+    INSERT INTO cdp_master_profiles (
+        master_profile_id, tenant_id,
+        email, phone_number,
+        web_visitor_ids, crm_contact_ids, social_user_ids,
+        first_name, last_name, gender, date_of_birth,
+        address_line1, address_line2, city, state, zip_code, country, latitude, longitude,
+        preferred_language, preferred_currency, preferred_communication,
+        last_seen_at, last_seen_observer_id, last_seen_touchpoint_id, last_seen_touchpoint_url, last_known_channel,
+        source_systems, first_seen_raw_profile_id,
+        ext_attributes,
+        created_at, updated_at
+    )
+    SELECT
+        b.final_master_id, b.tenant_id,
+        b.email, b.phone_number,
+        CASE WHEN b.web_visitor_id IS NOT NULL AND b.web_visitor_id <> '' THEN ARRAY[b.web_visitor_id]::TEXT[] ELSE '{}'::TEXT[] END,
+        CASE WHEN b.source_system IS NOT NULL AND b.crm_source_id IS NOT NULL THEN jsonb_build_object(b.source_system, b.crm_source_id) ELSE '{}'::jsonb END,
+        CASE WHEN b.social_user_id IS NOT NULL AND b.source_system IS NOT NULL THEN jsonb_build_object(b.source_system, b.social_user_id) ELSE '{}'::jsonb END,
+        b.first_name, b.last_name, b.gender, b.date_of_birth,
+        b.address_line1, b.address_line2, b.city, b.state, b.zip_code, b.country, b.latitude, b.longitude,
+        b.preferred_language, b.preferred_currency, b.preferred_communication,
+        b.last_seen_at, b.last_seen_observer_id, b.last_seen_touchpoint_id, b.last_seen_touchpoint_url, b.last_known_channel,
+        CASE WHEN b.source_system IS NOT NULL AND b.source_system <> '' THEN ARRAY[b.source_system]::TEXT[] ELSE '{}'::TEXT[] END,
+        b.raw_profile_id,
+        b.ext_attributes,
+        NOW(), NOW()
+    FROM tmp_ir_batch b
+    WHERE b.is_creator;
+
+    -- Khóa các master đã có theo thứ tự master_profile_id trước khi cập nhật: mọi batch lấy advisory lock
+    -- (đã sắp xếp) rồi mới khóa master (đã sắp xếp), nên hai batch song song không khóa chéo nhau
+    PERFORM 1
+    FROM cdp_master_profiles mp
+    WHERE mp.master_profile_id IN (SELECT final_master_id FROM tmp_ir_batch WHERE NOT is_creator)
+    ORDER BY mp.master_profile_id
+    FOR UPDATE;
+
+    -- Bước 5b: Tổng hợp các raw profile còn lại vào master của chúng, một UPDATE cho cả batch.
+    -- Quy tắc như nhánh UPDATE của link_or_create_master_profile; khi nhiều raw profile cùng master,
+    -- giá trị của raw profile có last_seen_at mới nhất được ưu tiên.
+    WITH members AS (
+        SELECT * FROM tmp_ir_batch WHERE NOT is_creator
+    ),
+    agg AS (
+        SELECT
+            m.final_master_id,
+            (array_agg(m.first_name ORDER BY m.last_seen_at DESC NULLS LAST, m.ord DESC) FILTER (WHERE m.first_name IS NOT NULL))[1] AS first_name,
+            (array_agg(m.last_name ORDER BY m.last_seen_at DESC NULLS LAST, m.ord DESC) FILTER (WHERE m.last_name IS NOT NULL))[1] AS last_name,
+            (array_agg(m.gender ORDER BY m.last_seen_at DESC NULLS LAST, m.ord DESC) FILTER (WHERE m.gender IS NOT NULL))[1] AS gender,
+            (array_agg(m.date_of_birth ORDER BY m.last_seen_at DESC NULLS LAST, m.ord DESC) FILTER (WHERE m.date_of_birth IS NOT NULL))[1] AS date_of_birth,
+            (array_agg(m.address_line1 ORDER BY m.last_seen_at DESC NULLS LAST, m.ord DESC) FILTER (WHERE m.address_line1 IS NOT NULL))[1] AS address_line1,
+            (array_agg(m.address_line2 ORDER BY m.last_seen_at DESC NULLS LAST, m.ord DESC) FILTER (WHERE m.address_line2 IS NOT NULL))[1] AS address_line2,
+            (array_agg(m.city ORDER BY m.last_seen_at DESC NULLS LAST, m.ord DESC) FILTER (WHERE m.city IS NOT NULL))[1] AS city,
+            (array_agg(m.state ORDER BY m.last_seen_at DESC NULLS LAST, m.ord DESC) FILTER (WHERE m.state IS NOT NULL))[1] AS state,
+            (array_agg(m.zip_code ORDER BY m.last_seen_at DESC NULLS LAST, m.ord DESC) FILTER (WHERE m.zip_code IS NOT NULL))[1] AS zip_code,
+            (array_agg(m.country ORDER BY m.last_seen_at DESC NULLS LAST, m.ord DESC) FILTER (WHERE m.country IS NOT NULL))[1] AS country,
+            (array_agg(m.latitude ORDER BY m.last_seen_at DESC NULLS LAST, m.ord DESC) FILTER (WHERE m.latitude IS NOT NULL))[1] AS latitude,
+            (array_agg(m.longitude ORDER BY m.last_seen_at DESC NULLS LAST, m.ord DESC) FILTER (WHERE m.longitude IS NOT NULL))[1] AS longitude,
+            (array_agg(m.preferred_language ORDER BY m.last_seen_at DESC NULLS LAST, m.ord DESC) FILTER (WHERE m.preferred_language IS NOT NULL))[1] AS preferred_language,
+            (array_agg(m.preferred_currency ORDER BY m.last_seen_at DESC NULLS LAST, m.ord DESC) FILTER (WHERE m.preferred_currency IS NOT NULL))[1] AS preferred_currency,
+            (array_agg(m.preferred_communication ORDER BY m.last_seen_at DESC NULLS LAST, m.ord DESC) FILTER (WHERE m.preferred_communication IS NOT NULL))[1] AS preferred_communication,
+            -- Hoạt động gần nhất của nhóm
+            max(m.last_seen_at) AS last_seen_at,
+            (array_agg(m.last_seen_observer_id ORDER BY m.last_seen_at DESC NULLS LAST, m.ord DESC))[1] AS last_seen_observer_id,
+            (array_agg(m.last_seen_touchpoint_id ORDER BY m.last_seen_at DESC NULLS LAST, m.ord DESC))[1] AS last_seen_touchpoint_id,
+            (array_agg(m.last_seen_touchpoint_url ORDER BY m.last_seen_at DESC NULLS LAST, m.ord DESC))[1] AS last_seen_touchpoint_url,
+            (array_agg(m.last_known_channel ORDER BY m.last_seen_at DESC NULLS LAST, m.ord DESC))[1] AS last_known_channel,
+            -- Identifier
+            (array_agg(m.email::TEXT ORDER BY m.ord) FILTER (WHERE m.email IS NOT NULL AND m.email <> ''))[1] AS first_email,
+            array_agg(DISTINCT m.email::TEXT) FILTER (WHERE m.email IS NOT NULL AND m.email <> '') AS emails,
+            (array_agg(m.phone_number ORDER BY m.ord) FILTER (WHERE m.phone_number IS NOT NULL AND m.phone_number <> ''))[1] AS first_phone_number,
+            array_agg(DISTINCT m.phone_number::TEXT) FILTER (WHERE m.phone_number IS NOT NULL AND m.phone_number <> '') AS phone_numbers,
+            array_agg(DISTINCT m.source_system::TEXT) FILTER (WHERE m.source_system IS NOT NULL AND m.source_system <> '') AS source_systems,
+            array_agg(DISTINCT m.web_visitor_id::TEXT) FILTER (WHERE m.web_visitor_id IS NOT NULL AND m.web_visitor_id <> '') AS web_visitor_ids,
+            jsonb_object_agg(m.source_system, m.crm_source_id) FILTER (WHERE m.source_system IS NOT NULL AND m.crm_source_id IS NOT NULL) AS crm_contact_ids,
+            jsonb_object_agg(m.source_system, m.social_user_id) FILTER (WHERE m.source_system IS NOT NULL AND m.social_user_id IS NOT NULL) AS social_user_ids
+        FROM members m
+        GROUP BY m.final_master_id
+    ),
+    ext AS (
+        -- ext_attributes: mỗi key lấy giá trị của raw profile mới nhất
+        SELECT final_master_id, jsonb_object_agg(key, value) AS ext_attributes
+        FROM (
+            SELECT DISTINCT ON (m.final_master_id, e.key) m.final_master_id, e.key, e.value
+            FROM members m
+            CROSS JOIN LATERAL jsonb_each(COALESCE(m.ext_attributes, '{}'::jsonb)) e
+            ORDER BY m.final_master_id, e.key, m.last_seen_at DESC NULLS LAST, m.ord DESC
+        ) latest
+        GROUP BY final_master_id
+    ),
+    merged AS (
+        SELECT
+            mp.master_profile_id,
+            COALESCE(NULLIF(mp.email::TEXT, ''), a.first_email) AS email,
+            COALESCE(NULLIF(mp.phone_number, ''), a.first_phone_number) AS phone_number
+        FROM agg a
+        JOIN cdp_master_profiles mp ON mp.master_profile_id = a.final_master_id
+    )
+    UPDATE cdp_master_profiles mp
+    SET
+        first_name = COALESCE(a.first_name, mp.first_name),
+        last_name = COALESCE(a.last_name, mp.last_name),
+        gender = COALESCE(a.gender, mp.gender),
+        date_of_birth = COALESCE(a.date_of_birth, mp.date_of_birth),
+
+        email = mg.email,
+        secondary_emails = CASE
+            WHEN a.emails IS NULL THEN mp.secondary_emails
+            ELSE ARRAY(SELECT DISTINCT elem FROM unnest(COALESCE(mp.secondary_emails, '{}'::TEXT[]) || a.emails) AS elem
+                       WHERE elem IS NOT NULL AND elem <> '' AND elem::CITEXT IS DISTINCT FROM mg.email::CITEXT)
+        END,
+        phone_number = mg.phone_number,
+        secondary_phone_numbers = CASE
+            WHEN a.phone_numbers IS NULL THEN mp.secondary_phone_numbers
+            ELSE ARRAY(SELECT DISTINCT elem FROM unnest(COALESCE(mp.secondary_phone_numbers, '{}'::TEXT[]) || a.phone_numbers) AS elem
+                       WHERE elem IS NOT NULL AND elem <> '' AND elem IS DISTINCT FROM mg.phone_number)
+        END,
+
+        address_line1 = COALESCE(a.address_line1, mp.address_line1),
+        address_line2 = COALESCE(a.address_line2, mp.address_line2),
+        city = COALESCE(a.city, mp.city),
+        state = COALESCE(a.state, mp.state),
+        zip_code = COALESCE(a.zip_code, mp.zip_code),
+        country = COALESCE(a.country, mp.country),
+        latitude = COALESCE(a.latitude, mp.latitude),
+        longitude = COALESCE(a.longitude, mp.longitude),
+
+        preferred_language = COALESCE(a.preferred_language, mp.preferred_language),
+        preferred_currency = COALESCE(a.preferred_currency, mp.preferred_currency),
+        preferred_communication = COALESCE(a.preferred_communication, mp.preferred_communication),
+
+        last_seen_at = GREATEST(mp.last_seen_at, a.last_seen_at),
+        last_seen_observer_id = CASE WHEN a.last_seen_at >= COALESCE(mp.last_seen_at, '1970-01-01'::TIMESTAMPTZ) THEN a.last_seen_observer_id ELSE mp.last_seen_observer_id END,
+        last_seen_touchpoint_id = CASE WHEN a.last_seen_at >= COALESCE(mp.last_seen_at, '1970-01-01'::TIMESTAMPTZ) THEN a.last_seen_touchpoint_id ELSE mp.last_seen_touchpoint_id END,
+        last_seen_touchpoint_url = CASE WHEN a.last_seen_at >= COALESCE(mp.last_seen_at, '1970-01-01'::TIMESTAMPTZ) THEN a.last_seen_touchpoint_url ELSE mp.last_seen_touchpoint_url END,
+        last_known_channel = CASE WHEN a.last_seen_at >= COALESCE(mp.last_seen_at, '1970-01-01'::TIMESTAMPTZ) THEN a.last_known_channel ELSE mp.last_known_channel END,
+
+        source_systems = (
+            SELECT array_agg(DISTINCT elem)
+            FROM unnest(COALESCE(mp.source_systems, '{}'::TEXT[]) || COALESCE(a.source_systems, '{}'::TEXT[])) AS elem
+            WHERE elem IS NOT NULL AND elem <> ''
+        ),
+        web_visitor_ids = (
+            SELECT array_agg(DISTINCT elem)
+            FROM unnest(COALESCE(mp.web_visitor_ids, '{}'::TEXT[]) || COALESCE(a.web_visitor_ids, '{}'::TEXT[])) AS elem
+            WHERE elem IS NOT NULL AND elem <> ''
+        ),
+        crm_contact_ids = COALESCE(mp.crm_contact_ids, '{}'::jsonb) || COALESCE(a.crm_contact_ids, '{}'::jsonb),
+        social_user_ids = COALESCE(mp.social_user_ids, '{}'::jsonb) || COALESCE(a.social_user_ids, '{}'::jsonb),
+        ext_attributes = COALESCE(mp.ext_attributes, '{}'::jsonb) || COALESCE(x.ext_attributes, '{}'::jsonb),
+        updated_at = NOW(),
+        status_code = 10
+    FROM agg a
+    JOIN merged mg ON mg.master_profile_id = a.final_master_id
+    LEFT JOIN ext x ON x.final_master_id = a.final_master_id
+    WHERE mp.master_profile_id = a.final_master_id;
+
+    -- Bước 6: Identifier mới của các master (như register_master_identifiers), identifier đã có giữ nguyên master
+    INSERT INTO cdp_master_identifiers (tenant_id, id_type, id_value, master_profile_id)
+    SELECT b.tenant_id, i.id_type, i.id_value, b.final_master_id
+    FROM tmp_ir_batch b
+    CROSS JOIN LATERAL profile_identifiers(
+        b.email::TEXT, b.phone_number, b.web_visitor_id, b.source_system, b.crm_source_id, b.social_user_id
+    ) i
+    WHERE b.tenant_id IS NOT NULL
+    ORDER BY b.ord
+    ON CONFLICT (tenant_id, id_type, id_value) DO NOTHING;
+
+    -- Bước 7: Link và status, mỗi loại một câu lệnh
+    INSERT INTO cdp_profile_links (raw_profile_id, master_profile_id, match_rule)
+    SELECT b.raw_profile_id, b.final_master_id,
+           CASE
+               WHEN b.is_creator THEN 'NewMaster'
+               WHEN b.matched_master_id IS NOT NULL THEN p_engine || 'Match'
+               ELSE p_engine || 'BatchMatch' -- khớp với raw profile khác trong cùng batch
+           END
+    FROM tmp_ir_batch b
+    ON CONFLICT (raw_profile_id) DO NOTHING;
+
+    UPDATE cdp_raw_profiles_stage r
+    SET status_code = 3,
+        updated_at = NOW()
+    FROM tmp_ir_batch b
+    WHERE r.raw_profile_id = b.raw_profile_id;
+
+    GET DIAGNOSTICS v_applied = ROW_COUNT;
+
+    DROP TABLE tmp_ir_identifiers;
+    DROP TABLE tmp_ir_batch;
+    RETURN v_applied;
+END;
+$$ LANGUAGE plpgsql;
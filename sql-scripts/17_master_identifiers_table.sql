@@ -0,0 +1,190 @@
+-- Bảng 4: cdp_master_identifiers: index định danh của master profile
+-- Mỗi identifier (dạng chuẩn) của một tenant là một dòng btree trỏ tới master profile sở hữu nó, gồm cả
+-- các identifier phụ (secondary_emails, secondary_phone_numbers, web_visitor_ids, crm_contact_ids, social_user_ids).
+-- Identity resolution cho rule 'exact' chỉ còn là một semi-join trên bảng này, không cần query động theo
+-- từng cột của cdp_master_profiles hay quét GIN trên mảng / JSONB.
+-- Được cập nhật bởi link_or_create_master_profile và resolve_customer_identities_set_based.
+-- Chạy sau 05_master_profiles_table.sql; chạy lại nhiều lần không ảnh hưởng (idempotent).
+
+CREATE TABLE IF NOT EXISTS cdp_master_identifiers (
+    tenant_id VARCHAR(36) NOT NULL,
+    id_type VARCHAR(50) NOT NULL, -- attribute_internal_code trong cdp_profile_attributes: 'email', 'phone_number', 'web_visitor_id', 'crm_source_id', 'social_user_id'
+    id_value TEXT NOT NULL, -- dạng chuẩn, xem profile_identifiers
+    master_profile_id UUID NOT NULL REFERENCES cdp_master_profiles(master_profile_id) ON DELETE CASCADE,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    -- Một identifier chỉ thuộc về một master: master đầu tiên giữ nó
+    PRIMARY KEY (tenant_id, id_type, id_value)
+);
+
+-- Index trên master_profile_id để tìm / chuyển các identifier của một master (khi merge master)
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_indexes
+        WHERE schemaname = 'public' AND indexname = 'idx_master_identifiers_master_id'
+    ) THEN
+        CREATE INDEX idx_master_identifiers_master_id ON cdp_master_identifiers (master_profile_id);
+        RAISE NOTICE 'Created index idx_master_identifiers_master_id';
+    ELSE
+        RAISE NOTICE 'Index idx_master_identifiers_master_id already exists';
+    END IF;
+END$$;
+
+
+----------------- profile_identifiers -----------------------
+-- Dạng chuẩn của các identifier của một profile:
+--   email: trim + viết thường, phone_number / web_visitor_id: trim (F2 đã chuẩn hóa E.164),
+--   crm_source_id / social_user_id: 'source_system:id', giống key của crm_contact_ids / social_user_ids trong master
+CREATE OR REPLACE FUNCTION profile_identifiers(
+    p_email TEXT,
+    p_phone_number TEXT,
+    p_web_visitor_id TEXT,
+    p_source_system TEXT,
+    p_crm_source_id TEXT,
+    p_social_user_id TEXT
+)
+RETURNS TABLE (id_type TEXT, id_value TEXT) AS $$
+    SELECT t.id_type, t.id_value
+    FROM (VALUES
+        ('email', lower(NULLIF(btrim(p_email), ''))),
+        ('phone_number', NULLIF(btrim(p_phone_number), '')),
+        ('web_visitor_id', NULLIF(btrim(p_web_visitor_id), '')),
+        ('crm_source_id', p_source_system || ':' || NULLIF(btrim(p_crm_source_id), '')),
+        ('social_user_id', p_source_system || ':' || NULLIF(btrim(p_social_user_id), ''))
+    ) AS t(id_type, id_value)
+    WHERE t.id_value IS NOT NULL;
+$$ LANGUAGE sql IMMUTABLE;
+
+
+----------------- register_master_identifiers -----------------------
+-- Ghi các identifier của raw profile cho master của nó. Identifier đã thuộc về master khác được giữ nguyên.
+CREATE OR REPLACE FUNCTION register_master_identifiers(
+    p_master_profile_id UUID,
+    p_raw_profile cdp_raw_profiles_stage
+)
+RETURNS VOID AS $$
+    INSERT INTO cdp_master_identifiers (tenant_id, id_type, id_value, master_profile_id)
+    SELECT p_raw_profile.tenant_id, i.id_type, i.id_value, p_master_profile_id
+    FROM profile_identifiers(
+        p_raw_profile.email::TEXT, p_raw_profile.phone_number, p_raw_profile.web_visitor_id,
+        p_raw_profile.source_system, p_raw_profile.crm_source_id, p_raw_profile.social_user_id
+    ) i
+    WHERE p_raw_profile.tenant_id IS NOT NULL
+    ON CONFLICT (tenant_id, id_type, id_value) DO NOTHING;
+$$ LANGUAGE sql;
+
+
+----------------- find_master_by_profile_columns -----------------------
+-- Dự phòng khi cdp_master_identifiers không có identifier của raw profile: so khớp 'exact' trực tiếp trên các cột
+-- của cdp_master_profiles (cột chính, mảng và JSONB, đều có index). Cần cho identifier chưa được backfill, hoặc được
+-- ghi bởi các đường không qua register_master_identifiers (sửa tay, link fuzzy, consolidation). Khi khớp,
+-- link_or_create_master_profile ghi identifier của raw profile vào cdp_master_identifiers cho lần sau.
+CREATE OR REPLACE FUNCTION find_master_by_profile_columns(p_raw_profile cdp_raw_profiles_stage)
+RETURNS UUID AS $$
+    SELECT m.master_profile_id
+    FROM (
+        SELECT 'email' AS id_type, mp.master_profile_id
+        FROM cdp_master_profiles mp
+        WHERE mp.tenant_id = p_raw_profile.tenant_id
+          AND mp.email = NULLIF(btrim(p_raw_profile.email::TEXT), '')::CITEXT
+        UNION ALL
+        SELECT 'email', mp.master_profile_id
+        FROM cdp_master_profiles mp
+        WHERE mp.tenant_id = p_raw_profile.tenant_id
+          AND mp.secondary_emails @> ARRAY[NULLIF(btrim(p_raw_profile.email::TEXT), '')]
+        UNION ALL
+        SELECT 'phone_number', mp.master_profile_id
+        FROM cdp_master_profiles mp
+        WHERE mp.tenant_id = p_raw_profile.tenant_id
+          AND mp.phone_number = NULLIF(btrim(p_raw_profile.phone_number), '')
+        UNION ALL
+        SELECT 'phone_number', mp.master_profile_id
+        FROM cdp_master_profiles mp
+        WHERE mp.tenant_id = p_raw_profile.tenant_id
+          AND mp.secondary_phone_numbers @> ARRAY[NULLIF(btrim(p_raw_profile.phone_number), '')]
+        UNION ALL
+        SELECT 'web_visitor_id', mp.master_profile_id
+        FROM cdp_master_profiles mp
+        WHERE mp.tenant_id = p_raw_profile.tenant_id
+          AND mp.web_visitor_ids @> ARRAY[NULLIF(btrim(p_raw_profile.web_visitor_id), '')]
+        UNION ALL
+        SELECT 'crm_source_id', mp.master_profile_id
+        FROM cdp_master_profiles mp
+        WHERE mp.tenant_id = p_raw_profile.tenant_id
+          AND p_raw_profile.source_system IS NOT NULL
+          AND NULLIF(btrim(p_raw_profile.crm_source_id), '') IS NOT NULL
+          -- COALESCE: jsonb_build_object không nhận key NULL, kể cả khi điều kiện trên đã loại
+          AND mp.crm_contact_ids @> jsonb_build_object(COALESCE(p_raw_profile.source_system, ''), btrim(p_raw_profile.crm_source_id))
+        UNION ALL
+        SELECT 'social_user_id', mp.master_profile_id
+        FROM cdp_master_profiles mp
+        WHERE mp.tenant_id = p_raw_profile.tenant_id
+          AND p_raw_profile.source_system IS NOT NULL
+          AND NULLIF(btrim(p_raw_profile.social_user_id), '') IS NOT NULL
+          -- COALESCE: jsonb_build_object không nhận key NULL, kể cả khi điều kiện trên đã loại
+          AND mp.social_user_ids @> jsonb_build_object(COALESCE(p_raw_profile.source_system, ''), btrim(p_raw_profile.social_user_id))
+    ) m
+    JOIN cdp_profile_attributes a
+      ON a.attribute_internal_code = m.id_type
+     AND a.is_identity_resolution = TRUE
+     AND a.status = 'ACTIVE'
+     AND a.matching_rule = 'exact'
+    WHERE p_raw_profile.tenant_id IS NOT NULL
+    ORDER BY a.id
+    LIMIT 1;
+$$ LANGUAGE sql STABLE;
+
+
+----------------- find_master_by_identifiers -----------------------
+-- Master khớp với raw profile theo các rule 'exact' đang hoạt động: một semi-join trên khóa chính của
+-- cdp_master_identifiers, rồi find_master_by_profile_columns nếu không khớp.
+-- Khi nhiều identifier khớp, thứ tự ưu tiên là cdp_profile_attributes.id.
+CREATE OR REPLACE FUNCTION find_master_by_identifiers(p_raw_profile cdp_raw_profiles_stage)
+RETURNS UUID AS $$
+    SELECT COALESCE((
+        SELECT mi.master_profile_id
+        FROM profile_identifiers(
+            p_raw_profile.email::TEXT, p_raw_profile.phone_number, p_raw_profile.web_visitor_id,
+            p_raw_profile.source_system, p_raw_profile.crm_source_id, p_raw_profile.social_user_id
+        ) i
+        JOIN cdp_profile_attributes a
+          ON a.attribute_internal_code = i.id_type
+         AND a.is_identity_resolution = TRUE
+         AND a.status = 'ACTIVE'
+         AND a.matching_rule = 'exact'
+        JOIN cdp_master_identifiers mi
+          ON mi.tenant_id = p_raw_profile.tenant_id
+         AND mi.id_type = i.id_type
+         AND mi.id_value = i.id_value
+        ORDER BY a.id
+        LIMIT 1
+    ), find_master_by_profile_columns(p_raw_profile));
+$$ LANGUAGE sql STABLE;
+
+
+----------------- Backfill -----------------------
+-- Identifier của các master đã có. Khi hai master có chung một identifier, master được tạo trước giữ nó.
+INSERT INTO cdp_master_identifiers (tenant_id, id_type, id_value, master_profile_id)
+SELECT mp.tenant_id, i.id_type, i.id_value, mp.master_profile_id
+FROM cdp_master_profiles mp
+CROSS JOIN LATERAL (
+    SELECT 'email', lower(NULLIF(btrim(mp.email::TEXT), ''))
+    UNION ALL
+    SELECT 'email', lower(NULLIF(btrim(elem), '')) FROM unnest(mp.secondary_emails) AS elem
+    UNION ALL
+    SELECT 'phone_number', NULLIF(btrim(mp.phone_number), '')
+    UNION ALL
+    SELECT 'phone_number', NULLIF(btrim(elem), '') FROM unnest(mp.secondary_phone_numbers) AS elem
+    UNION ALL
+    SELECT 'web_visitor_id', NULLIF(btrim(elem), '') FROM unnest(mp.web_visitor_ids) AS elem
+    UNION ALL
+    SELECT 'crm_source_id', c.key || ':' || NULLIF(btrim(c.value), '')
+    FROM jsonb_each_text(CASE WHEN jsonb_typeof(mp.crm_contact_ids) = 'object' THEN mp.crm_contact_ids ELSE '{}'::jsonb END) c
+    UNION ALL
+    SELECT 'social_user_id', s.key || ':' || NULLIF(btrim(s.value), '')
+    FROM jsonb_each_text(CASE WHEN jsonb_typeof(mp.social_user_ids) = 'object' THEN mp.social_user_ids ELSE '{}'::jsonb END) s
+) AS i(id_type, id_value)
+WHERE mp.tenant_id IS NOT NULL
+  AND i.id_value IS NOT NULL
+ORDER BY mp.created_at, mp.master_profile_id
+ON CONFLICT (tenant_id, id_type, id_value) DO NOTHING;
@@ -0,0 +1,143 @@
+-- Hàm so khớp được biên dịch từ cấu hình Identity Resolution
+-- Trước đây resolve_customer_identities_dynamic tạo lại SQL bằng format() cho từng raw profile và chạy bằng
+-- EXECUTE: PostgreSQL parse và plan lại một query mới (chứa literal) cho mỗi profile.
+-- compile_identity_matching_rules biên dịch cấu hình đang hoạt động của cdp_profile_attributes thành hàm PL/pgSQL
+-- match_master_by_identity_rules(raw profile), gồm các query tĩnh theo thứ tự so khớp:
+--   - các rule 'exact': một semi-join trên cdp_master_identifiers (17_master_identifiers_table.sql);
+--     khi không khớp, find_master_by_profile_columns trên các cột của cdp_master_profiles
+--   - mỗi thuộc tính có rule fuzzy ('fuzzy_trgm', 'fuzzy_dmetaphone'): một query trên cdp_master_profiles
+-- Query tĩnh của PL/pgSQL dùng giá trị của profile làm bind parameter, plan được cache trong session và không
+-- cần parse lại cho mỗi profile. Trigger trên cdp_profile_attributes biên dịch lại hàm khi cấu hình thay đổi,
+-- các session tự dùng bản mới ở lần gọi sau.
+
+
+----------------- compile_identity_matching_rules -----------------------
+-- Tạo lại match_master_by_identity_rules cho cấu hình hiện tại:
+-- 'exact' trước, sau đó các rule fuzzy theo cdp_profile_attributes.id.
+CREATE OR REPLACE FUNCTION compile_identity_matching_rules()
+RETURNS VOID AS $$
+DECLARE
+    v_exact_types TEXT;
+    v_body TEXT := '';
+    v_value TEXT;
+    v_condition TEXT;
+    r_rule RECORD;
+BEGIN
+    -- Rule 'exact': một query cho mọi loại identifier, thứ tự ưu tiên theo cdp_profile_attributes.id
+    SELECT string_agg(format('(%L, %s)', a.attribute_internal_code, a.id), ', ' ORDER BY a.id)
+    INTO v_exact_types
+    FROM cdp_profile_attributes a
+    WHERE a.is_identity_resolution = TRUE
+      AND a.status = 'ACTIVE'
+      AND a.matching_rule = 'exact';
+
+    IF v_exact_types IS NOT NULL THEN
+        v_body := v_body || format($body$
+    SELECT mi.master_profile_id INTO v_master_id
+    FROM profile_identifiers(
+        p_raw_profile.email::TEXT, p_raw_profile.phone_number, p_raw_profile.web_visitor_id,
+        p_raw_profile.source_system, p_raw_profile.crm_source_id, p_raw_profile.social_user_id
+    ) i
+    JOIN (VALUES %s) AS c(id_type, priority) ON c.id_type = i.id_type
+    JOIN cdp_master_identifiers mi
+      ON mi.tenant_id = p_raw_profile.tenant_id AND mi.id_type = i.id_type AND mi.id_value = i.id_value
+    ORDER BY c.priority
+    LIMIT 1;
+    -- Identifier chưa có trong cdp_master_identifiers (chưa backfill, ghi ngoài register_master_identifiers)
+    IF v_master_id IS NULL THEN
+        v_master_id := find_master_by_profile_columns(p_raw_profile);
+    END IF;
+    IF v_master_id IS NOT NULL THEN
+        RETURN v_master_id;
+    END IF;
+$body$, v_exact_types);
+    END IF;
+
+    -- Rule fuzzy: một query cho mỗi thuộc tính, chỉ chạy khi profile có giá trị
+    FOR r_rule IN
+        SELECT a.id, a.attribute_internal_code, a.matching_rule, a.matching_threshold
+        FROM cdp_profile_attributes a
+        WHERE a.is_identity_resolution = TRUE
+          AND a.status = 'ACTIVE'
+          AND a.matching_rule IN ('fuzzy_trgm', 'fuzzy_dmetaphone')
+        ORDER BY a.id
+    LOOP
+        -- vd: thuộc tính không có cột trong cdp_master_profiles
+        IF NOT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = 'cdp_master_profiles'
+              AND column_name = r_rule.attribute_internal_code
+        ) THEN
+            RAISE WARNING '[MATCHING_RULES] Bỏ qua rule % cho attr %: cdp_master_profiles không có cột này',
+                r_rule.matching_rule, r_rule.attribute_internal_code;
+            CONTINUE;
+        END IF;
+
+        IF r_rule.attribute_internal_code IN ('phone_number', 'crm_source_id', 'social_user_id', 'email') THEN
+            v_value := format('p_raw_profile.%I::TEXT', r_rule.attribute_internal_code);
+        ELSE
+            v_value := format('(p_raw_profile.ext_attributes ->> %L)', r_rule.attribute_internal_code);
+        END IF;
+
+        CASE r_rule.matching_rule
+            WHEN 'fuzzy_trgm' THEN
+                IF r_rule.matching_threshold IS NULL THEN
+                    RAISE WARNING '[MATCHING_RULES] fuzzy_trgm thiếu threshold cho attr %', r_rule.attribute_internal_code;
+                    CONTINUE;
+                END IF;
+                v_condition := format('similarity(mp.%I, %s) >= %s',
+                    r_rule.attribute_internal_code, v_value, r_rule.matching_threshold);
+            WHEN 'fuzzy_dmetaphone' THEN
+                v_condition := format('dmetaphone(mp.%I) = dmetaphone(%s)', r_rule.attribute_internal_code, v_value);
+        END CASE;
+
+        v_body := v_body || format($body$
+    -- %s: %s
+    IF %s <> '' THEN
+        SELECT mp.master_profile_id INTO v_master_id
+        FROM cdp_master_profiles mp
+        WHERE mp.tenant_id = p_raw_profile.tenant_id AND %s
+        LIMIT 1;
+        IF v_master_id IS NOT NULL THEN
+            RETURN v_master_id;
+        END IF;
+    END IF;
+$body$, r_rule.attribute_internal_code, r_rule.matching_rule, v_value, v_condition);
+    END LOOP;
+
+    EXECUTE format($function$
+CREATE OR REPLACE FUNCTION match_master_by_identity_rules(p_raw_profile cdp_raw_profiles_stage)
+RETURNS UUID AS $match$
+DECLARE
+    v_master_id UUID;
+BEGIN
+%s
+    RETURN NULL;
+END;
+$match$ LANGUAGE plpgsql STABLE;
+$function$, v_body);
+
+    RAISE NOTICE '[MATCHING_RULES] Đã biên dịch match_master_by_identity_rules cho cấu hình IR hiện tại';
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Biên dịch lại khi cdp_profile_attributes thay đổi (một lần cho mỗi câu lệnh)
+CREATE OR REPLACE FUNCTION recompile_identity_matching_rules()
+RETURNS TRIGGER AS $$
+BEGIN
+    -- Hai transaction đổi cấu hình cùng lúc thay hàm lần lượt (CREATE OR REPLACE song song lỗi "tuple concurrently updated")
+    PERFORM pg_advisory_xact_lock(hashtext('compile_identity_matching_rules'));
+    PERFORM compile_identity_matching_rules();
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS after_profile_attribute_matching_change ON cdp_profile_attributes;
+
+CREATE TRIGGER after_profile_attribute_matching_change
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON cdp_profile_attributes
+FOR EACH STATEMENT
+EXECUTE FUNCTION recompile_identity_matching_rules();
+
+SELECT compile_identity_matching_rules();
@@ -0,0 +1,76 @@
+-- Benchmark: resolve_customer_identities_dynamic vs resolve_customer_identities_set_based trên cùng dữ liệu.
+-- Chỉ chạy trên database test: engine dynamic không lọc theo tenant, nó xử lý mọi raw profile status_code = 1
+-- trong khoảng thời gian của benchmark. Dữ liệu được tạo trong tenant 'ir_benchmark' và được xóa ở cuối.
+-- Dữ liệu: 20000 raw profiles, ~40% dùng lại email/phone của một raw profile khác (cùng người, nhiều thiết bị).
+
+DO $$
+DECLARE
+    v_rows INT := 20000;
+    v_batch_size INT := 1000;
+    v_from TIMESTAMPTZ := '2000-01-01 00:00:00+00';
+    v_to TIMESTAMPTZ := '2000-01-02 00:00:00+00';
+    v_start TIMESTAMPTZ;
+    v_done INT;
+    v_dynamic_time INTERVAL;
+    v_set_based_time INTERVAL;
+    v_dynamic_masters INT;
+    v_set_based_masters INT;
+    v_links INT;
+BEGIN
+    -- Dữ liệu tổng hợp, received_at trong năm 2000 để không lẫn với dữ liệu thật
+    INSERT INTO cdp_raw_profiles_stage (
+        tenant_id, source_system, received_at, status_code, email, phone_number, web_visitor_id,
+        first_name, last_name, last_seen_at, ext_attributes
+    )
+    SELECT
+        'ir_benchmark', 'websdk', v_from + (g * INTERVAL '1 second'), 1,
+        CASE WHEN g % 3 <> 0 THEN 'user' || (CASE WHEN g % 5 < 2 THEN g / 7 ELSE g END) || '@bench.example' END,
+        CASE WHEN g % 2 = 0 THEN '+8490' || lpad((CASE WHEN g % 5 < 2 THEN g / 11 ELSE g END)::TEXT, 7, '0') END,
+        md5('visitor' || g)::UUID::TEXT,
+        'First' || g, 'Last' || g, v_from + (g * INTERVAL '1 second'),
+        jsonb_build_object('bench_seq', g)
+    FROM generate_series(1, v_rows) g;
+
+    -- 1. Engine dynamic
+    v_start := clock_timestamp();
+    LOOP
+        PERFORM resolve_customer_identities_dynamic(v_batch_size, v_from, v_to);
+        EXIT WHEN NOT EXISTS (
+            SELECT 1 FROM cdp_raw_profiles_stage WHERE tenant_id = 'ir_benchmark' AND status_code = 1
+        );
+    END LOOP;
+    v_dynamic_time := clock_timestamp() - v_start;
+    SELECT count(*) INTO v_dynamic_masters FROM cdp_master_profiles WHERE tenant_id = 'ir_benchmark';
+
+    -- Reset
+    DELETE FROM cdp_profile_links l USING cdp_raw_profiles_stage r
+    WHERE l.raw_profile_id = r.raw_profile_id AND r.tenant_id = 'ir_benchmark';
+    DELETE FROM cdp_master_profiles WHERE tenant_id = 'ir_benchmark';
+    UPDATE cdp_raw_profiles_stage SET status_code = 1 WHERE tenant_id = 'ir_benchmark';
+
+    -- 2. Engine set-based
+    v_start := clock_timestamp();
+    LOOP
+        v_done := resolve_customer_identities_set_based(v_batch_size, v_from, v_to);
+        EXIT WHEN v_done = 0;
+    END LOOP;
+    v_set_based_time := clock_timestamp() - v_start;
+    SELECT count(*) INTO v_set_based_masters FROM cdp_master_profiles WHERE tenant_id = 'ir_benchmark';
+    SELECT count(*) INTO v_links
+    FROM cdp_profile_links l JOIN cdp_raw_profiles_stage r ON r.raw_profile_id = l.raw_profile_id
+    WHERE r.tenant_id = 'ir_benchmark';
+
+    RAISE NOTICE '[BENCHMARK] % raw profiles, batch %', v_rows, v_batch_size;
+    RAISE NOTICE '[BENCHMARK] dynamic:   % (% profiles/s), % masters',
+        v_dynamic_time, round(v_rows / GREATEST(extract(epoch FROM v_dynamic_time), 0.001)), v_dynamic_masters;
+    RAISE NOTICE '[BENCHMARK] set_based: % (% profiles/s), % masters, % links',
+        v_set_based_time, round(v_rows / GREATEST(extract(epoch FROM v_set_based_time), 0.001)), v_set_based_masters, v_links;
+    -- Số master có thể khác nhau khi một raw profile nối hai master đã có: engine set-based gom cả nhóm
+    -- của batch vào master đầu tiên, engine dynamic xét từng raw profile.
+
+    -- Dọn dữ liệu
+    DELETE FROM cdp_profile_links l USING cdp_raw_profiles_stage r
+    WHERE l.raw_profile_id = r.raw_profile_id AND r.tenant_id = 'ir_benchmark';
+    DELETE FROM cdp_master_profiles WHERE tenant_id = 'ir_benchmark';
+    DELETE FROM cdp_raw_profiles_stage WHERE tenant_id = 'ir_benchmark';
+END $$;
@@ -0,0 +1,321 @@
+import contextvars
+import json
+import os
+import sys
+import tempfile
+import unittest
+import uuid
+from datetime import datetime, timezone
+from unittest import mock
+
+# Các module của F1 được import trực tiếp (flat import) như khi chạy trong Lambda
+F1_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "f1_event_track")
+if F1_DIR not in sys.path:
+    sys.path.insert(0, F1_DIR)
+
+# Chạy không cần Firehose, PostgreSQL hay CloudWatch
+os.environ.setdefault("QUEUE_TYPE", "memory")
+os.environ.setdefault("METRICS_SINK", "none")
+os.environ.setdefault("PERSONA_LOOKUP_ENABLED", "false")
+
+import main as f1_main  # noqa: E402
+from dedup import DuplicateFilter, event_dedup_key  # noqa: E402
+from persona_cache import PersonaProfileCache  # noqa: E402
+from persona_snapshot import PersonaSnapshot, build_snapshot  # noqa: E402
+
+
+def make_event(**overrides) -> dict:
+    """Sự kiện hợp lệ theo tracking schema."""
+    event = {
+        "schema_version": "2025.04.28",
+        "tenant_id": "tenant_test",
+        "metric": "pageview",
+        "mediahost": "example.com",
+        "tpurl": "https://example.com/products/1",
+        "visid": str(uuid.uuid4()),
+        "event_id": str(uuid.uuid4()),
+    }
+    event.update(overrides)
+    return event
+
+
+def make_queue(fail_first_n: int = 0) -> f1_main.EventQueue:
+    queue = f1_main.EventQueue(client=f1_main.InMemoryFirehose(fail_first_n=fail_first_n))
+    # Không flush theo tuổi của buffer trong kiểm thử
+    queue.batch_max_age_seconds = 3600
+    return queue
+
+
+class TestEventQueue(unittest.TestCase):
+
+    def test_partial_failure_retries_only_failed_entries(self):
+        """FailedPutCount > 0: chỉ gửi lại các record bị lỗi, không gửi lại cả batch."""
+        queue = make_queue(fail_first_n=2)
+        events = [{"n": i} for i in range(5)]
+        queue.send_batch(events, [f"k{i}" for i in range(5)])
+
+        self.assertEqual(queue.flush(), 0)
+        self.assertEqual(queue.client.batch_calls, 2)
+        delivered = [json.loads(data) for data in queue.client.records]
+        self.assertEqual(len(delivered), 5)  # không có record bị gửi hai lần
+        self.assertEqual(sorted(e["n"] for e in delivered), list(range(5)))
+        self.assertEqual(queue.take_failures(), [])
+
+    def test_dropped_events_are_reported_once(self):
+        queue = make_queue(fail_first_n=2)
+        queue.max_retries = 0
+        queue.send_batch([{"n": i} for i in range(5)], [f"k{i}" for i in range(5)])
+
+        self.assertEqual(queue.flush(), 2)
+        self.assertEqual(queue.take_failures(), ["k0", "k1"])
+        self.assertEqual(queue.take_failures(), [])
+
+    def test_full_batch_is_flushed(self):
+        queue = make_queue()
+        queue.batch_max_records = 3
+        queue.send_batch([{"n": i} for i in range(2)])
+        self.assertEqual(queue.pending_count(), 2)
+        queue.send({"n": 2})
+        self.assertEqual(queue.pending_count(), 0)
+        self.assertEqual(len(queue.client.records), 3)
+
+    def test_backpressure_flushes_before_buffering_more(self):
+        queue = make_queue()
+        queue.max_buffered = 3
+        queue.send_batch([{"n": i} for i in range(3)])
+        self.assertEqual(len(queue.client.records), 0)
+
+        queue.send({"n": 3})
+        self.assertEqual(len(queue.client.records), 3)
+        self.assertEqual(queue.pending_count(), 1)
+
+    def test_failures_are_reported_to_the_sending_request(self):
+        queue = make_queue(fail_first_n=1)
+        queue.max_retries = 0
+        dropped = []
+        queue.on_dropped = dropped.extend
+
+        def other_request():
+            # Request khác (context riêng) flush cả event của request đang chạy
+            with queue.track_failures():
+                queue.send({"n": 1}, "a")
+                queue.flush()
+                return queue.take_request_failures()
+
+        with queue.track_failures():
+            queue.send({"n": 0}, "b")
+            self.assertEqual(contextvars.Context().run(other_request), [])
+            self.assertEqual(queue.take_request_failures(), ["b"])
+        self.assertEqual(dropped, ["b"])
+        self.assertEqual(queue.take_failures(), [])
+
+    def test_oversize_event_is_rejected(self):
+        queue = make_queue()
+        with self.assertRaises(ValueError):
+            queue.send({"blob": "x" * (f1_main.FIREHOSE_MAX_RECORD_BYTES + 1)})
+        self.assertEqual(queue.pending_count(), 0)
+
+
+class TestWebEventProcessorDelivery(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = make_queue()
+        self.processor = f1_main.WebEventProcessor(self.queue, DuplicateFilter(capacity=1000))
+
+    def handle(self, body, flush=True):
+        response = self.processor.handle_event({"body": json.dumps(body)}, flush)
+        return response["statusCode"], json.loads(response["body"])
+
+    def test_flush_at_invocation_end(self):
+        status, _ = self.handle(make_event(), flush=False)
+        self.assertEqual(status, 200)
+        self.assertEqual(self.queue.pending_count(), 1)
+        self.assertEqual(len(self.queue.client.records), 0)
+
+        status, _ = self.handle(make_event(), flush=True)
+        self.assertEqual(status, 200)
+        self.assertEqual(self.queue.pending_count(), 0)
+        self.assertEqual(len(self.queue.client.records), 2)
+
+    def test_dropped_event_returns_500_and_is_not_suppressed_on_retry(self):
+        self.queue.client.fail_first_n = 1
+        self.queue.max_retries = 0
+        event = make_event()
+
+        status, _ = self.handle(event)
+        self.assertEqual(status, 500)
+
+        status, body = self.handle(event)
+        self.assertEqual(status, 200)
+        self.assertFalse(body.get("duplicate", False))
+        self.assertEqual(len(self.queue.client.records), 1)
+
+        # Đã gửi thành công: lần gửi lại tiếp theo là duplicate
+        status, body = self.handle(event)
+        self.assertEqual(status, 200)
+        self.assertTrue(body["duplicate"])
+        self.assertEqual(len(self.queue.client.records), 1)
+
+    def test_event_dropped_by_the_periodic_flush_is_forgotten(self):
+        self.queue.client.fail_first_n = 1
+        self.queue.max_retries = 0
+        event = make_event()
+
+        status, _ = self.handle(event, flush=False)
+        self.assertEqual(status, 200)
+        # Flusher của server.py: không thuộc request nào
+        self.assertEqual(self.queue.flush(), 1)
+
+        status, body = self.handle(event)
+        self.assertEqual(status, 200)
+        self.assertFalse(body.get("duplicate", False))
+        self.assertEqual(len(self.queue.client.records), 1)
+
+    def test_batch_reports_failed_items(self):
+        self.queue.client.fail_first_n = 2
+        self.queue.max_retries = 0
+        visitor = str(uuid.uuid4())
+        events = [make_event(visid=visitor) for _ in range(3)] + [make_event()]
+
+        status, body = self.handle({"events": events})
+        self.assertEqual(status, 500)
+        self.assertEqual([r["status"] for r in body["results"]], ["failed", "failed", "ok", "ok"])
+        # Persona trả về một lần cho mỗi visitor, không lặp lại trong từng item
+        self.assertTrue(all("persona_profiles" not in r for r in body["results"]))
+        self.assertEqual(
+            sorted(body["persona_profiles"]),
+            sorted({f"tenant_test:{visitor}", f"tenant_test:{events[3]['visid']}"}),
+        )
+
+        # Client gửi lại cả batch: item đã giao là duplicate, item lỗi được gửi lại
+        status, body = self.handle({"events": events})
+        self.assertEqual(status, 200)
+        self.assertEqual([r["status"] for r in body["results"]], ["ok", "ok", "duplicate", "duplicate"])
+        self.assertEqual(len(self.queue.client.records), 4)
+
+
+class TestPersonaProfileCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        entry_size = PersonaProfileCache._estimate_size(("t", "v1"), ("a",))
+        cache = PersonaProfileCache(max_bytes=2 * entry_size)
+        cache.put("t", "v1", ["a"])
+        cache.put("t", "v2", ["a"])
+        self.assertEqual(cache.get("t", "v1"), ["a"])  # v1 vừa được dùng, v2 là LRU
+
+        cache.put("t", "v3", ["a"])
+        self.assertEqual(cache.get("t", "v1"), ["a"])
+        self.assertIsNone(cache.get("t", "v2"))
+        self.assertEqual(cache.get("t", "v3"), ["a"])
+        self.assertEqual(cache.evictions, 1)
+        self.assertLessEqual(cache.bytes_used, cache.max_bytes)
+
+    def test_negative_entry_expires(self):
+        cache = PersonaProfileCache(max_bytes=1024 * 1024, negative_ttl_seconds=60)
+        with mock.patch("persona_cache.time.monotonic", return_value=1000.0):
+            cache.put("t", "unknown", [])
+            cache.put("t", "known", ["a"])
+            self.assertEqual(cache.get("t", "unknown"), [])  # known miss, khác với None (chưa cache)
+
+        with mock.patch("persona_cache.time.monotonic", return_value=1061.0):
+            self.assertIsNone(cache.get("t", "unknown"))
+            self.assertEqual(cache.get("t", "known"), ["a"])  # entry có persona không hết hạn
+        self.assertEqual(len(cache), 1)
+
+
+class TestEventValidation(unittest.TestCase):
+
+    def setUp(self):
+        self.processor = f1_main.WebEventProcessor(make_queue())
+
+    def test_valid_event(self):
+        self.assertIsNotNone(f1_main.validate_event_schema)
+        self.assertEqual(self.processor._validate_event(make_event()), [])
+
+    def test_invalid_events(self):
+        event = make_event()
+        del event["metric"]
+        self.assertEqual(self.processor._validate_event(event)[0]["field"], "$")
+        # Ràng buộc của F1: visid vừa cột VARCHAR(36), metric ngắn hơn 50 ký tự
+        self.assertEqual(self.processor._validate_event(make_event(visid="v" * 37))[0]["field"], "visid")
+        self.assertEqual(self.processor._validate_event(make_event(metric="m" * 50))[0]["field"], "metric")
+        self.assertEqual(self.processor._validate_event(make_event(tenant_id=""))[0]["field"], "tenant_id")
+        self.assertEqual(self.processor._validate_event(make_event(event_id="not-a-uuid")),
+                         [{"field": "event_id", "reason": "must be uuid"}])
+        self.assertEqual(self.processor._validate_event(["not", "an", "object"]), [{"field": "$", "reason": "must be object"}])
+
+    def test_basic_checks_without_compiled_schema(self):
+        # Khi không biên dịch được schema, chỉ kiểm tra visid, tenant_id và metric
+        with mock.patch.object(f1_main, "validate_event_schema", None):
+            self.assertEqual(self.processor._validate_event(make_event(event_id="not-a-uuid")), [])
+            self.assertEqual(len(self.processor._validate_event(make_event(visid="v" * 37))), 1)
+            self.assertEqual(len(self.processor._validate_event({"visid": "v", "tenant_id": "t"})), 1)
+
+
+class TestDuplicateFilter(unittest.TestCase):
+
+    def test_add_forget(self):
+        duplicate_filter = DuplicateFilter(capacity=1000)
+        self.assertFalse(duplicate_filter.contains("k1"))
+        duplicate_filter.add(["k1", "k2"])
+        self.assertTrue(duplicate_filter.contains("k1"))
+
+        duplicate_filter.forget(["k1"])
+        self.assertFalse(duplicate_filter.contains("k1"))
+        self.assertTrue(duplicate_filter.contains("k2"))
+
+        duplicate_filter.add(["k1"])
+        self.assertTrue(duplicate_filter.contains("k1"))
+
+    def test_forget_past_capacity_resets(self):
+        duplicate_filter = DuplicateFilter(capacity=2)
+        duplicate_filter.add(["k1"])
+        duplicate_filter.forget(["a", "b", "c"])
+        self.assertFalse(duplicate_filter.contains("k1"))
+
+    def test_keys_expire_after_two_windows(self):
+        with mock.patch("dedup.time.monotonic", return_value=0.0):
+            duplicate_filter = DuplicateFilter(capacity=1000, window_seconds=10)
+            duplicate_filter.add(["k1"])
+        with mock.patch("dedup.time.monotonic", return_value=11.0):
+            self.assertTrue(duplicate_filter.contains("k1"))  # trong filter trước
+        with mock.patch("dedup.time.monotonic", return_value=22.0):
+            self.assertFalse(duplicate_filter.contains("k1"))
+
+    def test_event_dedup_key(self):
+        event = make_event()
+        self.assertEqual(event_dedup_key(event), f"tenant_test:id:{event['event_id']}")
+
+        without_id = {"tenant_id": "t", "metric": "pageview", "visid": "v"}
+        reordered = {"visid": "v", "metric": "pageview", "tenant_id": "t"}
+        self.assertEqual(event_dedup_key(without_id), event_dedup_key(reordered))
+        self.assertNotEqual(event_dedup_key(without_id), event_dedup_key(dict(without_id, metric="click")))
+
+
+class TestPersonaSnapshot(unittest.TestCase):
+
+    def test_round_trip(self):
+        rows = [("tenant_test", f"visitor-{i}", ["persona_a", "persona_b"] if i % 2 else '["persona_c"]') for i in range(1000)]
+        rows.append(("tenant_test", "no-persona", []))
+        watermark = datetime(2025, 5, 1, 8, 30)  # naive, được hiểu là UTC
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "persona_snapshot.bin")
+            self.assertEqual(build_snapshot(rows, path, watermark), 1000)
+
+            snapshot = PersonaSnapshot(path)
+            try:
+                self.assertEqual(len(snapshot), 1000)
+                self.assertEqual(snapshot.watermark, watermark.replace(tzinfo=timezone.utc))
+                for tenant_id, visitor_id, profiles in rows[:-1]:
+                    expected = json.loads(profiles) if isinstance(profiles, str) else profiles
+                    self.assertEqual(snapshot.get(tenant_id, visitor_id), expected)
+                self.assertIsNone(snapshot.get("tenant_test", "no-persona"))
+                self.assertIsNone(snapshot.get("other_tenant", "visitor-1"))
+            finally:
+                snapshot.close()
+
+
+if __name__ == "__main__":
+    # Chạy từ thư mục gốc: python -m pytest test_cases/test_event_track.py
+    unittest.main(argv=['first-arg-is-ignored'], exit=False)
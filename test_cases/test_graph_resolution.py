@@ -0,0 +1,101 @@
+import os
+import sys
+import unittest
+
+# Các module của F0 được import trực tiếp (flat import) như khi chạy worker
+F0_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "f0_setup_and_synch")
+if F0_DIR not in sys.path:
+    sys.path.insert(0, F0_DIR)
+
+import graph_resolution  # noqa: E402
+from graph_resolution import UnionFind  # noqa: E402
+
+
+class FakeCursor:
+    """Cursor giả: ghi lại câu lệnh SQL và nội dung COPY."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, sql, params=None):
+        self.conn.statements.append(sql)
+        self.rowcount = 1
+
+    def copy_expert(self, sql, buffer):
+        self.conn.statements.append(sql)
+        self.conn.copied = buffer.read()
+
+    def fetchone(self):
+        return (self.conn.has_behavioral_events,)
+
+
+class FakeConnection:
+
+    def __init__(self, has_behavioral_events=False):
+        self.statements = []
+        self.copied = None
+        self.has_behavioral_events = has_behavioral_events
+
+    def cursor(self, name=None):
+        return FakeCursor(self)
+
+
+class TestUnionFind(unittest.TestCase):
+
+    def test_components(self):
+        union_find = UnionFind()
+        edges = [("a", "b"), ("c", "d"), ("b", "c"), ("e", "f"), ("a", "a")]
+        self.assertEqual(union_find.add_edges(iter(edges)), 5)
+
+        components = sorted(sorted(members) for members in union_find.components())
+        self.assertEqual(components, [["a", "b", "c", "d"], ["e", "f"]])
+        self.assertEqual(union_find.root("a"), union_find.root("d"))
+        self.assertNotEqual(union_find.root("a"), union_find.root("e"))
+        self.assertIsNone(union_find.root("unknown"))
+
+    def test_single_key_is_not_a_component(self):
+        union_find = UnionFind()
+        union_find.union("a", "a")
+        union_find.union("b", "c")
+        self.assertEqual(union_find.components(), [["b", "c"]])
+
+    def test_long_chain(self):
+        union_find = UnionFind()
+        union_find.add_edges((i, i + 1) for i in range(10000))
+        components = union_find.components()
+        self.assertEqual(len(components), 1)
+        self.assertEqual(len(components[0]), 10001)
+
+
+class TestMergeComponents(unittest.TestCase):
+
+    def test_copies_components_and_merges_in_order(self):
+        conn = FakeConnection()
+        stats = graph_resolution.merge_components(conn, [["m1", "m2"], ["m3", "m4", "m5"]])
+
+        self.assertEqual(conn.copied, "m1\t0\nm2\t0\nm3\t1\nm4\t1\nm5\t1\n")
+        statements = conn.statements
+        # Khóa master trước khi gộp, xóa master đã gộp sau cùng
+        self.assertLess(statements.index(graph_resolution.sql_lock_graph_masters),
+                        statements.index(graph_resolution.sql_create_master_merges))
+        self.assertEqual(statements[-1], graph_resolution.sql_delete_merged_masters)
+        self.assertNotIn(graph_resolution.sql_repoint_behavioral_events, statements)
+        self.assertNotIn("behavioral_events", stats)
+
+    def test_repoints_behavioral_events_when_the_table_exists(self):
+        conn = FakeConnection(has_behavioral_events=True)
+        stats = graph_resolution.merge_components(conn, [["m1", "m2"]])
+        self.assertIn(graph_resolution.sql_repoint_behavioral_events, conn.statements)
+        self.assertEqual(stats["behavioral_events"], 1)
+
+
+if __name__ == "__main__":
+    # Chạy từ thư mục gốc: python -m pytest test_cases/test_graph_resolution.py
+    unittest.main(argv=['first-arg-is-ignored'], exit=False)
@@ -0,0 +1,307 @@
+import base64
+import json
+import multiprocessing
+import os
+import sys
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+from unittest import mock
+
+import psycopg2
+from psycopg2.extras import Json
+
+# Các module của F2 được import trực tiếp (flat import) như khi chạy trong Lambda
+F2_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "f2_event_to_entities")
+if F2_DIR not in sys.path:
+    sys.path.insert(0, F2_DIR)
+
+import behavioral_events  # noqa: E402
+import field_mapping  # noqa: E402
+import pipeline  # noqa: E402
+from backfill_canonical_identifiers import backfill_master, backfill_raw_profile  # noqa: E402
+from processor import (  # noqa: E402
+    PROFILE_FINGERPRINT_EXCLUDED_COLUMNS, RAW_PROFILE_COLUMNS, _copy_text_value, build_profile_row, canonical_email,
+    canonical_phone_number, compute_profile_fingerprint, event_to_profile, fold_name, save_with_failure_isolation,
+)
+
+
+class TestSaveWithFailureIsolation(unittest.TestCase):
+
+    def make_save_batch(self, bad_rows, error=psycopg2.DataError):
+        """save_batch giả: từ chối cả batch nếu có dòng lỗi, như một câu lệnh INSERT nhiều dòng."""
+        self.saved = []
+        self.calls = 0
+
+        def save_batch(batch):
+            self.calls += 1
+            if any(row in bad_rows for row in batch):
+                raise error("value too long for type character varying(50)")
+            self.saved.extend(batch)
+        return save_batch
+
+    def test_bad_rows_are_isolated(self):
+        rows = [f"row-{i}" for i in range(16)]
+        failed = save_with_failure_isolation(rows, self.make_save_batch({"row-5", "row-11"}), describe=str)
+
+        self.assertEqual(failed, [5, 11])
+        # Các dòng còn lại đều được lưu, theo thứ tự ban đầu
+        self.assertEqual(self.saved, [row for row in rows if row not in ("row-5", "row-11")])
+        # O(log n) batch con cho mỗi dòng lỗi, không phải một lần lưu cho mỗi dòng
+        self.assertLess(self.calls, len(rows))
+
+    def test_clean_batch_is_saved_once(self):
+        rows = [f"row-{i}" for i in range(8)]
+        self.assertEqual(save_with_failure_isolation(rows, self.make_save_batch(set()), describe=str), [])
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.saved, rows)
+
+    def test_integrity_error_is_isolated(self):
+        rows = ["a", "b", "c"]
+        failed = save_with_failure_isolation(rows, self.make_save_batch({"c"}, psycopg2.IntegrityError), describe=str)
+        self.assertEqual(failed, [2])
+        self.assertEqual(self.saved, ["a", "b"])
+
+    def test_other_errors_are_raised(self):
+        rows = ["a", "b"]
+        with self.assertRaises(psycopg2.OperationalError):
+            save_with_failure_isolation(rows, self.make_save_batch({"a"}, psycopg2.OperationalError), describe=str)
+
+
+class TestCompiledFieldMapping(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        field_mapping.install_profile_transform(field_mapping.DEFAULT_FIELD_MAPPINGS)
+
+    @staticmethod
+    def comparable(row) -> dict:
+        # received_at là thời điểm tạo dòng, khác nhau giữa hai lần gọi
+        return {
+            column: getattr(value, "adapted", value)
+            for column, value in zip(RAW_PROFILE_COLUMNS, row)
+            if column != "received_at"
+        }
+
+    def test_same_row_as_legacy_mapping(self):
+        events = [
+            {
+                "tenant_id": "tenant_test", "visid": "visitor-1", "metric": "pageview",
+                "profile_traits": {
+                    "usersource": "crm", "email": "An.Nguyen@Example.com", "phone": "0901234567",
+                    "firstname": "Đức <b>", "lastname": "Nguyễn", "userid": "u-1", "birthday": "2000-01-01",
+                },
+            },
+            {
+                "tenant_id": "tenant_test", "visid": "visitor-2", "metric": "identify",
+                "profile_traits": {
+                    "source_system": "app", "name": "An", "first_name": "Bình", "gender": "female",
+                    "preferred_communication": {"email": True}, "ext_attributes": {"loyalty_tier": "gold"},
+                },
+            },
+        ]
+        for event in events:
+            legacy_row = build_profile_row(event_to_profile(event))
+            compiled_row = field_mapping.transform_event(event)
+            self.assertEqual(len(compiled_row), len(legacy_row))
+            self.assertEqual(self.comparable(compiled_row), self.comparable(legacy_row))
+
+    def test_invalid_values_are_rejected_by_both(self):
+        for traits in ({"email": "not-an-email"}, {"phone_number": "090-abc"}):
+            event = {"tenant_id": "tenant_test", "visid": "visitor-3", "profile_traits": traits}
+            with self.assertRaises(ValueError):
+                field_mapping.transform_event(event)
+            with self.assertRaises(ValueError):
+                build_profile_row(event_to_profile(event))
+
+    def test_attribute_without_column_goes_to_ext_attributes(self):
+        mappings = field_mapping.DEFAULT_FIELD_MAPPINGS + (field_mapping.FieldMapping("loyalty_tier", ("tier",)),)
+        transform = field_mapping.compile_profile_transform(mappings)
+        row = transform({"tenant_id": "tenant_test", "visid": "visitor-4", "profile_traits": {"tier": "gold"}})
+        ext_attributes = row[RAW_PROFILE_COLUMNS.index("ext_attributes")].adapted
+        self.assertEqual(ext_attributes, {"loyalty_tier": "gold"})
+
+
+class TestCanonicalIdentifiers(unittest.TestCase):
+
+    def test_canonical_phone_number(self):
+        self.assertEqual(canonical_phone_number("0901234567"), "+84901234567")
+        self.assertEqual(canonical_phone_number(" +84 90 123 4567 "), "+84901234567")
+        self.assertEqual(canonical_phone_number("+1 650-253-0000"), "+16502530000")
+        # Không phải số điện thoại hợp lệ: giữ nguyên (đã bỏ khoảng trắng hai đầu)
+        self.assertEqual(canonical_phone_number(" 12 "), "12")
+        self.assertEqual(canonical_phone_number("abc"), "abc")
+
+    def test_canonical_email(self):
+        self.assertEqual(canonical_email("  An.Nguyen@Example.COM "), "an.nguyen@example.com")
+        # NFKC: chữ full-width thành ASCII
+        self.assertEqual(canonical_email("ａｎ@example.com"), "an@example.com")
+
+    def test_fold_name(self):
+        self.assertEqual(fold_name("Nguyễn  Văn Đức"), "nguyen van duc")
+        self.assertEqual(fold_name("  "), "")
+
+    def test_backfill_uses_the_same_canonical_forms(self):
+        row = ("id-1", "An@Example.com", "0901234567", "Đức &lt;b&gt;", "Nguyễn", None, None, None)
+        self.assertEqual(
+            backfill_raw_profile(row),
+            ("id-1", "an@example.com", "+84901234567", "An@Example.com", "0901234567", "duc <b> nguyen"),
+        )
+        # Dòng đã ở dạng chuẩn: không cập nhật
+        canonical_row = ("id-2", "an@example.com", "+84901234567", "An", None, "An@Example.com", "0901234567", "an")
+        self.assertIsNone(backfill_raw_profile(canonical_row))
+
+    def test_backfill_master_deduplicates_secondary_values(self):
+        row = ("m-1", "An@Example.com", ["an@example.com", "B@Example.com"], "0901234567", ["+84901234567", "0912345678"])
+        self.assertEqual(
+            backfill_master(row),
+            ("m-1", "an@example.com", ["b@example.com"], "+84901234567", ["+84912345678"]),
+        )
+        self.assertIsNone(backfill_master(("m-2", "an@example.com", None, "+84901234567", [])))
+
+
+def make_record(record_id, event) -> dict:
+    """Firehose record của một sự kiện (base64 của JSON)."""
+    data = event if isinstance(event, str) else json.dumps(event)
+    return {"recordId": record_id, "data": base64.b64encode(data.encode("utf-8")).decode("ascii")}
+
+
+class TestProcessRecordsPipelined(unittest.TestCase):
+
+    def setUp(self):
+        self.records = []
+        for i in range(10):
+            event = {"tenant_id": "tenant_test", "visid": f"visitor-{i}", "profile_traits": {"email": f"user{i}@example.com"}}
+            # Record 3 và 7 không decode được
+            self.records.append(make_record(f"r{i}", "not json" if i in (3, 7) else event))
+        self.saved = []
+
+    def save_batch(self, rows):
+        self.saved.extend(rows)
+        # Database từ chối dòng thứ hai của mỗi batch
+        return [1] if len(rows) > 1 else []
+
+    def run_pipeline(self, pool_kind, convert=pipeline.convert_record_data, **kwargs):
+        return pipeline.process_records_pipelined(
+            self.records, self.save_batch, batch_size=3, workers=2, chunk_size=4, pool_kind=pool_kind,
+            convert=convert, **kwargs
+        )
+
+    def test_keeps_order_and_count(self):
+        output = self.run_pipeline("thread")
+
+        self.assertEqual([r["recordId"] for r in output], [r["recordId"] for r in self.records])
+        self.assertEqual([r["data"] for r in output], [r["data"] for r in self.records])
+        self.assertEqual(
+            [r["result"] for r in output],
+            ["Ok", "ProcessingFailed", "Ok", "Dropped", "Ok", "ProcessingFailed", "Ok", "Dropped", "Ok", "ProcessingFailed"],
+        )
+        self.assertEqual(len(self.saved), 8)
+
+    def test_process_pool_workers_install_the_compiled_mapping(self):
+        field_mapping.install_profile_transform(field_mapping.DEFAULT_FIELD_MAPPINGS)
+        # spawn: worker không kế thừa transform đã biên dịch của process cha, chỉ có initializer
+        spawn_pool = partial(ProcessPoolExecutor, mp_context=multiprocessing.get_context("spawn"))
+        with mock.patch.object(pipeline, "ProcessPoolExecutor", spawn_pool):
+            output = self.run_pipeline(
+                "process", convert=partial(pipeline.convert_record_data, convert=field_mapping.convert_event_to_row),
+                initializer=field_mapping.install_profile_transform, initargs=(field_mapping.get_profile_mappings(),),
+            )
+
+        self.assertEqual([r["result"] for r in output].count("Dropped"), 2)
+        self.assertEqual(len(self.saved), 8)
+        emails = [row[RAW_PROFILE_COLUMNS.index("email")] for row in self.saved]
+        self.assertEqual(emails, [f"user{i}@example.com" for i in range(10) if i not in (3, 7)])
+
+
+class TestBehavioralEvents(unittest.TestCase):
+
+    def test_created_at_fallback_order(self):
+        event = {"datetime": "2025-05-01T08:30:00+07:00", "unix_timestamp": 1746000000000}
+        self.assertEqual(behavioral_events.event_created_at(event, 1746100000000), "2025-05-01T08:30:00+07:00")
+
+        del event["datetime"]
+        self.assertEqual(behavioral_events.event_created_at(event, 1746100000000), "2025-04-30T08:00:00+00:00")
+
+        # unix_timestamp không phải số: dùng approximateArrivalTimestamp của Firehose record
+        event["unix_timestamp"] = "1746000000000"
+        self.assertEqual(behavioral_events.event_created_at(event, 1746100000000), "2025-05-01T11:46:40+00:00")
+        self.assertIsNone(behavioral_events.event_created_at(event))
+
+    def test_event_without_time_has_no_row(self):
+        event = {"tenant_id": "tenant_test", "visid": "visitor-1", "metric": "pageview"}
+        self.assertIsNone(behavioral_events.build_behavioral_event(event))
+        self.assertIsNotNone(behavioral_events.build_behavioral_event(event, 1746100000000))
+
+    def test_assign_event_ids_is_stable(self):
+        event = {
+            "tenant_id": "tenant_test", "visid": "visitor-1", "metric": "pageview", "unix_timestamp": 1746000000000,
+            "tpurl": "https://example.com/", "sessionid": "s-1", "event_id": "e-1",
+        }
+        row = behavioral_events.build_behavioral_event(event, 1746100000000)
+        # Firehose gửi lại record với arrival time khác: cùng id
+        retried_row = behavioral_events.build_behavioral_event(event, 1746200000000)
+        other_row = behavioral_events.build_behavioral_event(dict(event, metric="click"), 1746100000000)
+
+        ids = [r[0] for r in behavioral_events.assign_event_ids([row, retried_row, other_row])]
+        self.assertIsNone(row[0])
+        self.assertEqual(ids[0], ids[1])
+        self.assertNotEqual(ids[0], ids[2])
+        self.assertEqual(len(ids[0]), 64)
+
+
+class TestCopyTextValue(unittest.TestCase):
+
+    def test_special_characters_are_escaped(self):
+        # Định dạng text của COPY: tab, xuống dòng và backslash phải được escape
+        self.assertEqual(_copy_text_value("a\tb\nc\\d\re"), "a\\tb\\nc\\\\d\\re")
+        self.assertEqual(_copy_text_value("C:\\new"), "C:\\\\new")
+
+    def test_null_json_and_datetime(self):
+        self.assertEqual(_copy_text_value(None), "\\N")
+        self.assertEqual(_copy_text_value("\\N"), "\\\\N")  # chuỗi '\N' không bị hiểu là NULL
+        self.assertEqual(_copy_text_value(Json({"note": "x\ty"})), '{"note": "x\\\\ty"}')
+        self.assertEqual(_copy_text_value(datetime(2025, 5, 1, 8, 30, tzinfo=timezone.utc)), "2025-05-01T08:30:00+00:00")
+        self.assertEqual(_copy_text_value(12.5), "12.5")
+
+
+class TestProfileFingerprint(unittest.TestCase):
+
+    def make_row(self, **traits):
+        profile_traits = {"email": "an@example.com", "firstname": "An", "usersource": "crm"}
+        profile_traits.update(traits)
+        return build_profile_row(event_to_profile({
+            "tenant_id": "tenant_test", "visid": "visitor-1", "metric": "pageview", "profile_traits": profile_traits,
+        }))
+
+    def replace(self, row, column, value):
+        row = list(row)
+        row[RAW_PROFILE_COLUMNS.index(column)] = value
+        return tuple(row)
+
+    def test_stable_across_calls(self):
+        # received_at khác nhau giữa hai lần build_profile_row nhưng không nằm trong fingerprint
+        first, second = self.make_row(), self.make_row()
+        self.assertEqual(compute_profile_fingerprint(first), compute_profile_fingerprint(second))
+        self.assertEqual(len(compute_profile_fingerprint(first)), 32)
+
+    def test_trait_change_changes_fingerprint(self):
+        self.assertNotEqual(compute_profile_fingerprint(self.make_row()),
+                            compute_profile_fingerprint(self.make_row(firstname="Bình")))
+        self.assertNotEqual(compute_profile_fingerprint(self.make_row()),
+                            compute_profile_fingerprint(self.make_row(ext_attributes={"tier": "gold"})))
+
+    def test_excluded_columns_are_ignored(self):
+        row = self.make_row()
+        fingerprint = compute_profile_fingerprint(row)
+        # profile_fingerprint chưa có trong row: cột này được thêm khi lưu
+        for column in PROFILE_FINGERPRINT_EXCLUDED_COLUMNS:
+            if column in RAW_PROFILE_COLUMNS[:len(row)]:
+                self.assertEqual(compute_profile_fingerprint(self.replace(row, column, "changed")), fingerprint, column)
+        self.assertNotEqual(compute_profile_fingerprint(self.replace(row, "email", "binh@example.com")), fingerprint)
+
+
+if __name__ == "__main__":
+    # Chạy từ thư mục gốc: python -m pytest test_cases/test_profile_pipeline.py
+    unittest.main(argv=['first-arg-is-ignored'], exit=False)
@@ -0,0 +1,81 @@
+import os
+import sys
+import unittest
+
+# Các module của F0 được import trực tiếp (flat import) như khi chạy worker
+F0_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "f0_setup_and_synch")
+if F0_DIR not in sys.path:
+    sys.path.insert(0, F0_DIR)
+
+from resolution_worker import resolve_batch, unmatched_ords  # noqa: E402
+
+
+def email(value):
+    return ("tenant_test", "email", value)
+
+
+def phone(value):
+    return ("tenant_test", "phone_number", value)
+
+
+class TestResolveBatch(unittest.TestCase):
+
+    def test_existing_master_is_matched_by_priority(self):
+        identifiers = [(1, email("an@example.com")), (1, phone("+84901234567"))]
+        master_ids = {email("an@example.com"): "master-email", phone("+84901234567"): "master-phone"}
+
+        rows = resolve_batch(1, identifiers, master_ids)
+        # Identifier đầu tiên (ưu tiên cao nhất) quyết định master
+        self.assertEqual(rows, [(1, "master-email", 1, "master-email", False)])
+
+    def test_profiles_sharing_an_identifier_create_one_master(self):
+        identifiers = [
+            (1, email("an@example.com")),
+            (2, email("an@example.com")), (2, phone("+84901234567")),
+            (3, phone("+84901234567")),
+            (4, email("binh@example.com")),
+        ]
+        rows = resolve_batch(4, identifiers, {})
+
+        ords, matched, anchors, finals, creators = zip(*rows)
+        self.assertEqual(ords, (1, 2, 3, 4))
+        self.assertEqual(matched, (None, None, None, None))
+        # 1, 2, 3 nối với nhau qua email và số điện thoại: một nhóm, raw profile 1 tạo master
+        self.assertEqual(anchors, (1, 1, 1, 4))
+        self.assertEqual(len({finals[0], finals[1], finals[2]}), 1)
+        self.assertNotEqual(finals[3], finals[0])
+        self.assertEqual(creators, (True, False, False, True))
+
+    def test_group_joins_the_master_of_a_member(self):
+        identifiers = [(1, email("an@example.com")), (2, email("an@example.com")), (2, phone("+84901234567"))]
+        rows = resolve_batch(2, identifiers, {phone("+84901234567"): "master-1"})
+
+        self.assertEqual(rows, [
+            (1, None, 1, "master-1", False),
+            (2, "master-1", 1, "master-1", False),
+        ])
+
+    def test_profile_without_identifier_is_its_own_group(self):
+        rows = resolve_batch(2, [(2, email("an@example.com"))], {})
+
+        self.assertEqual([row[2] for row in rows], [1, 2])
+        self.assertTrue(all(row[4] for row in rows))
+        self.assertNotEqual(rows[0][3], rows[1][3])
+
+    def test_column_match_for_unregistered_identifiers(self):
+        # Raw profile 2 không khớp cdp_master_identifiers nhưng khớp cột của cdp_master_profiles
+        identifiers = [(1, email("an@example.com")), (2, phone("+84901234567")), (3, phone("+84901234567"))]
+        master_ids = {email("an@example.com"): "master-1"}
+        self.assertEqual(unmatched_ords(3, identifiers, master_ids), [2, 3])
+
+        rows = resolve_batch(3, identifiers, master_ids, {2: "master-2"})
+        self.assertEqual(rows, [
+            (1, "master-1", 1, "master-1", False),
+            (2, "master-2", 2, "master-2", False),
+            (3, None, 2, "master-2", False),
+        ])
+
+
+if __name__ == "__main__":
+    # Chạy từ thư mục gốc: python -m pytest test_cases/test_resolution_worker.py
+    unittest.main(argv=['first-arg-is-ignored'], exit=False)
@@ -11,6 +11,7 @@ requests_log.propagate = True # Ensure these logs are handled by the root logger
 
 from locust import HttpUser, task, between
 from faker import Faker
+import os
 import uuid
 import json
 from datetime import datetime, timedelta, timezone # Import timezone
@@ -28,7 +29,8 @@ def reset_redis_counters():
 
 reset_redis_counters()
 
-CDP_TRACK_URL = "https://cdp-api.resynap.com/id-resolution/c360-profile-track"
+# Point CDP_TRACK_URL at a local F1 server (f1_event_track/server.py) to load test without the public host
+CDP_TRACK_URL = os.environ.get("CDP_TRACK_URL", "https://cdp-api.resynap.com/id-resolution/c360-profile-track")
 
 fake = Faker('vi_VN')
 # logging.basicConfig(level=logging.INFO) # Avoid re-calling basicConfig